@@ -1,36 +1,70 @@
 import os
+import logging
 import markdown2
 from forms import AddKeywordForm, SubscribeEmailForm, TimeWindowForm
 from flask import (flash, render_template, request, escape, redirect, url_for, 
-                   session, abort)
+                   session, abort, jsonify)
 from flask_paginate import Pagination, get_page_parameter
 
 from parsing.notifications import send_email_subs_start_notification
 from parsing.parsing_options import (email_server, email_acc, email_port, 
                                      email_pass)
 from init_app import app
-from models import Bill
+from models import Bill, search_results_cache
+from search import check_index
+from percolator import add_keyword_percolators, remove_keyword_percolators
+from jobs import job_queue
+from keyword_matcher import scan_keyword
+import store
 
+
+logger = logging.getLogger("jobs")
     
 def get_all_keywords():
-    with open('keywords.txt', 'r') as f:
-        kws = [kw.strip() for kw in f.read().splitlines() if kw.strip()]
-        return kws
+    return store.get_keywords()
+
+@job_queue.register("update_keyword_percolators")
+def update_keyword_percolators(new_kws, unused_kws):
+    '''
+    Keeps percolator index in sync with subscriptions: adds new keywords,
+    removes keywords which aren't subscribed anymore. Keywords are checked
+    in db when job runs, jobs of several requests may run in any order
+    '''
+    subscribed_kws = store.get_subscribed_keywords()
+    index = app.config['PERCOLATOR_INDEX']
+    add_keyword_percolators(index, set(new_kws) & subscribed_kws)
+    remove_keyword_percolators(index, set(unused_kws) - subscribed_kws)
+
+@job_queue.register("send_subscription_email")
+def send_subscription_email(email, kws, time_limit):
+    send_email_subs_start_notification(email, kws, time_limit, email_server, 
+                                       email_acc, email_port, email_pass)
 
-def delete_email_from_list(email):
-    with open('subscribed_emails.txt', 'r') as f:
-        lines = [line.split(":") for line in f.read().splitlines()]
-        lines_updated = [":".join(line) for line in lines if line[0] != email]
-    with open('subscribed_emails.txt', 'w') as f:      
-        f.write("\n".join(lines_updated))
+@job_queue.register("scan_keyword")
+def scan_keyword_job(keyword):
+    # bills are scanned for new keyword of monitoring page
+    conn = store.connect()
+    try:
+        logger.info("Bills matching {}: {}".format(keyword,
+                                                   scan_keyword(conn, keyword, 'bills')))
+    finally:
+        conn.close()
+
+def enqueue_percolators_update(new_kws, unused_kws):
+    # missing keywords are added to index before notifications anyway
+    if app.config['NOTIFICATIONS_USE_PERCOLATOR'] and (new_kws or unused_kws) and \
+            app.config['SEARCH_BACKEND'] == 'elasticsearch':
+        job_queue.enqueue("update_keyword_percolators", new_kws=list(new_kws),
+                          unused_kws=list(unused_kws))
 
 def subscribe_email(email, kws, time_limit):
-    delete_email_from_list(email)
-    with open('subscribed_emails.txt', 'a') as f:
-        f.write("\n" + email + ":" + kws + ":" + time_limit + "\n")
+    # kws - list of keywords
+    unused_kws = store.subscribe(email, kws, time_limit)
+    enqueue_percolators_update(kws, unused_kws)
 
 def unsubscribe_email(email):
-    delete_email_from_list(email)
+    unused_kws = store.unsubscribe(email)
+    enqueue_percolators_update([], unused_kws)
         
 
 @app.route('/')
@@ -53,10 +87,27 @@ def search(search):
         query = get_all_keywords()
     else:
         query = [search]
+
+    # ?cursor= - pages are got by cursor of previous page (for deep pages),
+    # empty cursor is the first page
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            bills, total, next_cursor = Bill.get_cached_monitoring_results_after(
+                query, cursor or None, per_page=per_page, time_limit=time_window)
+        except ValueError:
+            abort(400)
+        return render_template('results.html',
+                               results=bills,
+                               total=total,
+                               next_cursor=next_cursor,
+                               cursor_mode=True,
+                               escape=escape,
+                               lazy_text=True)
             
-    bills, total = Bill.get_monitoring_results(query, page=page, 
-                                               per_page=per_page,
-                                               time_limit=time_window)
+    bills, total = Bill.get_cached_monitoring_results(query, page=page,
+                                                      per_page=per_page,
+                                                      time_limit=time_window)
     pagination = Pagination(page=page, total=total, per_page=per_page,
                             offset=offset,
                             css_framework='bootstrap4')
@@ -65,7 +116,12 @@ def search(search):
                            per_page=per_page,
                            page=page,
                            pagination=pagination,
-                           escape=escape)
+                           escape=escape,
+                           lazy_text=True)
+
+@app.route('/search_cache_stats')
+def search_cache_stats():
+    return jsonify(search_results_cache.get_stats())
 
 @app.route('/configure', methods=['GET', 'POST'])
 def configure():
@@ -74,18 +130,15 @@ def configure():
             new_keyword = request.form.get('new_kw')
             new_keyword = new_keyword.lower()
             try:
-                with open('keywords.txt', 'a') as f:
-                    f.write('\n' + new_keyword + '\n')
-                    flash(f'New keyword {new_keyword} added')
+                if store.add_keyword(new_keyword):
+                    job_queue.enqueue_once("scan_keyword", keyword=new_keyword)
+                flash(f'New keyword {new_keyword} added')
             except Exception as e:
                     flash(f'Error adding new keyword: ' + str(e))
         elif request.form.get("action_type") == "delete":
             kw_to_delete = request.form.get('name')
             try:
-                kws = get_all_keywords()
-                new_kws_list = list(filter(lambda kw: kw != kw_to_delete, kws))
-                with open('keywords.txt', 'w') as f:
-                    f.write('\n'.join(new_kws_list))
+                store.delete_keyword(kw_to_delete)
             except Exception as e:
                 flash("Error deletuing keyword: " + str(e))
                 kws = []
@@ -97,12 +150,16 @@ def configure():
     try:
         kws = get_all_keywords()
         print("Keywords: ", kws)
+        # numbers of bills in time window, for keywords which were scanned
+        kws_counts = Bill.get_keywords_counts(session.get("time_window") or "20y")
     except Exception as e:
         flash("Error getting keywords: " + str(e))
         kws = []
+        kws_counts = {}
     form_tw = TimeWindowForm()
     return render_template('configure.html', 
                            keywords=kws, 
+                           kws_counts=kws_counts, 
                            form_add=add_new_kw_form,
                            form_tw=form_tw)
 
@@ -111,12 +168,13 @@ def subscribe():
     if request.method == 'POST':
         email = request.form.get('email')
         kws = request.form.get('kws')
-        kws = [kw.strip() for kw in kws.split(",")]
+        kws = [kw.strip() for kw in kws.split(",") if kw.strip()]
         time_limit = request.form.get('time_limit')
         try:
-            subscribe_email(email, ",".join(kws), time_limit)
-            send_email_subs_start_notification(email, kws, time_limit, email_server, 
-                                               email_acc, email_port, email_pass)
+            subscribe_email(email, kws, time_limit)
+            # email is sent by background job, request doesn't wait for SMTP
+            job_queue.enqueue("send_subscription_email", email=email, kws=kws,
+                              time_limit=time_limit)
         except Exception as e:
             flash(f'Error: ' + str(e))
         else:
@@ -159,10 +217,37 @@ def bill_info(bill_leginfo_id):
     bill = Bill.query.filter(Bill.leginfo_id==bill_leginfo_id).first()
     return render_template('bill_page.html', bill=bill)
 
+@app.route('/api/bills/<bill_leginfo_id>')
+def bill_text(bill_leginfo_id):
+    # text of bill for modal of results page
+    # ?excerpt=<n> returns only first n characters of text
+    text = Bill.get_text_by_leginfo_id(bill_leginfo_id)
+    if text is None:
+        abort(404)
+    excerpt = request.args.get('excerpt', type=int)
+    if excerpt is not None and excerpt < 0:
+        abort(400)
+    truncated = excerpt is not None and len(text) > excerpt
+    if truncated:
+        text = text[:excerpt]
+    return jsonify(leginfo_id=bill_leginfo_id, text=text, truncated=truncated)
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
+if app.config['SEARCH_BACKEND'] == 'elasticsearch':
+    # app isn't started with index of older mapping (searches would find
+    # nothing)
+    with app.app_context():
+        check_index(Bill.__tablename__)
+# workers of background jobs run in process of web app
+job_queue.start()
+# keywords added before matches were saved (or whose jobs failed), jobs
+# which are pending (e.g. added by other process of app) aren't duplicated
+for _kw in store.get_unmatched_keywords():
+    job_queue.enqueue_once("scan_keyword", keyword=_kw)
+
 if __name__ == '__main__':
     #app.run("localhost", port=8080)
     app.run("0.0.0.0", port=80)
@@ -0,0 +1,111 @@
+'''
+Benchmark of bill text page extraction: one walk through lxml tree vs
+previous lxml -> bytes -> str -> HTMLParser round trip. Checks that both
+give the same text and publishing date
+
+Usage: python benchmarks/bench_bill_text.py pages [--repeat 5]
+(pages are saved with benchmarks/save_pages.py)
+'''
+import argparse
+import glob
+import os
+import re
+import sys
+import timeit
+from html.parser import HTMLParser
+
+from lxml import html
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing.extract import (date_publiched_regex, date_reformat_regex,
+                             extract_bill_text_and_date_published)
+
+
+# previous implementation
+
+class _HTMLToText(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._buf = []
+        self.hide_output = False
+    def handle_starttag(self, tag, attrs):
+        if tag in ('p', 'br', 'h1', 'h2', 'h3', 'div') and not self.hide_output:
+            self._buf.append('\n')
+        elif tag in ('script', 'style'):
+            self.hide_output = True
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'br':
+            self._buf.append('\n')
+    def handle_endtag(self, tag):
+        if tag == 'p' or 'h' in tag:
+            self._buf.append('\n')
+        elif tag in ('script', 'style'):
+            self.hide_output = False
+    def handle_data(self, text):
+        if text and not self.hide_output:
+            self._buf.append(re.sub(r'\s+', ' ', text))
+    def handle_charref(self, name):
+        if not self.hide_output:
+            n = int(name[1:], 16) if name.startswith('x') else int(name)
+            self._buf.append(chr(n))
+    def get_text(self):
+        return re.sub(r' +', ' ', ''.join(self._buf))
+
+def html_to_text(html):
+    parser = _HTMLToText()
+    parser.feed(html)
+    parser.close()
+    return parser.get_text().strip()
+
+def legacy_text_and_date_published(page_text):
+    tree = html.fromstring(bytes(page_text, encoding='utf-8'))
+    bill_text = tree.xpath("//div[@id='bill_all']")[0]
+    for strike in bill_text.xpath("//strike"):
+        strike.getparent().remove(strike)
+    new_tree = html.tostring(bill_text)
+    text = re.sub(r'\n\n\n|\\t|\t|\\n', '', html_to_text(str(new_tree)))[2:-1]
+    date_published = tree.xpath('//span[contains(text(), "Date Published")]')
+    if not date_published:
+        date_publiched = ''
+    else:
+        date_published = date_published[0]
+        date_publiched = date_publiched_regex.search(date_published.text).group(1)
+        date_publiched = date_reformat_regex.sub(r'\3-\1-\2', date_publiched)
+    return text, date_publiched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark bill text extraction")
+    parser.add_argument("pages_dir")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = dict()
+    for file_name in sorted(glob.glob(os.path.join(args.pages_dir, "text", "*.html"))):
+        with open(file_name, encoding="utf-8") as f:
+            pages[os.path.basename(file_name)[:-5]] = f.read()
+    if not pages:
+        sys.exit("No pages in " + os.path.join(args.pages_dir, "text"))
+
+    mismatches = 0
+    for leginfo_id, page_text in pages.items():
+        legacy = legacy_text_and_date_published(page_text)
+        new = extract_bill_text_and_date_published(page_text)
+        if legacy != new:
+            mismatches += 1
+            print("Mismatch " + leginfo_id)
+
+    legacy_time = timeit.timeit(lambda: [legacy_text_and_date_published(p)
+                                         for p in pages.values()],
+                                number=args.repeat)
+    new_time = timeit.timeit(lambda: [extract_bill_text_and_date_published(p)
+                                      for p in pages.values()],
+                             number=args.repeat)
+    parsed = len(pages) * args.repeat
+    size = sum(len(p) for p in pages.values()) / len(pages)
+    print("Pages: {} (avg {:.0f} KB), mismatches: {}".format(len(pages), size / 1024,
+                                                           mismatches))
+    print("Round trip: {:.2f} ms/page".format(legacy_time / parsed * 1000))
+    print("Tree walk:  {:.2f} ms/page".format(new_time / parsed * 1000))
+    print("Speedup: {:.1f}x".format(legacy_time / new_time))
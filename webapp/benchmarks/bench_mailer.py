@@ -0,0 +1,88 @@
+'''
+Benchmark of email delivery: messages per second of one SMTP connection
+sending serially (as before) vs mailer with pool of connections and
+concurrent workers. Messages are sent to local fake SMTP server, which
+answers every message after --latency seconds (like real server over network)
+
+Usage: python benchmarks/bench_mailer.py [--messages 200] [--workers 4] [--latency 0.02]
+'''
+import argparse
+import os
+import smtplib
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing.mailer import SMTPConnectionPool, Mailer
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    # minimal SMTP dialog without TLS and authentication
+    latency = 0
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        self.reply("220 fake smtp")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip().upper()
+            if command.startswith("EHLO") or command.startswith("HELO"):
+                self.reply("250 fake")
+            elif command == "DATA":
+                self.reply("354 end with .")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                time.sleep(self.latency)
+                self.server.received += 1
+                self.reply("250 ok")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.reply("250 ok")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    received = 0
+
+
+def run(messages, workers, server_addr):
+    pool = SMTPConnectionPool(lambda: smtplib.SMTP(*server_addr), workers)
+    mailer = Mailer(pool, workers, rate=0)
+    started = time.time()
+    sent_cnt = mailer.send_all(messages)
+    elapsed = time.time() - started
+    mailer.close()
+    return sent_cnt, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark sending of emails")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    FakeSMTPHandler.latency = args.latency
+    server = FakeSMTPServer(("127.0.0.1", 0), FakeSMTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    msg = "Subject: test\r\n\r\n" + "Bill changed\r\n" * 50
+    messages = [("from@example.com", "to{}@example.com".format(i), msg)
+                for i in range(args.messages)]
+    for name, workers in (("Serial (1 connection)", 1),
+                          ("Pool ({} connections)".format(args.workers), args.workers)):
+        sent_cnt, elapsed = run(messages, workers, server.server_address)
+        print("{}: {} sent in {:.2f} s, {:.1f} messages/s".format(
+            name, sent_cnt, elapsed, sent_cnt / elapsed))
+    server.shutdown()
@@ -0,0 +1,100 @@
+'''
+Benchmark of search backends on the same bills: latency of search queries
+(first page and total, like search page) with elasticsearch and with SQLite
+FTS5 index, memory used by them. Elasticsearch index "bill" must be made
+from the same bills.db (reindex.py), it's skipped if server isn't available.
+FTS5 index is created in bills.db if it doesn't exist
+
+Usage (from webapp directory): python benchmarks/bench_search_backends.py
+[--keywords education "public health" tax] [--repeat 20] [--time-limit 2y]
+'''
+import argparse
+import os
+import resource
+import sqlite3
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from init_app import app, db_file_name
+from search import make_query
+from search_fts import create_fts_index, get_index_size
+
+
+def get_rss_mb():
+    # max resident memory of this process (kilobytes on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def get_es_memory_mb():
+    '''
+    Returns (heap used by elasticsearch nodes, size of index "bill") in MB
+    '''
+    es = app.elasticsearch
+    nodes = es.nodes.stats(metric="jvm")["nodes"].values()
+    heap = sum(node["jvm"]["mem"]["heap_used_in_bytes"] for node in nodes)
+    store = es.indices.stats(index="bill", metric="store")["_all"]["total"]["store"]
+    return heap / 2**20, store["size_in_bytes"] / 2**20
+
+def run_queries(backend, keywords, repeat, time_limit):
+    '''
+    Returns list of latencies (seconds) and dict {keyword: number of results}
+    '''
+    app.config['SEARCH_BACKEND'] = backend
+    latencies = []
+    totals = dict()
+    for i in range(repeat):
+        for kw in keywords:
+            started = time.perf_counter()
+            _, total = make_query("bill", [kw], 1, 10, time_limit, returned_val="source",
+                                  source_fields=['title', 'leginfo_id', 'last_action_date'])
+            latencies.append(time.perf_counter() - started)
+            totals[kw] = total
+    return latencies, totals
+
+def print_latencies(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print("{}: {} queries, median {:.2f} ms, p95 {:.2f} ms".format(
+        name, len(latencies), statistics.median(latencies) * 1000, p95 * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of search backends")
+    parser.add_argument("--keywords", nargs="+",
+                        default=["education", "chinese", "public health", "tax",
+                                 "housing", "water quality", "school district"])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--time-limit", default="2y")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(db_file_name, timeout=60)
+    started = time.time()
+    if create_fts_index(conn, 'bills'):
+        print("FTS index created in {:.1f} s".format(time.time() - started))
+    conn.close()
+
+    with app.app_context():
+        rss_before = get_rss_mb()
+        latencies, fts_totals = run_queries("fts", args.keywords, args.repeat, args.time_limit)
+        print_latencies("FTS5", latencies)
+        print("FTS5 index size: {:.1f} MB, process max RSS: {:.1f} MB (+{:.1f} MB by queries)"
+              .format((get_index_size("bill") or 0) / 2**20, get_rss_mb(),
+                      get_rss_mb() - rss_before))
+
+        try:
+            app.elasticsearch.info()
+        except Exception as e:
+            print("Elasticsearch is skipped: ", e)
+        else:
+            latencies, es_totals = run_queries("elasticsearch", args.keywords, args.repeat,
+                                               args.time_limit)
+            print_latencies("Elasticsearch", latencies)
+            heap_mb, store_mb = get_es_memory_mb()
+            print("Elasticsearch heap used: {:.1f} MB, index size: {:.1f} MB".format(
+                heap_mb, store_mb))
+            for kw in args.keywords:
+                if fts_totals[kw] != es_totals[kw]:
+                    print("Different number of results for {!r}: FTS5 {}, elasticsearch {}"
+                          .format(kw, fts_totals[kw], es_totals[kw]))
@@ -0,0 +1,112 @@
+'''
+Micro-benchmark of bill status page extraction: single-pass lxml extractor
+vs previous BeautifulSoup searches. Checks that both give the same bill info
+
+Usage: python benchmarks/bench_status_extract.py pages [--repeat 20]
+(pages are saved with benchmarks/save_pages.py)
+'''
+import argparse
+import datetime
+import glob
+import os
+import sys
+import timeit
+
+import bs4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing.extract import (bill_attrs, bill_code_regex, session_regex,
+                             extract_bill_status_fields, get_bill_attrs,
+                             get_bill_subject_code_session, get_bill_last_action)
+
+
+# previous implementation (without error logging)
+
+def custom_tag_search(tag, span_id):
+    if tag.has_key("id"):
+        return (tag.name == "span" or  tag.name == "div") and tag["id"]==span_id
+    return False
+
+def legacy_bill_info(page_text):
+    bill_info = dict()
+    soup = bs4.BeautifulSoup(page_text, 'html.parser')
+    if soup.find("div", id="bill_status") is None:
+        return None
+    try:
+        last_action_date = soup.find(lambda tag: custom_tag_search(tag, "lastAction"))
+        if last_action_date is not None:
+            last_action_date = last_action_date.text.strip()
+            last_action_date = datetime.datetime.strptime(last_action_date, "%m/%d/%y").strftime("%Y-%m-%d")
+        bill_info["last_action_date"] = last_action_date
+    except:
+        bill_info["last_action_date"] = None
+    last_action_name = soup.find("label", attrs={"for": "lastAction"})
+    if last_action_name is not None:
+        bill_info["last_action_name"] = last_action_name.text.replace(":", "")
+    else:
+        bill_info["last_action_name"] = ""
+    for span_id, db_col_name in bill_attrs.items():
+        param = soup.find(lambda tag: custom_tag_search(tag, span_id))
+        if param is not None:
+            bill_info[db_col_name] = param.text.strip()
+        else:
+            bill_info[db_col_name] = ''
+    try:
+        bill_title = soup.find('div', id='bill_title').text
+        bill_code = bill_code_regex.search(bill_title).group(0)
+        session = session_regex.search(bill_title).group(1)
+        bill_info['code'] = bill_code
+        bill_info['session'] = session
+    except Exception:
+        bill_info['code'] = ""
+        bill_info['session'] = ""
+    try:
+        bill_info['subject'] = bill_title.replace(session, '').replace(bill_code, '').\
+                               replace('()', '').strip()
+    except:
+        bill_info['subject'] = ''
+    return bill_info
+
+def new_bill_info(page_text, leginfo_id=''):
+    bill_info = {"leginfo_id": leginfo_id}
+    status_fields = extract_bill_status_fields(page_text)
+    if not status_fields["bill_status"]:
+        return None
+    get_bill_last_action(bill_info, status_fields)
+    get_bill_attrs(bill_info, status_fields)
+    get_bill_subject_code_session(bill_info, status_fields)
+    del bill_info["leginfo_id"]
+    return bill_info
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark status page extraction")
+    parser.add_argument("pages_dir")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = dict()
+    for file_name in sorted(glob.glob(os.path.join(args.pages_dir, "status", "*.html"))):
+        with open(file_name, encoding="utf-8") as f:
+            pages[os.path.basename(file_name)[:-5]] = f.read()
+    if not pages:
+        sys.exit("No pages in " + os.path.join(args.pages_dir, "status"))
+
+    mismatches = 0
+    for leginfo_id, page_text in pages.items():
+        legacy, new = legacy_bill_info(page_text), new_bill_info(page_text, leginfo_id)
+        if legacy != new:
+            mismatches += 1
+            print("Mismatch " + leginfo_id + ":\n  bs4:  " + str(legacy) +
+                  "\n  lxml: " + str(new))
+
+    legacy_time = timeit.timeit(lambda: [legacy_bill_info(p) for p in pages.values()],
+                                number=args.repeat)
+    new_time = timeit.timeit(lambda: [new_bill_info(p) for p in pages.values()],
+                             number=args.repeat)
+    parsed = len(pages) * args.repeat
+    print("Pages: {}, mismatches: {}".format(len(pages), mismatches))
+    print("bs4:  {:.2f} ms/page".format(legacy_time / parsed * 1000))
+    print("lxml: {:.2f} ms/page".format(new_time / parsed * 1000))
+    print("Speedup: {:.1f}x".format(legacy_time / new_time))
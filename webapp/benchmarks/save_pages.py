@@ -0,0 +1,35 @@
+'''
+Saves bills' status and text pages from leginfo site for benchmarks:
+<pages_dir>/status/<leginfo_id>.html and <pages_dir>/text/<leginfo_id>.html
+
+Usage: python benchmarks/save_pages.py pages 201920200AB1 201920200SB100 ...
+'''
+import argparse
+import os
+
+import requests
+
+
+status_client_url = 'http://leginfo.legislature.ca.gov/faces/billStatusClient.xhtml'
+text_client_url = 'http://leginfo.legislature.ca.gov/faces/billTextClient.xhtml'
+
+
+def save_page(r_session, url, file_name):
+    page = r_session.get(url)
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write(page.text)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Save bills' pages")
+    parser.add_argument("pages_dir")
+    parser.add_argument("leginfo_ids", nargs="+")
+    args = parser.parse_args()
+
+    s = requests.Session()
+    for client_url, sub_dir in ((status_client_url, "status"),
+                                (text_client_url, "text")):
+        os.makedirs(os.path.join(args.pages_dir, sub_dir), exist_ok=True)
+        for leginfo_id in args.leginfo_ids:
+            print(sub_dir, leginfo_id)
+            save_page(s, client_url + '?bill_id=' + leginfo_id,
+                      os.path.join(args.pages_dir, sub_dir, leginfo_id + ".html"))
@@ -0,0 +1,33 @@
+'''
+Imports keywords from keywords.txt and subscriptions from
+subscribed_emails.txt (lines like email:keyword1,keyword2:time_limit) to db
+again (they're imported by db migration when tables are created).
+Existing subscriptions of the same emails are replaced
+
+Usage: python3 import_subscriptions.py [--keywords keywords.txt] [--subscriptions subscribed_emails.txt]
+'''
+import argparse
+import os
+
+from migrations import migrate_db_file
+from init_app import db_file_name
+import store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import keywords and subscriptions to db")
+    parser.add_argument("--keywords", default=store.KEYWORDS_FILE_NAME)
+    parser.add_argument("--subscriptions", default=store.SUBSCRIPTIONS_FILE_NAME)
+    args = parser.parse_args()
+
+    migrate_db_file(db_file_name)
+    conn = store.connect()
+    try:
+        with conn:
+            if os.path.exists(args.keywords):
+                print("Imported keywords: ", store.import_keywords_file(conn, args.keywords))
+            if os.path.exists(args.subscriptions):
+                print("Imported subscriptions: ",
+                      store.import_subscriptions_file(conn, args.subscriptions))
+    finally:
+        conn.close()
@@ -2,14 +2,52 @@ from elasticsearch import Elasticsearch
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
+db_file_name = 'bills.db'
+
 def create_app():
     app = Flask(__name__)
     app.elasticsearch = Elasticsearch('http://localhost:9200', http_compress=True)
     
     app.secret_key = 'super secret key'
     app.config['SESSION_TYPE'] = 'filesystem'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bills.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_file_name
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # bulk indexing: max documents and bytes in one request, retries of
+    # documents rejected by elasticsearch
+    app.config['ELASTICSEARCH_BULK_CHUNK_SIZE'] = 200
+    app.config['ELASTICSEARCH_BULK_MAX_BYTES'] = 20 * 1024 * 1024
+    app.config['ELASTICSEARCH_BULK_MAX_RETRIES'] = 3
+    # seconds to keep number of bills for listing without keywords
+    app.config['ROWS_COUNT_CACHE_TTL'] = 300
+    # cache of search results: max number of cached pages, their time to
+    # live and how often (seconds) data generation is checked in db
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 64
+    app.config['SEARCH_CACHE_TTL'] = 3600
+    app.config['SEARCH_CACHE_GENERATION_CHECK_INTERVAL'] = 10
+    # search results are rendered from fields of elasticsearch documents
+    # (without bills' text and query to db). Documents indexed by older
+    # versions of app have no last_action_name and house_location, enable it
+    # only after reindex.py
+    app.config['SEARCH_RESULTS_FROM_SOURCE'] = False
+    # "elasticsearch" or "fts" - SQLite FTS5 index in bills.db (see
+    # search_fts.py), doesn't need elasticsearch server. Percolator is used
+    # only with elasticsearch
+    app.config['SEARCH_BACKEND'] = 'elasticsearch'
+    # email notifications: changed bills are matched with subscribed keywords
+    # by percolator index (False - every keyword is searched in changed bills)
+    app.config['NOTIFICATIONS_USE_PERCOLATOR'] = True
+    app.config['PERCOLATOR_INDEX'] = 'subscriptions'
+    # number of bills matched by one percolate request
+    app.config['PERCOLATE_BATCH_SIZE'] = 50
+    # background jobs (see jobs.py): worker threads, attempts of failed job,
+    # seconds before its first retry (doubled for next ones), how often
+    # (seconds) idle workers check db for jobs and seconds after which job of
+    # stopped process is run again
+    app.config['JOBS_WORKERS'] = 2
+    app.config['JOBS_MAX_ATTEMPTS'] = 5
+    app.config['JOBS_RETRY_BACKOFF'] = 30
+    app.config['JOBS_POLL_INTERVAL'] = 5
+    app.config['JOBS_LEASE_TIME'] = 300
     
     return app
 
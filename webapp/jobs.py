@@ -0,0 +1,281 @@
+'''
+Background jobs of web app (sending emails, updating elasticsearch), so
+requests don't wait for them. Jobs are saved in db table jobs (created by
+db migrations) and run by worker threads, failed job is retried after
+backoff * 2^(attempts-1) seconds and is marked as failed after max_attempts
+attempts. Running job has lease, which is extended by process running it,
+so job of stopped process is run again when its lease expires (jobs of
+other live processes aren't taken)
+'''
+import json
+import time
+import sqlite3
+import threading
+import traceback
+import logging
+
+from init_app import app, db_file_name
+
+
+logger = logging.getLogger("jobs")
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+JOB_FIELDS = ['id', 'name', 'state', 'attempts', 'run_at', 'last_error',
+              'created_at', 'updated_at', 'lease_until']
+
+
+class JobQueue(object):
+    '''
+    handlers - {job name: function}, job's function is called with its args
+    as keyword arguments in app context
+    poll_interval - seconds between checks of db by idle worker (jobs
+    enqueued by this process wake workers at once)
+    lease_time - seconds after which running job is taken by other worker
+    if its lease isn't extended (leases are extended every lease_time / 3
+    seconds while job runs)
+    '''
+    def __init__(self, db_file_name, workers, max_attempts, backoff,
+                 poll_interval, app=None, lease_time=300):
+        self.db_file_name = db_file_name
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.app = app
+        self.lease_time = lease_time
+        self.handlers = dict()
+        # jobs run by this process: {id: attempt}, attempt identifies claim
+        self._running = dict()
+        self._running_lock = threading.Lock()
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file_name, timeout=60)
+
+    def register(self, name):
+        # decorator of job's function
+        def decorator(func):
+            self.handlers[name] = func
+            return func
+        return decorator
+
+    def enqueue(self, name, **kwargs):
+        '''
+        Returns id of job
+        '''
+        return self._enqueue(name, kwargs, False)
+
+    def enqueue_once(self, name, **kwargs):
+        '''
+        Like enqueue, but job isn't added if the same job (name and args) is
+        queued or running, e.g. by other process
+        Returns id of new or pending job
+        '''
+        return self._enqueue(name, kwargs, True)
+
+    def _enqueue(self, name, kwargs, once):
+        if name not in self.handlers:
+            raise ValueError("Unknown job: " + name)
+        # args of the same jobs are equal strings
+        args = json.dumps(kwargs, sort_keys=True)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = None
+                if once:
+                    row = conn.execute('''SELECT id FROM jobs WHERE name=? AND args=?
+                                          AND state IN (?, ?) LIMIT 1''',
+                                       (name, args, JOB_QUEUED, JOB_RUNNING)).fetchone()
+                if row is None:
+                    cursor = conn.execute('''INSERT INTO jobs (name, args, state, attempts,
+                                             run_at, created_at, updated_at)
+                                             VALUES (?, ?, ?, 0, ?, ?, ?)''',
+                                          (name, args, JOB_QUEUED, now, now, now))
+                    job_id = cursor.lastrowid
+                else:
+                    job_id = row[0]
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
+        self._wakeup.set()
+        return job_id
+
+    def get_job(self, job_id):
+        '''
+        Returns dict with fields of job (without args) or None
+        '''
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT {} FROM jobs WHERE id=?'.format(', '.join(JOB_FIELDS)),
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return dict(zip(JOB_FIELDS, row))
+
+    def _claim(self):
+        '''
+        Takes the oldest due job or running job with expired lease
+        Returns (id, name, args, attempt) or None
+        '''
+        # idle worker only reads db, write lock is taken when there is a job
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                row = conn.execute('''SELECT id, name, args, attempts, state FROM jobs
+                                      WHERE (state=? AND run_at <= ?)
+                                      OR (state=? AND lease_until < ?)
+                                      ORDER BY run_at, id LIMIT 1''',
+                                   (JOB_QUEUED, now, JOB_RUNNING, now)).fetchone()
+                if row is None:
+                    return None
+                job_id, name, args, attempts, state = row
+                with conn:
+                    if state == JOB_RUNNING and attempts >= self.max_attempts:
+                        # process running the last attempt stopped
+                        conn.execute('''UPDATE jobs SET state=?, last_error=?, updated_at=?
+                                        WHERE id=? AND attempts=? AND state=?''',
+                                     (JOB_FAILED, "Lease expired", now, job_id, attempts,
+                                      JOB_RUNNING))
+                        continue
+                    # job isn't claimed if it was changed by other worker
+                    cursor = conn.execute('''UPDATE jobs SET state=?, attempts=attempts+1,
+                                             lease_until=?, updated_at=?
+                                             WHERE id=? AND attempts=? AND state=?''',
+                                          (JOB_RUNNING, now + self.lease_time, now,
+                                           job_id, attempts, state))
+                if cursor.rowcount == 1:
+                    break
+        finally:
+            conn.close()
+        return job_id, name, json.loads(args), attempts + 1
+
+    def _finish(self, job_id, attempt, error=None):
+        now = time.time()
+        if error is None:
+            state, run_at = JOB_DONE, now
+        elif attempt >= self.max_attempts:
+            state, run_at = JOB_FAILED, now
+        else:
+            state, run_at = JOB_QUEUED, now + self.backoff * 2 ** (attempt - 1)
+        conn = self._connect()
+        try:
+            with conn:
+                # job isn't changed if it was taken by other worker after
+                # lease expired
+                conn.execute('''UPDATE jobs SET state=?, run_at=?, last_error=?,
+                                lease_until=NULL, updated_at=?
+                                WHERE id=? AND attempts=? AND state=?''',
+                             (state, run_at, error, now, job_id, attempt, JOB_RUNNING))
+        finally:
+            conn.close()
+
+    def extend_leases(self):
+        # leases of jobs run by this process
+        with self._running_lock:
+            running = list(self._running.items())
+        if not running:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('''UPDATE jobs SET lease_until=?, updated_at=?
+                                    WHERE id=? AND attempts=? AND state=?''',
+                                 [(now + self.lease_time, now, job_id, attempt, JOB_RUNNING)
+                                  for job_id, attempt in running])
+        finally:
+            conn.close()
+
+    def run_job(self, job_id, name, args, attempt):
+        with self._running_lock:
+            self._running[job_id] = attempt
+        try:
+            handler = self.handlers[name]
+            if self.app is not None:
+                with self.app.app_context():
+                    handler(**args)
+            else:
+                handler(**args)
+        except:
+            error = traceback.format_exc()
+            logger.error("Job {} ({}), attempt {}: {}".format(job_id, name, attempt, error))
+            self._finish(job_id, attempt, error)
+        else:
+            self._finish(job_id, attempt)
+        finally:
+            with self._running_lock:
+                self._running.pop(job_id, None)
+
+    def run_pending(self):
+        '''
+        Runs due jobs one by one until there are no more
+        Returns number of run jobs
+        '''
+        run_cnt = 0
+        while not self._stopped.is_set():
+            job = self._claim()
+            if job is None:
+                break
+            self.run_job(*job)
+            run_cnt += 1
+        return run_cnt
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_pending()
+            except:
+                logger.error(traceback.format_exc())
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _extend_leases_periodically(self):
+        while not self._stopped.wait(self.lease_time / 3):
+            try:
+                self.extend_leases()
+            except:
+                logger.error(traceback.format_exc())
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stopped.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name="jobs-{}".format(i),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._extend_leases_periodically,
+                                      name="jobs-leases", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._start_lock:
+            self._stopped.set()
+            self._wakeup.set()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+
+job_queue = JobQueue(db_file_name, app.config['JOBS_WORKERS'],
+                     app.config['JOBS_MAX_ATTEMPTS'], app.config['JOBS_RETRY_BACKOFF'],
+                     app.config['JOBS_POLL_INTERVAL'], app,
+                     app.config['JOBS_LEASE_TIME'])
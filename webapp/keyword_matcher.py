@@ -0,0 +1,196 @@
+'''
+Keywords of monitoring page are found in bills when they're written by
+crawler, matches are saved to table bill_keyword_matches (created by db
+migrations), so monitoring page and numbers of bills of keywords are got
+by SQL join instead of full-text search.
+Bill matches keyword if all words of keyword are in its title, subject or
+text (the same as search queries). Words of all keywords are found by one
+pass through bill with Aho-Corasick automaton
+'''
+import re
+from collections import deque
+
+
+word_regex = re.compile(r'\w+')
+
+# columns of bills scanned for keywords
+MATCHED_FIELDS = ['title', 'subject', 'text']
+
+
+def get_words(keyword):
+    return word_regex.findall(keyword.lower())
+
+def lower(value):
+    # sqlite lower() changes only ASCII letters, texts are lowercased by
+    # python on both ways of matching
+    return value.lower() if value is not None else None
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordMatcher(object):
+    '''
+    Aho-Corasick automaton of words of keywords: states are nodes of trie
+    of words, fail links lead to the longest suffix which is in trie
+    '''
+    def __init__(self, keywords):
+        self.keywords = [kw for kw in keywords if get_words(kw)]
+        self.keyword_words = {kw: set(get_words(kw)) for kw in self.keywords}
+        # transitions, fail links and words ending in state
+        self._goto = [dict()]
+        self._fail = [0]
+        self._out = [[]]
+        for words in self.keyword_words.values():
+            for word in words:
+                self._add_word(word)
+        self._build_fail_links()
+
+    def _add_word(self, word):
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._out.append([])
+            state = next_state
+        if word not in self._out[state]:
+            self._out[state].append(word)
+
+    def _build_fail_links(self):
+        # breadth first, fail link of state is known when its children are
+        # processed
+        states = deque(self._goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, next_state in self._goto[state].items():
+                states.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._out[next_state] = self._out[next_state] + \
+                                        self._out[self._fail[next_state]]
+
+    def find_words(self, text):
+        '''
+        Returns set of words of keywords which are in text as whole words
+        '''
+        found = set()
+        if not text or len(self._goto) == 1:
+            return found
+        text = text.lower()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        text_len = len(text)
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                after_word = i + 1 < text_len and is_word_char(text[i + 1])
+                if after_word:
+                    continue
+                for word in out[state]:
+                    start = i - len(word) + 1
+                    if start == 0 or not is_word_char(text[start - 1]):
+                        found.add(word)
+        return found
+
+    def match(self, *texts):
+        '''
+        Returns set of keywords matching texts (e.g. title, subject and text
+        of bill)
+        '''
+        found = set()
+        for text in texts:
+            found |= self.find_words(text)
+        return {kw for kw, words in self.keyword_words.items() if words <= found}
+
+
+def save_bills_matches(conn, matcher, bills):
+    '''
+    Replaces matches of bills with keywords of matcher, transaction is
+    committed by caller
+    bills - list of (id, title, subject, text)
+    Returns number of saved matches
+    '''
+    if not matcher.keywords or not bills:
+        return 0
+    placeholders = ', '.join('?' * len(matcher.keywords))
+    conn.executemany('DELETE FROM bill_keyword_matches WHERE bill_id=? '
+                     'AND keyword IN ({})'.format(placeholders),
+                     [(bill[0],) + tuple(matcher.keywords) for bill in bills])
+    matches = [(kw, bill[0]) for bill in bills for kw in matcher.match(*bill[1:])]
+    conn.executemany('INSERT OR IGNORE INTO bill_keyword_matches (keyword, bill_id) '
+                     'VALUES (?, ?)', matches)
+    return len(matches)
+
+def match_bills_by_leginfo_ids(conn, matcher, table_name, leginfo_ids, step=500):
+    '''
+    Scans bills in transaction of caller, after they were written
+    '''
+    # connection of crawler returns rows as dicts
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    bills = []
+    for i in range(0, len(leginfo_ids), step):
+        ids_part = leginfo_ids[i:i+step]
+        q = 'SELECT id, {} FROM {} WHERE leginfo_id IN ({})'.format(
+            ', '.join(MATCHED_FIELDS), table_name, ', '.join('?' * len(ids_part)))
+        bills.extend(cursor.execute(q, ids_part).fetchall())
+    return save_bills_matches(conn, matcher, bills)
+
+def get_keywords(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return [row[0] for row in cursor.execute('SELECT keyword FROM keywords')]
+
+def get_current_matcher(conn, matcher=None):
+    '''
+    Returns matcher of keywords in db, matcher is reused if they didn't
+    change (keywords are added and deleted while bills are written)
+    '''
+    keywords = [kw for kw in get_keywords(conn) if get_words(kw)]
+    if matcher is not None and set(matcher.keywords) == set(keywords):
+        return matcher
+    return KeywordMatcher(keywords)
+
+def scan_keyword(conn, keyword, table_name, batch_size=500):
+    '''
+    Finds keyword in all bills (e.g. when keyword was added). Only bills
+    containing all words of keyword as substrings are read by python
+    Returns number of matching bills
+    '''
+    conn.create_function("py_lower", 1, lower)
+    matcher = KeywordMatcher([keyword])
+    words = get_words(keyword)
+    matched_cnt = 0
+    with conn:
+        conn.execute('DELETE FROM bill_keyword_matches WHERE keyword=?', (keyword,))
+    if words:
+        # concatenation with || is null if any field is null
+        fields = " || ' ' || ".join("py_lower(coalesce({}, ''))".format(field)
+                                    for field in MATCHED_FIELDS)
+        conditions = ' AND '.join('instr({}, ?) > 0'.format(fields) for word in words)
+        q = 'SELECT id, {} FROM {} WHERE id > ? AND {} ORDER BY id LIMIT ?'.format(
+            ', '.join(MATCHED_FIELDS), table_name, conditions)
+        last_id = -1
+        while True:
+            bills = [tuple(row) for row in
+                     conn.execute(q, [last_id] + words + [batch_size]).fetchall()]
+            if not bills:
+                break
+            with conn:
+                matched_cnt += save_bills_matches(conn, matcher, bills)
+            last_id = bills[-1][0]
+    with conn:
+        conn.execute('UPDATE keywords SET matched=1 WHERE keyword=?', (keyword,))
+    return matched_cnt
@@ -0,0 +1,31 @@
+import argparse
+import sqlite3
+
+from migrations import (MIGRATIONS, migrate, analyze, get_db_version,
+                        get_latest_version)
+from parsing.parsing_options import db_file_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upgrade db schema")
+    parser.add_argument("--db", default=db_file_name, help="db file")
+    parser.add_argument("--status", action="store_true",
+                        help="only show db version and pending migrations")
+    parser.add_argument("--analyze", action="store_true",
+                        help="update query planner statistics")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, timeout=60)
+    version = get_db_version(conn)
+    print("DB version: {}, latest version: {}".format(version, get_latest_version()))
+    if args.status:
+        for migration_version, description, _ in MIGRATIONS:
+            if migration_version > version:
+                print("Pending migration {}: {}".format(migration_version, description))
+    else:
+        applied_versions = migrate(conn)
+        if not applied_versions:
+            print("DB is up to date")
+        if args.analyze and not applied_versions:
+            analyze(conn)
+    conn.close()
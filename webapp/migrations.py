@@ -0,0 +1,234 @@
+'''
+Versioned migrations of db schema. Version of db is kept in
+PRAGMA user_version, migrations with greater versions are applied in order
+when the app or parser starts (or by migrate_db.py), so existing db files
+are upgraded in place
+'''
+import os
+import sqlite3
+
+from parsing.parsing_options import table_name, sessions_table_name
+import store
+
+
+def create_bills_table(conn):
+    # table was created by script before migrations, new db gets the same
+    conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    code VARCHAR(25),
+                    subject TEXT,
+                    title TEXT,
+                    house_location VARCHAR(10),
+                    authors TEXT,
+                    session VARCHAR(25),
+                    last_action_date VARCHAR(25),
+                    last_action_name VARCHAR(25),
+                    date_published VARCHAR(25),
+                    leginfo_id INT(25),
+                    text TEXT)'''.format(table_name))
+
+def create_leginfo_id_index(conn):
+    # older copies of duplicated bills are deleted, unique index is needed
+    # for upserting bills
+    q = '''DELETE FROM {0} WHERE id NOT IN
+           (SELECT MAX(id) FROM {0} GROUP BY leginfo_id)'''.format(table_name)
+    deleted_cnt = conn.execute(q).rowcount
+    if deleted_cnt:
+        print("Deleted duplicated bills: ", deleted_cnt)
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_{0}_leginfo_id '
+                 'ON {0} (leginfo_id)'.format(table_name))
+
+def create_bills_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_{0}_last_action_date '
+                 'ON {0} (last_action_date)'.format(table_name))
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_{0}_session '
+                 'ON {0} (session)'.format(table_name))
+
+def create_sessions_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                    session VARCHAR(25) PRIMARY KEY,
+                    state VARCHAR(10) NOT NULL,
+                    updated_at VARCHAR(25))'''.format(sessions_table_name))
+
+def add_bills_text_hash(conn):
+    # hash of text page, text isn't parsed and rewritten if it didn't change
+    conn.execute('ALTER TABLE {} ADD COLUMN text_hash VARCHAR(40)'.format(table_name))
+
+def create_app_state_table(conn):
+    # data_generation is increased after every run of parser, caches of
+    # web app are cleared when it changes
+    conn.execute('''CREATE TABLE IF NOT EXISTS app_state (
+                    key VARCHAR(50) PRIMARY KEY,
+                    value INTEGER NOT NULL)''')
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) "
+                 "VALUES ('data_generation', 0)")
+
+def create_email_queue_table(conn):
+    # emails which weren't sent, retried by mailer
+    conn.execute('''CREATE TABLE IF NOT EXISTS email_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    from_addr TEXT NOT NULL,
+                    to_addr TEXT NOT NULL,
+                    msg TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    state VARCHAR(10) NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_email_queue_state_next_attempt_at '
+                 'ON email_queue (state, next_attempt_at)')
+
+def create_subscriptions_tables(conn):
+    # keywords of monitoring page and email subscriptions, they were in
+    # keywords.txt and subscribed_emails.txt and are imported from them in
+    # the same transaction
+    conn.execute('''CREATE TABLE IF NOT EXISTS keywords (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    keyword TEXT NOT NULL UNIQUE)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email TEXT NOT NULL UNIQUE,
+                    time_limit VARCHAR(10) NOT NULL,
+                    created_at VARCHAR(25))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS subscription_keywords (
+                    subscription_id INTEGER NOT NULL
+                        REFERENCES subscriptions (id) ON DELETE CASCADE,
+                    keyword TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    PRIMARY KEY (subscription_id, keyword))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_subscription_keywords_keyword '
+                 'ON subscription_keywords (keyword)')
+    if os.path.exists(store.KEYWORDS_FILE_NAME):
+        print("Imported keywords: ", store.import_keywords_file(conn, store.KEYWORDS_FILE_NAME))
+    if os.path.exists(store.SUBSCRIPTIONS_FILE_NAME):
+        print("Imported subscriptions: ",
+              store.import_subscriptions_file(conn, store.SUBSCRIPTIONS_FILE_NAME))
+
+def create_change_journal_tables(conn):
+    # runs of crawler and changes of bills made by them, used by notifications
+    # instead of changed_bills.txt (see parsing/change_journal.py)
+    conn.execute('''CREATE TABLE IF NOT EXISTS crawl_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started_at VARCHAR(25) NOT NULL,
+                    finished_at VARCHAR(25))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bill_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id INTEGER NOT NULL REFERENCES crawl_runs (id),
+                    leginfo_id VARCHAR(30) NOT NULL,
+                    change_type VARCHAR(10) NOT NULL,
+                    prev_last_action_name TEXT,
+                    created_at VARCHAR(25) NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_bill_changes_run_id '
+                 'ON bill_changes (run_id)')
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) "
+                 "VALUES ('delivered_run_id', 0)")
+
+def create_jobs_table(conn):
+    # background jobs of web app (see jobs.py)
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name VARCHAR(50) NOT NULL,
+                    args TEXT NOT NULL,
+                    state VARCHAR(10) NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    run_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_state_run_at '
+                 'ON jobs (state, run_at)')
+
+def create_keyword_matches_table(conn):
+    # keywords of monitoring page found in bills by crawler (see
+    # keyword_matcher.py), keywords.matched - whether all bills were scanned
+    # for keyword
+    conn.execute('''CREATE TABLE IF NOT EXISTS bill_keyword_matches (
+                    keyword TEXT NOT NULL,
+                    bill_id INTEGER NOT NULL,
+                    PRIMARY KEY (keyword, bill_id)) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_bill_keyword_matches_bill_id '
+                 'ON bill_keyword_matches (bill_id)')
+    conn.execute('ALTER TABLE keywords ADD COLUMN matched INTEGER NOT NULL DEFAULT 0')
+
+def add_jobs_lease(conn):
+    # running job is taken by other worker when its lease expires, jobs left
+    # running by older version are taken at once
+    conn.execute('ALTER TABLE jobs ADD COLUMN lease_until REAL')
+    conn.execute("UPDATE jobs SET lease_until=0 WHERE state='running'")
+
+
+# (version, description, function changing schema)
+MIGRATIONS = [
+    (1, "bills table", create_bills_table),
+    (2, "unique index on bills.leginfo_id", create_leginfo_id_index),
+    (3, "indexes on bills.last_action_date and bills.session", create_bills_indexes),
+    (4, "sessions table", create_sessions_table),
+    (5, "bills.text_hash column", add_bills_text_hash),
+    (6, "app_state table", create_app_state_table),
+    (7, "email_queue table", create_email_queue_table),
+    (8, "keywords and subscriptions tables", create_subscriptions_tables),
+    (9, "crawl_runs and bill_changes tables", create_change_journal_tables),
+    (10, "jobs table", create_jobs_table),
+    (11, "bill_keyword_matches table", create_keyword_matches_table),
+    (12, "jobs.lease_until column", add_jobs_lease),
+]
+
+
+def get_db_version(conn):
+    # connection can have other row factory (e.g. in parser)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+def get_latest_version():
+    return MIGRATIONS[-1][0]
+
+def apply_migration(conn, version, migration):
+    '''
+    Applies migration and sets db version in one transaction.
+    Returns False if migration was applied before (e.g. by other process)
+    '''
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        applied = get_db_version(conn) < version
+        if applied:
+            migration(conn)
+            conn.execute("PRAGMA user_version = {}".format(version))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return applied
+
+def analyze(conn):
+    # statistics for query planner
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def optimize(conn):
+    # updates statistics of tables which changed much since last analyze
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+
+def migrate(conn):
+    '''
+    Applies migrations newer than db version
+    Returns list of applied versions
+    '''
+    applied_versions = []
+    for version, description, migration in MIGRATIONS:
+        if get_db_version(conn) >= version:
+            continue
+        if apply_migration(conn, version, migration):
+            print("DB migration {}: {}".format(version, description))
+            applied_versions.append(version)
+    if applied_versions:
+        analyze(conn)
+    return applied_versions
+
+def migrate_db_file(db_file_name):
+    conn = sqlite3.connect(db_file_name, timeout=60)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
@@ -1,20 +1,229 @@
-from search import add_to_index, remove_from_index, make_query
-from init_app import db
+import time
+import sqlite3
 import traceback
 
+from sqlalchemy import text, or_, and_, event, inspect, bindparam
+from sqlalchemy.orm import defer
+
+from result_cache import ResultCache
+from search_params import encode_cursor, decode_cursor
+from search import (make_query, make_cursor_query, bulk_index, bulk_update,
+                    bulk_remove, create_index,
+                    bulk_load_mode, is_index_current, get_versioned_index,
+                    create_versioned_index, switch_alias)
+from init_app import app, db, db_file_name
+from migrations import migrate_db_file
+import store
+from jobs import job_queue
+from search_fts import create_fts_index, drop_fts_index, rebuild_fts_index, get_min_date
+
+# db schema is upgraded before reflecting it
+migrate_db_file(db_file_name)
+_conn = sqlite3.connect(db_file_name, timeout=60)
+try:
+    if app.config['SEARCH_BACKEND'] == 'fts':
+        # index is created once, then it's updated by triggers
+        if create_fts_index(_conn, 'bills'):
+            print("Created FTS index")
+    elif drop_fts_index(_conn, 'bills'):
+        # triggers of unused index aren't run by writes of crawler
+        print("Removed FTS index")
+finally:
+    _conn.close()
 db.Model.metadata.reflect(db.engine)
 
+# cached number of rows of tables: {table name: (count, time of counting)}
+_rows_count_cache = dict()
+
+def get_data_generation():
+    q = text("SELECT value FROM app_state WHERE key='data_generation'")
+    return db.session.execute(q).scalar()
+
+search_results_cache = ResultCache(app.config['SEARCH_CACHE_MAX_ENTRIES'],
+                                   app.config['SEARCH_CACHE_TTL'],
+                                   get_data_generation,
+                                   app.config['SEARCH_CACHE_GENERATION_CHECK_INTERVAL'])
+
 class SearchableMixin(object):
+    @classmethod
+    def get_rows_count(cls):
+        # COUNT(*) scans the whole table, so it's cached for
+        # ROWS_COUNT_CACHE_TTL seconds
+        cached = _rows_count_cache.get(cls.__tablename__)
+        if cached is not None and time.time() - cached[1] < app.config['ROWS_COUNT_CACHE_TTL']:
+            return cached[0]
+        count = cls.query.count()
+        _rows_count_cache[cls.__tablename__] = (count, time.time())
+        return count
+
+    @classmethod
+    def are_keywords_matched(cls, query):
+        # whether bills were scanned for all keywords of query by crawler
+        # (see keyword_matcher.py)
+        keywords = set(query)
+        q = text('SELECT COUNT(*) FROM keywords WHERE matched=1 AND keyword IN :keywords') \
+            .bindparams(bindparam('keywords', expanding=True))
+        return db.session.execute(q, {"keywords": list(keywords)}).scalar() == len(keywords)
+
+    @classmethod
+    def get_matched_query(cls, query, time_limit):
+        '''
+        Query of bills matching keywords of query by table of matches, with
+        the same filter and order as search queries
+        '''
+        matches = db.Model.metadata.tables['bill_keyword_matches']
+        matched_ids = db.session.query(matches.c.bill_id).filter(matches.c.keyword.in_(query))
+        return cls.query.options(defer(cls.text)) \
+                        .filter(cls.id.in_(matched_ids),
+                                cls.last_action_date >= get_min_date(time_limit),
+                                cls.last_action_date.op('GLOB')('[0-9][0-9][0-9][0-9]-*'))
+
+    @classmethod
+    def get_keywords_counts(cls, time_limit="1y"):
+        '''
+        Returns dict {keyword: number of matching bills in time limit} of
+        keywords which bills were scanned for
+        '''
+        q = text('''SELECT m.keyword, COUNT(*) FROM bill_keyword_matches m
+                    JOIN {} b ON b.id = m.bill_id
+                    WHERE b.last_action_date >= :min_date
+                    AND b.last_action_date GLOB '[0-9][0-9][0-9][0-9]-*'
+                    GROUP BY m.keyword'''.format(cls.__table__.name))
+        counts = dict(db.session.execute(q, {"min_date": get_min_date(time_limit)}).fetchall())
+        matched = text('SELECT keyword FROM keywords WHERE matched=1')
+        return {row[0]: counts.get(row[0], 0) for row in db.session.execute(matched)}
+
     @classmethod
     def get_monitoring_results(cls, query, page, per_page, time_limit="1y"):
+        # text of bills isn't shown in results (it's loaded by page when
+        # it's opened), so it's not read from db
         if not query:
-            filtered = cls.query.order_by(Bill.last_action_date.desc()).all()
-            filtered = filtered[(page - 1)*per_page:(page - 1)*per_page+per_page]
-            total = len(filtered)
+            # only one page of rows is read from db
+            filtered = cls.query.options(defer(cls.text)) \
+                                .order_by(cls.last_action_date.desc(), cls.id.desc()) \
+                                .limit(per_page).offset((page - 1)*per_page).all()
+            total = cls.get_rows_count()
+        elif cls.are_keywords_matched(query):
+            q = cls.get_matched_query(query, time_limit)
+            filtered = q.order_by(cls.last_action_date.desc(), cls.leginfo_id.asc()) \
+                        .limit(per_page).offset((page - 1)*per_page).all()
+            total = q.count()
+        elif app.config['SEARCH_RESULTS_FROM_SOURCE']:
+            # bills (dicts of fields shown in results) are got from
+            # elasticsearch, without query to db
+            filtered, total = make_query(cls.__tablename__, query, page, per_page,
+                                         time_limit, returned_val="source",
+                                         source_fields=cls.__display_fields__)
         else:
             ids, total = make_query(cls.__tablename__, query, page, per_page, time_limit)
-            filtered = cls.query.filter(cls.id.in_(ids)).order_by(Bill.last_action_date.desc()).all()
+            filtered = cls.query.options(defer(cls.text)).filter(cls.id.in_(ids)) \
+                                .order_by(Bill.last_action_date.desc()).all()
         return filtered, total
+
+    @classmethod
+    def get_monitoring_results_after(cls, query, cursor, per_page, time_limit="1y"):
+        '''
+        Like get_monitoring_results, but page is got after cursor (keyset
+        pagination), so deep pages are as fast as the first one
+        cursor - None for the first page
+        Returns bills, total number of found bills and cursor of next page
+        (None if it's the last page)
+        Raises ValueError if cursor is invalid
+        '''
+        if not query:
+            # cursor is (last_action_date, id) of the last bill of previous page
+            q = cls.query.options(defer(cls.text))
+            if cursor:
+                date, id = decode_cursor(cursor, [(str, type(None)), int])
+                if date is None:
+                    q = q.filter(cls.last_action_date.is_(None), cls.id < id)
+                else:
+                    q = q.filter(or_(cls.last_action_date < date,
+                                     and_(cls.last_action_date == date, cls.id < id),
+                                     cls.last_action_date.is_(None)))
+            filtered = q.order_by(cls.last_action_date.desc(), cls.id.desc()) \
+                        .limit(per_page).all()
+            total = cls.get_rows_count()
+            next_cursor = None
+            if len(filtered) == per_page:
+                next_cursor = encode_cursor([filtered[-1].last_action_date, filtered[-1].id])
+        elif cls.are_keywords_matched(query):
+            # cursor is (last_action_date, leginfo_id) of the last bill
+            q = cls.get_matched_query(query, time_limit)
+            total = q.count()
+            if cursor:
+                date, leginfo_id = decode_cursor(cursor, [str, str])
+                q = q.filter(or_(cls.last_action_date < date,
+                                 and_(cls.last_action_date == date, cls.leginfo_id > leginfo_id)))
+            filtered = q.order_by(cls.last_action_date.desc(), cls.leginfo_id.asc()) \
+                        .limit(per_page).all()
+            next_cursor = None
+            if len(filtered) == per_page:
+                next_cursor = encode_cursor([filtered[-1].last_action_date,
+                                             filtered[-1].leginfo_id])
+        elif app.config['SEARCH_RESULTS_FROM_SOURCE']:
+            filtered, total, next_cursor = make_cursor_query(cls.__tablename__, query, per_page,
+                                                             time_limit, cursor,
+                                                             returned_val="source",
+                                                             source_fields=cls.__display_fields__)
+        else:
+            ids, total, next_cursor = make_cursor_query(cls.__tablename__, query, per_page,
+                                                        time_limit, cursor)
+            filtered = cls.query.options(defer(cls.text)).filter(cls.id.in_(ids)).all()
+            # the same order as in elasticsearch
+            filtered.sort(key=lambda obj: ids.index(obj.id))
+        return filtered, total, next_cursor
+
+    @classmethod
+    def to_display_dicts(cls, bills):
+        columns = ['id'] + cls.__display_fields__
+        return [obj if isinstance(obj, dict) else
+                {column: getattr(obj, column) for column in columns}
+                for obj in bills]
+
+    @classmethod
+    def normalize_query(cls, query):
+        # keywords are the same in any case and order, query is searched and
+        # cached in this form
+        return sorted(set(kw.strip().lower() for kw in query if kw.strip()))
+
+    @classmethod
+    def get_search_cache_key(cls, query, *params):
+        # query - normalized (see normalize_query)
+        return (cls.__tablename__, tuple(query)) + params
+
+    @classmethod
+    def get_cached_monitoring_results(cls, query, page, per_page, time_limit="1y"):
+        '''
+        get_monitoring_results with results cached until next run of parser
+        Returns list of bills as dicts and total number of found bills
+        '''
+        query = cls.normalize_query(query)
+        key = cls.get_search_cache_key(query, page, per_page, time_limit)
+        cached, generation = search_results_cache.lookup(key)
+        if cached is not None:
+            return cached
+        filtered, total = cls.get_monitoring_results(query, page, per_page, time_limit)
+        results = (cls.to_display_dicts(filtered), total)
+        search_results_cache.put(key, results, generation)
+        return results
+
+    @classmethod
+    def get_cached_monitoring_results_after(cls, query, cursor, per_page, time_limit="1y"):
+        '''
+        get_monitoring_results_after with results cached until next run of
+        parser. Returns list of bills as dicts, total and cursor of next page
+        '''
+        query = cls.normalize_query(query)
+        key = cls.get_search_cache_key(query, "cursor", cursor, per_page, time_limit)
+        cached, generation = search_results_cache.lookup(key)
+        if cached is not None:
+            return cached
+        filtered, total, next_cursor = cls.get_monitoring_results_after(query, cursor,
+                                                                        per_page, time_limit)
+        results = (cls.to_display_dicts(filtered), total, next_cursor)
+        search_results_cache.put(key, results, generation)
+        return results
     
     @classmethod
     def before_commit(cls, session):
@@ -26,32 +235,60 @@ class SearchableMixin(object):
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+        # elasticsearch is updated by background jobs, ids are got from
+        # identity of objects (sql can't be run after commit)
+        changes = getattr(session, '_changes', None)
+        if not changes:
+            return
+        session._changes = None
+        indexed = dict()
+        removed = dict()
+        for obj in changes['add'] + changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                indexed.setdefault(obj.__class__.__name__, []).append(inspect(obj).identity[0])
+        for obj in changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                removed.setdefault(obj.__tablename__, []).append(inspect(obj).identity[0])
+        try:
+            for model, ids in indexed.items():
+                job_queue.enqueue("index_models", model=model, ids=ids)
+            for index, ids in removed.items():
+                job_queue.enqueue("remove_from_index", index=index, ids=ids)
+        except:
+            traceback.print_exc()
 
     @classmethod
     def reindex(cls):
-        for obj in cls.query.all():
-            try:
-                print(obj.id)
-                add_to_index(cls.__tablename__, obj)
-            except:
-                traceback.print_exc()
-                continue
+        if app.config['SEARCH_BACKEND'] == 'fts':
+            rebuild_fts_index(cls.__tablename__)
+            print("Reindex: FTS index rebuilt")
+            return None
+        # bills are loaded to index with current mapping (see
+        # search.INDEX_VERSION). Index of older version is searched until
+        # the new one is loaded, then alias is switched to the new one
+        index = cls.__tablename__
+        versioned = get_versioned_index(index)
+        in_place = is_index_current(index)
+        if not in_place:
+            create_versioned_index(index)
+        # rows are read from db by parts while they are indexed
+        with bulk_load_mode(versioned):
+            report = bulk_index(versioned, cls.query.yield_per(100))
+        if not in_place:
+            switch_alias(index, versioned)
+        print("Reindex: ", report)
+        return report
     
 
 class Bill(SearchableMixin, db.Model):
     __searchable__ = ['title', 'subject', 'session', 'text', 'code', 
                       'authors', 'leginfo_id', 'last_action_date',
-                      'date_published']
+                      'date_published', 'last_action_name', 'house_location']
+    # fields shown in search results, got from elasticsearch if
+    # SEARCH_RESULTS_FROM_SOURCE
+    __display_fields__ = ['code', 'title', 'subject', 'last_action_date',
+                          'last_action_name', 'leginfo_id', 'date_published',
+                          'house_location', 'authors', 'session']
     __table__ = db.Model.metadata.tables['bills']
     
 @classmethod
@@ -62,22 +299,103 @@ def reindex_by_leginfo_ids(cls, leginfo_ids):
     # so we query by parts
     
     # number of ids to query at once
-    step = 20
-    i = 0
-    while i < len(leginfo_ids):
-        ids_part = leginfo_ids[i:i+step]
-        for obj in cls.query.filter(cls.leginfo_id.in_(ids_part)).all():
-            add_to_index(cls.__tablename__, obj)
-        i += step
+    step = 500
+    
+    def get_bills():
+        i = 0
+        while i < len(leginfo_ids):
+            ids_part = leginfo_ids[i:i+step]
+            for obj in cls.query.filter(cls.leginfo_id.in_(ids_part)).all():
+                yield obj
+            i += step
+    
+    # index isn't made by dynamic mapping of the first document
+    create_index(cls.__tablename__)
+    report = bulk_index(cls.__tablename__, get_bills())
+    print("Reindex: ", report)
+    return report
       
+@classmethod
+def update_index_fields(cls, updates):
+    '''
+    Partial update of bills in elasticsearch
+    updates - list of (id, dict of changed fields)
+    Bills which aren't in index yet are indexed fully from db
+    '''
+    create_index(cls.__tablename__)
+    report = bulk_update(cls.__tablename__, updates, cls.__searchable__)
+    print("Partial update: ", report)
+    missing_ids = report["missing"]
+    if missing_ids:
+        step = 500
+        bills = (obj for i in range(0, len(missing_ids), step)
+                 for obj in cls.query.filter(cls.id.in_(missing_ids[i:i+step])).all())
+        bulk_index(cls.__tablename__, bills)
+    return report
+
 @classmethod
 def find_by_leginfo_id(cls, id):
     return cls.query.filter(cls.leginfo_id == id).first()
+
+@classmethod
+def find_by_leginfo_ids(cls, leginfo_ids, step=500, with_text=True):
+    '''
+    Returns dict {leginfo_id: bill} of found bills, queried by parts
+    with_text - if False, text isn't read from db
+    '''
+    leginfo_ids = list(leginfo_ids)
+    found = dict()
+    q = cls.query if with_text else cls.query.options(defer(cls.text))
+    for i in range(0, len(leginfo_ids), step):
+        for obj in q.filter(cls.leginfo_id.in_(leginfo_ids[i:i+step])).all():
+            found[obj.leginfo_id] = obj
+    return found
+
+@classmethod
+def get_texts_by_leginfo_ids(cls, leginfo_ids):
+    # only text column is read (bills aren't loaded to session),
+    # returns dict {leginfo_id: text}
+    rows = db.session.query(cls.leginfo_id, cls.text) \
+                     .filter(cls.leginfo_id.in_(list(leginfo_ids))).all()
+    return {leginfo_id: text or '' for leginfo_id, text in rows}
+
+@classmethod
+def get_text_by_leginfo_id(cls, leginfo_id):
+    # only text column is read, returns None if bill isn't found
+    row = db.session.query(cls.text).filter(cls.leginfo_id == leginfo_id).first()
+    if row is None:
+        return None
+    return row[0] or ''
         
 Bill.reindex_by_leginfo_ids = reindex_by_leginfo_ids
 Bill.find_by_leginfo_id = find_by_leginfo_id
+Bill.find_by_leginfo_ids = find_by_leginfo_ids
+Bill.update_index_fields = update_index_fields
+Bill.get_text_by_leginfo_id = get_text_by_leginfo_id
+Bill.get_texts_by_leginfo_ids = get_texts_by_leginfo_ids
+
+event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+
+# models which are indexed by jobs, by class name
+searchable_models = {'Bill': Bill}
+
+@job_queue.register("index_models")
+def index_models(model, ids, step=500):
+    cls = searchable_models[model]
+    objs = (obj for i in range(0, len(ids), step)
+            for obj in cls.query.filter(cls.id.in_(ids[i:i+step])).all())
+    report = bulk_index(cls.__tablename__, objs)
+    if report["failed"]:
+        # job is retried
+        raise RuntimeError("Indexing failed: " + str(report))
+
+@job_queue.register("remove_from_index")
+def remove_from_index(index, ids):
+    report = bulk_remove(index, ids)
+    if report["failed"]:
+        raise RuntimeError("Removing failed: " + str(report))
 
 def get_all_keywords():
-    with open('keywords.txt', 'r') as f:
-        return [kw.strip() for kw in f.read().splitlines() if kw.strip() != '']
+    return store.get_keywords()
 
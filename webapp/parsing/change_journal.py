@@ -0,0 +1,84 @@
+'''
+Journal of bills' changes (tables crawl_runs and bill_changes, created by db
+migrations). Changes are appended in the same transaction as bills are
+written, notifications are sent about changes of runs after the last
+delivered one (its id is in app_state), so changes of crashed run are sent
+after the next run
+'''
+import datetime
+
+
+CHANGE_ADDED = "added"
+CHANGE_UPDATED = "updated"
+
+
+def _cursor(conn):
+    # connection of crawler returns rows as dicts
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor
+
+def start_crawl_run(conn):
+    '''
+    Returns id of new run
+    '''
+    with conn:
+        cursor = _cursor(conn)
+        cursor.execute('INSERT INTO crawl_runs (started_at) VALUES (?)',
+                       (datetime.datetime.now().isoformat(),))
+        return cursor.lastrowid
+
+def finish_crawl_run(conn, run_id):
+    with conn:
+        conn.execute('UPDATE crawl_runs SET finished_at=? WHERE id=?',
+                     (datetime.datetime.now().isoformat(), run_id))
+
+def add_bill_changes(conn, run_id, changes):
+    '''
+    Appends changes to journal, transaction is committed by caller
+    changes - list of (leginfo id, change type, previous last action name)
+    '''
+    now = datetime.datetime.now().isoformat()
+    conn.executemany('''INSERT INTO bill_changes (run_id, leginfo_id, change_type,
+                        prev_last_action_name, created_at) VALUES (?, ?, ?, ?, ?)''',
+                     [(run_id, leginfo_id, change_type, prev_last_action_name, now)
+                      for leginfo_id, change_type, prev_last_action_name in changes])
+
+def get_delivered_run_id(conn):
+    cursor = _cursor(conn)
+    cursor.execute("SELECT value FROM app_state WHERE key='delivered_run_id'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def get_undelivered_changes(conn):
+    '''
+    Merges changes of runs after the last delivered run up to the last
+    finished run. Bill added and then updated is returned as added, updated
+    bill has last action name from before its first update
+    Returns (id of the last run or None if there are no such runs,
+    list of leginfo ids of added bills,
+    list of (leginfo id, previous last action name) of updated bills)
+    '''
+    delivered_run_id = get_delivered_run_id(conn)
+    cursor = _cursor(conn)
+    cursor.execute('''SELECT MAX(id) FROM crawl_runs
+                      WHERE id > ? AND finished_at IS NOT NULL''', (delivered_run_id,))
+    last_run_id = cursor.fetchone()[0]
+    if last_run_id is None:
+        return None, [], []
+    cursor.execute('''SELECT leginfo_id, change_type, prev_last_action_name
+                      FROM bill_changes WHERE run_id > ? AND run_id <= ?
+                      ORDER BY id''', (delivered_run_id, last_run_id))
+    added = dict()
+    updated = dict()
+    for leginfo_id, change_type, prev_last_action_name in cursor:
+        if change_type == CHANGE_ADDED:
+            added.setdefault(leginfo_id, True)
+        elif leginfo_id not in added:
+            updated.setdefault(leginfo_id, prev_last_action_name)
+    return last_run_id, list(added), list(updated.items())
+
+def mark_changes_delivered(conn, run_id):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO app_state (key, value) "
+                     "VALUES ('delivered_run_id', ?)", (run_id,))
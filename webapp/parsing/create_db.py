@@ -5,59 +5,34 @@ import datetime
 import traceback
 import logging
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import urllib.parse
 import bs4
-from html.parser import HTMLParser
-from lxml import html
 from elasticsearch import Elasticsearch
 
 from .parsing_options import (db_file_name, table_name, elasticsearch_server_addr,
-                             email_acc, email_pass, email_server, email_port)
+                             email_acc, email_pass, email_server, email_port,
+                             fetch_workers, sessions_table_name,
+                             session_freeze_delay_days, db_write_batch_size,
+                             http_cache_enabled)
 from init_app import app
 from models import Bill
-from .notifications import get_auth_smtp_server, save_ids_of_changed_bills
-
-
-
-class _HTMLToText(HTMLParser):
-    def __init__(self):
-        HTMLParser.__init__(self)
-        self._buf = []
-        self.hide_output = False
-    def handle_starttag(self, tag, attrs):
-        if tag in ('p', 'br', 'h1', 'h2', 'h3', 'div') and not self.hide_output:
-            self._buf.append('\n')
-        elif tag in ('script', 'style'):
-            self.hide_output = True
-    def handle_startendtag(self, tag, attrs):
-        if tag == 'br':
-            self._buf.append('\n')
-    def handle_endtag(self, tag):
-        if tag == 'p' or 'h' in tag:
-            self._buf.append('\n')
-        elif tag in ('script', 'style'):
-            self.hide_output = False
-    def handle_data(self, text):
-        if text and not self.hide_output:
-            self._buf.append(re.sub(r'\s+', ' ', text))
-    def handle_charref(self, name):
-        if not self.hide_output:
-            n = int(name[1:], 16) if name.startswith('x') else int(name)
-            self._buf.append(chr(n))
-    def get_text(self):
-        return re.sub(r' +', ' ', ''.join(self._buf))
-
-def html_to_text(html):
-    parser = _HTMLToText()
-    try:
-        parser.feed(html)
-        parser.close()
-        return parser.get_text().strip()
-    except:
-        raise
-        return None
+from .notifications import get_auth_smtp_server
+from .fetching import (limited_get, mount_pool_adapter, get_content_hash,
+                       set_host_concurrency_limits)
+from .http_cache import (mount_caching_adapter, get_http_cache, is_unchanged,
+                         get_cache_entry, save_cache_entries)
+from .db_writer import BillsWriter
+from . import change_journal
+from keyword_matcher import MATCHED_FIELDS, get_current_matcher, match_bills_by_leginfo_ids
+from migrations import migrate, optimize
+from .extract import (log_exception, extract_bill_status_fields, get_bill_attrs,
+                      get_bill_subject_code_session, get_bill_last_action,
+                      extract_bill_text_and_date_published)
+
+
 
 def dict_factory(cursor, row):
     d = {}
@@ -102,9 +77,17 @@ except:
     traceback.print_exc()
 
 
-conn = sqlite3.connect(db_file_name)
+# sessions can be parsed by several processes at once, wait for db lock
+conn = sqlite3.connect(db_file_name, timeout=60)
 conn.row_factory = dict_factory
 cursor = conn.cursor()
+migrate(conn)
+
+# threads downloading bills' pages, db is used only from main thread
+if fetch_workers > 1:
+    fetch_executor = ThreadPoolExecutor(fetch_workers)
+else:
+    fetch_executor = None
 
 headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.3'}
 base_url = 'http://leginfo.legislature.ca.gov/faces/billSearchClient.xhtml'
@@ -113,11 +96,6 @@ status_client_url = 'http://leginfo.legislature.ca.gov/faces/billStatusClient.xh
 site_url = 'http://leginfo.legislature.ca.gov'
 
 bill_id_regex = re.compile('bill_id=([\dA-Za-z-]+)')
-bill_code_regex = re.compile('[A-Z]+-\d+')
-session_regex = re.compile('\(((20|19)\d{2}-(20|19)\d{2})\)')
-date_publiched_regex = re.compile("(\d{2}/\d{2}/\d{4})")
-
-date_reformat_regex = re.compile("(\d\d)/(\d\d)/(\d{2,4})")
 
 table_elems = {
         1: 'Law code',
@@ -133,11 +111,28 @@ pages_regex = re.compile('Page (\d+) of (\d+) pages')
 BILL_UPDATED = 1
 BILL_ADDED = 2
 
+# results of fetch_bill_info (if bill changed, it returns bill info)
+BILL_NOT_CHANGED = 3
+BILL_FETCH_FAILED = 4
+
+# states of sessions in sessions table
+# frozen - session is closed and was fully parsed after closing, its bills
+# don't change anymore
+SESSION_OPEN = "open"
+SESSION_FROZEN = "frozen"
+
 updated_bill_info = namedtuple('updated_bill_info', ['id', 'last_action_name'])
 
+# entries of http cache of pages of bills given to writer, they're saved
+# when bills are committed: {leginfo_id: list of entries}
+pending_cache_entries = dict()
+
+# columns of bills got from db to compare with parsed bills. Text isn't
+# compared, text_hash is used instead
+db_bill_columns = ['id', 'code', 'subject', 'title', 'house_location', 'authors',
+                   'session', 'last_action_date', 'last_action_name',
+                   'date_published', 'leginfo_id', 'text_hash']
 
-def log_exception(exc, bill_info):
-    logger.error(bill_info["leginfo_id"] + ": " + exc)
 
 def log_bill_changes(action, bill_info):
     if action == BILL_UPDATED:
@@ -146,47 +141,123 @@ def log_bill_changes(action, bill_info):
         action_text = "Bill added: "
     bills_changes_logger.info(action_text + bill_info["leginfo_id"])
 
-def update_bills_in_elasticsearch(leginfo_ids):
+def update_bills_in_elasticsearch(leginfo_ids, partial_updates=None):
+    '''
+    leginfo_ids - bills indexed from db
+    partial_updates - list of (id, dict of changed fields) of bills, only
+    these fields are updated in elasticsearch
+    '''
     with app.app_context():
-        Bill.reindex_by_leginfo_ids(leginfo_ids=leginfo_ids)
-
-def update_bill(bill_dict):
+        if leginfo_ids:
+            Bill.reindex_by_leginfo_ids(leginfo_ids=leginfo_ids)
+        if partial_updates:
+            Bill.update_index_fields(partial_updates)
+
+def journal_bill_changes(run_id, conn, saved_bills):
+    # called by writer in transaction of written bills
+    journal_changes = []
+    for bill_info, (action, db_bill) in saved_bills:
+        if action == BILL_UPDATED:
+            journal_changes.append((bill_info["leginfo_id"], change_journal.CHANGE_UPDATED,
+                                    db_bill['last_action_name']))
+        else:
+            journal_changes.append((bill_info["leginfo_id"], change_journal.CHANGE_ADDED,
+                                    None))
+    change_journal.add_bill_changes(conn, run_id, journal_changes)
+
+def match_bills_keywords(matcher, conn, saved_bills):
+    # added bills and bills with changed searched fields are scanned for
+    # keywords in transaction of written bills
+    leginfo_ids = [bill_info["leginfo_id"] for bill_info, (action, _) in saved_bills
+                   if action == BILL_ADDED or
+                   any(field in bill_info for field in MATCHED_FIELDS)]
+    match_bills_by_leginfo_ids(conn, matcher, table_name, leginfo_ids)
+
+_matcher = None
+
+def get_matcher(conn):
+    # keywords are read in transaction of every batch, so keyword added
+    # after scan_keyword (keyword_matcher.py) began is matched with bills
+    # written later
+    global _matcher
+    _matcher = get_current_matcher(conn, _matcher)
+    return _matcher
+
+def on_bills_written(run_id, conn, saved_bills):
+    journal_bill_changes(run_id, conn, saved_bills)
+    match_bills_keywords(get_matcher(conn), conn, saved_bills)
+
+def save_bills_changes(saved_bills, changes=None):
     '''
-    Inserts bill into db
+    Called after bills were written to db: updates them in elasticsearch,
+    logs ids of changed bills (they're saved to journal by writer)
+    saved_bills - list of (bill_info, (action, db_bill)), bill_info of
+    updated bill has only changed fields
+    changes - see save_bills_info
     '''
-    try:
-        vals = "".join(['{0}="{1}",'.format(key, val) for key, val in bill_dict.items()])
-        q = 'UPDATE {} SET {} WHERE leginfo_id="{}"'.format(table_name, vals[:-1], bill_dict['leginfo_id'])
-        cursor.execute(q)
-        conn.commit()
-    except:
-        logger.error(traceback.format_exc())
-        traceback.print_exc()
+    updated_bills_ids = []
+    added_bills_ids = []
+    partial_updates = []
+    for bill_info, (action, db_bill) in saved_bills:
+        log_bill_changes(action, bill_info)
+        if action == BILL_UPDATED:
+            updated_bills_ids.append(updated_bill_info(id=bill_info["leginfo_id"],
+                                                       last_action_name=\
+                                                       db_bill['last_action_name']))
+            partial_updates.append((db_bill['id'], bill_info))
+        else:
+            added_bills_ids.append(bill_info["leginfo_id"])
+
+    update_bills_in_elasticsearch(added_bills_ids, partial_updates)
+    print("Updated bills: ", updated_bills_ids)
+    print("Added bills: ", added_bills_ids)
+    bills_changes_logger.info("Updated bills: " + ", ".join([bill.id for bill in updated_bills_ids]))
+    bills_changes_logger.info("Added bills: " + ", ".join(added_bills_ids))
+    if changes is not None:
+        changes["added"].extend(added_bills_ids)
+        changes["updated"].extend(updated_bills_ids)
 
-def insert_bill_to_db(bill_dict, check_unique=False):
+def save_cached_pages(saved_bills):
     '''
-    Inserts bill into db
+    Caches pages of bills committed to db, so they're skipped next time if
+    they don't change. Entries of bills which weren't written are dropped
+    (their pages are parsed again by next run)
     '''
-    try:
-        columns = ', '.join(list(bill_dict.keys()))
-        placeholders = ', '.join('?' * len(list(bill_dict.keys())))
-        if check_unique:
-            q = 'SELECT * FROM {} WHERE leginfo_id="{}"'.format(table_name, bill_dict['leginfo_id'])
-            cursor.execute(q)
-            found_bills = list(cursor)
-            if found_bills:
-                # don't insert if this bill is already in db
-                return
-        q = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, columns, placeholders)
-        cursor.execute(q, tuple(bill_dict.values()))
-        conn.commit()
-    except:
-        logger.error(traceback.format_exc())
-        traceback.print_exc()
+    entries = [entry for bill_info, _ in saved_bills
+               for entry in pending_cache_entries.pop(bill_info["leginfo_id"], [])]
+    pending_cache_entries.clear()
+    save_cache_entries(entries)
+
+def on_bills_committed(saved_bills, changes=None):
+    save_cached_pages(saved_bills)
+    save_bills_changes(saved_bills, changes)
+
+_run_id = None
+
+def get_run_id(changes=None):
+    # run of update_db.py is in changes, other callers get one run per process
+    global _run_id
+    if changes is not None and changes.get("run_id") is not None:
+        return changes["run_id"]
+    if _run_id is None:
+        _run_id = start_crawl_run()
+    return _run_id
+
+def get_bills_writer(changes=None):
+    # changes of bills are saved to journal and bills are matched with
+    # keywords in transaction of bills, bills are updated in elasticsearch
+    # after they were written to db
+    run_id = get_run_id(changes)
+    return BillsWriter(conn, table_name, db_write_batch_size,
+                       on_flush=lambda saved_bills: on_bills_committed(saved_bills,
+                                                                       changes),
+                       on_write=lambda conn, saved_bills: on_bills_written(run_id, conn,
+                                                                           saved_bills))
 
 def get_bill_from_db_by_leginfo_id(leginfo_id):
-    q = 'SELECT * FROM {} WHERE leginfo_id="{}"'.format(table_name, leginfo_id)
-    cursor.execute(q)
+    q = 'SELECT {} FROM {} WHERE leginfo_id=?'.format(', '.join(db_bill_columns),
+                                                     table_name)
+    cursor.execute(q, (leginfo_id,))
     found_bills = list(cursor)
     if not found_bills:
         # empty list
@@ -194,126 +265,139 @@ def get_bill_from_db_by_leginfo_id(leginfo_id):
     else:
         return found_bills[0]
             
-def custom_tag_search(tag, span_id):
-    if tag.has_key("id"):
-        return (tag.name == "span" or  tag.name == "div") and tag["id"]==span_id
-    return False
-
-def get_bill_text_and_date_published(bill_info, text_client_url, bill_id_param, r_session):
-    try:
-        bill_text_url = text_client_url + '?' + bill_id_param
-        bill_text_page = r_session.get(bill_text_url)
-        
-        tree = html.fromstring(bytes(bill_text_page.text, encoding='utf-8'))
-        bill_text = tree.xpath("//div[@id='bill_all']")[0]
-        
-        for strike in bill_text.xpath("//strike"):
-            strike.getparent().remove(strike)
-        
-        new_tree = html.tostring(bill_text)
-        # [2:-1] - for removing b'' after converting bytes to str
-        bill_info['text'] = re.sub(r'\n\n\n|\\t|\t|\\n', '', html_to_text(str(new_tree)))[2:-1]
-    
-        date_published = tree.xpath('//span[contains(text(), "Date Published")]')
-        if not date_published:
-            date_publiched = ''
-        else:
-            date_published = date_published[0]
-            date_publiched = date_publiched_regex.search(date_published.text).group(1)
-            date_publiched = date_reformat_regex.sub(r'\3-\1-\2', date_publiched)
-        bill_info['date_published'] = date_publiched
-    except:
-        log_exception(traceback.format_exc(), bill_info)
-        traceback.print_exc()
-        bill_info['text'] = ''
-        bill_info['date_published'] = None
-
-def get_bill_attrs(bill_info, bill_status_soup):
-    # title, house_location, authors
-    # id on page - column in DB
-    bill_attrs = {
-            'statusTitle': 'title',
-            'houseLoc': 'house_location',
-            'leadAuthors': 'authors',
-            }
-    
-    for span_id, db_col_name in bill_attrs.items():
-        param = bill_status_soup.find(lambda tag: \
-                                 custom_tag_search(tag, span_id))
-        if param is not None:
-            bill_info[db_col_name] = param.text.strip()
-        else:
-            bill_info[db_col_name] = ''
+def invalidate_cached_page(url):
+    # page which wasn't parsed must be parsed next time, even if it's the same
+    if http_cache_enabled:
+        try:
+            get_http_cache().invalidate(url)
+        except:
+            logger.error(traceback.format_exc())
 
-def get_bill_subject_code_session(bill_info, bill_status_soup):
-    try:
-        bill_title = bill_status_soup.find('div', id='bill_title').text
-        bill_code = bill_code_regex.search(bill_title).group(0)
-        session = session_regex.search(bill_title).group(1)
-        bill_info['code'] = bill_code
-        bill_info['session'] = session
-    except Exception:
-        log_exception(traceback.format_exc(), bill_info)
-        traceback.print_exc()
-        bill_info['code'] = ""
-        bill_info['session'] = ""
-        
-    try:
-        bill_subject = bill_title.replace(session, '').replace(bill_code, '').\
-                       replace('()', '').strip()
-        bill_info['subject'] = bill_subject
-    except:
-        log_exception(traceback.format_exc(), bill_info)
-        traceback.print_exc()
-        bill_info['subject'] = ''
-        
-    
-def get_bill_last_action(bill_info, bill_status_soup):
-    # get last action date and name
-    try:
-        last_action_date = bill_status_soup.find(lambda tag: \
-                                 custom_tag_search(tag, "lastAction"))                
-        if last_action_date is not None:
-            last_action_date = last_action_date.text.strip()
-            last_action_date = datetime.datetime.strptime(last_action_date, "%m/%d/%y").strftime("%Y-%m-%d")
-            bill_info["last_action_date"] = last_action_date
-        else:
-            bill_info["last_action_date"] = None
-    except:
-        bill_info["last_action_date"] = None
-        log_exception(traceback.format_exc(), bill_info)
-        traceback.print_exc()
-        
+def get_bill_text_and_date_published(bill_info, text_client_url, bill_id_param, r_session,
+                                     db_bill=None, cache_entries=None):
+    '''
+    If text page is the same as last fetched one or its hash is equal to
+    text_hash of db_bill, text and date published are not parsed and not set
+    in bill_info (values in db are kept). The same if page of bill in db
+    wasn't got, new bill gets empty text
+    cache_entries - list to append entry of http cache of page to
+    '''
+    bill_text_url = text_client_url + '?' + bill_id_param
     try:
-        last_action_name = bill_status_soup.find("label", attrs={"for": "lastAction"}) 
-        if last_action_name is not None:
-            bill_info["last_action_name"] = last_action_name.text.replace(":", "")
-        else:
-            bill_info["last_action_name"] = ""
+        bill_text_page = limited_get(r_session, bill_text_url)
+        if db_bill is not None and is_unchanged(bill_text_page):
+            return
+        text_hash = get_content_hash(bill_text_page.content)
+        if db_bill is None or db_bill['text_hash'] != text_hash:
+            text, date_published = extract_bill_text_and_date_published(bill_text_page.text)
+            bill_info['text'] = text
+            bill_info['date_published'] = date_published
+            bill_info['text_hash'] = text_hash
+        if cache_entries is not None and get_cache_entry(bill_text_page) is not None:
+            cache_entries.append(get_cache_entry(bill_text_page))
     except:
-        bill_info["last_action_name"] = ""
         log_exception(traceback.format_exc(), bill_info)
         traceback.print_exc()
+        invalidate_cached_page(bill_text_url)
+        if db_bill is None:
+            bill_info['text'] = ''
+            bill_info['date_published'] = None
+            bill_info['text_hash'] = None
+
+def get_bill_status_fields(bill_info, bill_status_url, r_session, skip_unchanged=False,
+                           cache_entries=None):
+    '''
+    Downloads bill status page, retries if error getting the page
+    Returns fields extracted from page (see extract_bill_status_fields),
+    None if page wasn't got or BILL_NOT_CHANGED if skip_unchanged and
+    page is the same as last fetched one (it's not parsed)
+    cache_entries - list to append entry of http cache of parsed page to
+    '''
+    attempt = 0
+    while attempt < 5:
+        attempt += 1
+        try:
+            bill_page = limited_get(r_session, bill_status_url)
+            if skip_unchanged and is_unchanged(bill_page):
+                return BILL_NOT_CHANGED
+            status_fields = extract_bill_status_fields(bill_page.text)
+            if status_fields["bill_status"]:
+                if cache_entries is not None and get_cache_entry(bill_page) is not None:
+                    cache_entries.append(get_cache_entry(bill_page))
+                return status_fields
+        except:
+            log_exception(traceback.format_exc(), bill_info)
+            traceback.print_exc()
+        invalidate_cached_page(bill_status_url)
+    return None
 
-def save_bills_info(bill_links, r_session, check_unique):
+def fetch_bill_info(bill_info, bill_id_param, db_bill, cache_entries, r_session):
+    '''
+    Downloads and parses pages of one bill. Runs in fetching threads, so
+    it mustn't use db connection (db_bill is got from db beforehand)
+    cache_entries - list to collect entries of http cache of fetched pages
+    into, they're saved when bill is in db
+    Returns filled bill_info, BILL_NOT_CHANGED or BILL_FETCH_FAILED
+    '''
+    bill_status_url = status_client_url + '?' + bill_id_param
+    # pages of bills which are in db aren't parsed if they didn't change
+    status_fields = get_bill_status_fields(bill_info, bill_status_url, r_session,
+                                           skip_unchanged=db_bill is not None,
+                                           cache_entries=cache_entries)
+    if status_fields is None:
+        return BILL_FETCH_FAILED
+    if status_fields == BILL_NOT_CHANGED:
+        return BILL_NOT_CHANGED
+
+    get_bill_last_action(bill_info, status_fields)
+    if db_bill is not None:
+        if bill_info["last_action_date"] == db_bill["last_action_date"]:
+            # no changes
+            return BILL_NOT_CHANGED
+
+    get_bill_attrs(bill_info, status_fields)
+    get_bill_subject_code_session(bill_info, status_fields)
+    get_bill_text_and_date_published(bill_info, text_client_url, bill_id_param, r_session,
+                                     db_bill, cache_entries)
+    return bill_info
+
+def get_changed_fields(bill_info, db_bill):
+    # only changed fields of existing bill are written to db and elasticsearch
+    changed_fields = {"leginfo_id": bill_info["leginfo_id"]}
+    for field, value in bill_info.items():
+        if field not in db_bill or db_bill[field] != value:
+            changed_fields[field] = value
+    return changed_fields
+
+def save_bills_info(bill_links, r_session, check_unique, executor=None,
+                    changes=None, writer=None):
     '''
-    Parses bills from links, gets bills' attributes and calls function 
-    which inserts bill info to db (inserting happens after 
-    getting info for one bill)
+    Parses bills from links, gets bills' attributes and gives bill info
+    to writer, which inserts bills to db in batches
     bill_links - links to bills
     r_session - request.Session object
-    check_unique - check if bill is already in db, don't add if it is
+    check_unique - not used: bills are unique by leginfo_id in db, existing
+    bill is updated instead of adding a copy
+    executor - ThreadPoolExecutor for downloading bills' pages concurrently,
+    pages are downloaded one by one if None. Db is written only from the
+    calling thread
+    changes - dict with "added" and "updated" lists to collect ids of changed
+    bills into, "failed" counter of bills which weren't got and "run_id" of
+    crawl run, changes are saved to journal under it (see get_run_id)
+    writer - BillsWriter, bills are written to db and saved to elasticsearch
+    when it's flushed. If None, bills are written before return
     '''
-    saved_bills_leginfo_ids = []
-    updated_bills_ids = []
-    added_bills_ids = []
+    own_writer = writer is None
+    if own_writer:
+        writer = get_bills_writer(changes)
     bills_info = list()
     parsed_bills_cnt = 0
     all_bills_cnt = len(bill_links)
-    for bill_link in bill_links:
-        print(str(parsed_bills_cnt) + " of " + str(all_bills_cnt) + " bills")
-        parsed_bills_cnt += 1
 
+    # bills to fetch: (bill_info, bill_id_param, db_bill, cache entries of
+    # its pages)
+    bills_to_fetch = []
+    for bill_link in bill_links:
         # get leginfo site bill id
         bill_info = dict()
         bill_id_parsed = bill_id_regex.search(bill_link)
@@ -323,67 +407,42 @@ def save_bills_info(bill_links, r_session, check_unique):
         except:
             print("Failed to parse bill id from URL: ", bill_link)
             continue
-        
-        # get bill attributes
-        bill_status_url = status_client_url + '?' + bill_id_param
-        
-        # if error getting the page, retry
-        got_response = False
-        attempt = 0
-        while not got_response and attempt < 5:
-            try:
-                bill_page = r_session.get(bill_status_url)
-                bill_status_soup = bs4.BeautifulSoup(bill_page.text, 'html.parser')
-                if bill_status_soup.find("div", id="bill_status") is not None:
-                    got_response = True
-            except:
-                log_exception(traceback.format_exc(), bill_info)
-                traceback.print_exc()
-                attempt += 1
-        if not got_response:
-            continue
-            
-        get_bill_last_action(bill_info, bill_status_soup)
-
         db_bill = get_bill_from_db_by_leginfo_id(bill_info['leginfo_id'])
+        bills_to_fetch.append((bill_info, bill_id_param, db_bill, []))
 
-        if db_bill is not None:
-            if bill_info["last_action_date"] == db_bill["last_action_date"]:
-                # no changes
-                continue
-        
-        get_bill_attrs(bill_info, bill_status_soup)
-        get_bill_subject_code_session(bill_info, bill_status_soup)
-        get_bill_text_and_date_published(bill_info, text_client_url, bill_id_param, r_session)
+    if executor is not None:
+        futures = [executor.submit(fetch_bill_info, *args, r_session)
+                   for args in bills_to_fetch]
+        fetched = (future.result() for future in futures)
+    else:
+        fetched = (fetch_bill_info(*args, r_session) for args in bills_to_fetch)
+
+    # results are handled in order of links, while next bills are downloaded
+    for (_, _, db_bill, cache_entries), bill_info in zip(bills_to_fetch, fetched):
+        print(str(parsed_bills_cnt) + " of " + str(all_bills_cnt) + " bills")
+        parsed_bills_cnt += 1
+
+        if bill_info == BILL_FETCH_FAILED:
+            if changes is not None:
+                changes["failed"] += 1
+            continue
+        if bill_info == BILL_NOT_CHANGED:
+            # bill in db is up to date
+            save_cache_entries(cache_entries)
+            continue
         
         bills_info.append(bill_info)
         print("Bill changed: ",  bill_info["code"])
-        try:
-            if db_bill is not None:
-                # bill exists, update
-                update_bill(bill_info)
-                log_bill_changes(BILL_UPDATED, bill_info)
-                updated_bill_info_ = updated_bill_info(id=bill_info["leginfo_id"],
-                                                       last_action_name=\
-                                                       db_bill['last_action_name'])
-                updated_bills_ids.append(updated_bill_info_)
-            else:
-                # add new bill
-                insert_bill_to_db(bill_info, check_unique=check_unique)
-                log_bill_changes(BILL_ADDED, bill_info)
-                added_bills_ids.append(bill_info["leginfo_id"])
-            saved_bills_leginfo_ids.append(bill_info["leginfo_id"])
-        except:
-            log_exception(traceback.format_exc(), bill_info)
-            traceback.print_exc()
-            continue
-        
-    update_bills_in_elasticsearch(saved_bills_leginfo_ids)
-    print("Updated bills: ", updated_bills_ids)
-    print("Added bills: ", added_bills_ids)
-    bills_changes_logger.info("Updated bills: " + ", ".join([bill.id for bill in updated_bills_ids]))
-    bills_changes_logger.info("Added bills: " + ", ".join(added_bills_ids))
-    save_ids_of_changed_bills(added_bills_ids, updated_bills_ids)
+        pending_cache_entries[bill_info["leginfo_id"]] = cache_entries
+        if db_bill is not None:
+            # bill exists, update
+            writer.add(get_changed_fields(bill_info, db_bill), (BILL_UPDATED, db_bill))
+        else:
+            # add new bill
+            writer.add(bill_info, (BILL_ADDED, None))
+
+    if own_writer:
+        writer.flush()
     return bills_info
 
 def get_soup_with_params(base_url, session, params_dict=None, form=None):
@@ -432,7 +491,7 @@ def get_bills_on_one_page(soup):
         bills.append(site_url + link_elem.a['href'])
     return bills
 
-def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='', house='Both', law_code='All', statute_year='', chapter_number='', check_unique=False):
+def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='', house='Both', law_code='All', statute_year='', chapter_number='', check_unique=False, changes=None):
     '''
     Query bills from http://leginfo.legislature.ca.gov/faces/billSearchClient.xhtml
     Parse and add to database
@@ -440,7 +499,9 @@ def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='',
     bill_number param must be in format 'AB-100' or 'AB100' or '100'
     Params: keyword, session_year, house, law_code, bill_number, statute_year, chapter_number
     num - number of bills to return. -1 if all available bills
-    check_unique - check if bill is already in db, don't add if it is
+    check_unique - not used (see save_bills_info)
+    changes - dict to collect ids of changed bills into (see save_bills_info)
+    Returns True if all pages of search results were parsed
     '''    
 
     session = session.replace('-', '')
@@ -458,6 +519,9 @@ def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='',
             }
     
     s = requests.Session()
+    mount_pool_adapter(s, fetch_workers)
+    if http_cache_enabled:
+        mount_caching_adapter(s, [status_client_url, text_client_url], fetch_workers)
     soup = get_soup_with_params(base_url, s, params_dict=url_params)
 
         
@@ -479,7 +543,15 @@ def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='',
             logging.info("No links on page")
             print("No links on page")
             return None
-        save_bills_info(bills_on_page_links, s, check_unique)
+        writer = get_bills_writer(changes)
+        try:
+            save_bills_info(bills_on_page_links, s, check_unique, fetch_executor,
+                            changes, writer)
+        finally:
+            writer.flush()
+            print(writer.get_stats())
+            logger.info(writer.get_stats())
+        return True
     else:
         current_page = 1
         view_state = soup.find('input', attrs={'id': 'j_id1:javax.faces.ViewState:3'})['value']
@@ -490,22 +562,98 @@ def parse_laws_into_db(num=-1, keyword='', session='2019-2020', bill_number='',
         if num > all_laws_num or num == -1:
             num = all_laws_num
         pages_num = ceil(num/10)
-        while current_page <= pages_num:            
-            paging_params = {
-                    'dataNavForm:hidden_page_index': str(current_page),
-                    'dataNavForm:go_to_page': str(current_page),
-                    'javax.faces.ViewState': view_state
-                    }
-            paging_params = get_paging_params(paging_params, url_params)
-            soup = get_soup_with_params(base_url, s, form=paging_params)
-            bills_on_page_links = get_bills_on_one_page(soup)
-            save_bills_info(bills_on_page_links, s, check_unique)
-            try:
-                view_state = soup.find('input', attrs={'id': 'j_id1:javax.faces.ViewState:3'})['value']
-            except:
-                traceback.print_exc()
-            current_page += 1
-        cursor.close()
+        # bills of several pages are written to db in one batch
+        writer = get_bills_writer(changes)
+        try:
+            while current_page <= pages_num:            
+                paging_params = {
+                        'dataNavForm:hidden_page_index': str(current_page),
+                        'dataNavForm:go_to_page': str(current_page),
+                        'javax.faces.ViewState': view_state
+                        }
+                paging_params = get_paging_params(paging_params, url_params)
+                soup = get_soup_with_params(base_url, s, form=paging_params)
+                bills_on_page_links = get_bills_on_one_page(soup)
+                save_bills_info(bills_on_page_links, s, check_unique, fetch_executor,
+                                changes, writer)
+                try:
+                    view_state = soup.find('input', attrs={'id': 'j_id1:javax.faces.ViewState:3'})['value']
+                except:
+                    traceback.print_exc()
+                current_page += 1
+        finally:
+            writer.flush()
+            print(writer.get_stats())
+            logger.info(writer.get_stats())
+    return True
+
+def crawl_session(session, run_id=None, host_concurrency=None):
+    '''
+    Parses all bills of session into db. Used as worker of process pool
+    in update_db.py: every process has own db connection, requests session
+    and JSF ViewState
+    run_id - crawl run, changes of bills are saved to journal under it
+    host_concurrency - (min, max) limits of simultaneous requests of this
+    process to one host (see fetching.get_host_concurrency_share)
+    Returns dict with "added" and "updated" lists of changed bills and
+    "completed" - whether every bill of session was got
+    '''
+    changes = {"session": session, "run_id": run_id, "added": [], "updated": [],
+               "failed": 0, "completed": False}
+    print("Parsing session " + session)
+    if host_concurrency is not None:
+        set_host_concurrency_limits(*host_concurrency)
+    try:
+        parsed = parse_laws_into_db(session=session, num=-1, changes=changes)
+        changes["completed"] = bool(parsed) and changes["failed"] == 0
+    except:
+        # bills saved before error are in db, so their changes are returned
+        logger.error("Session " + session + ": " + traceback.format_exc())
+        traceback.print_exc()
+    return changes
+
+def get_frozen_sessions():
+    q = 'SELECT session FROM {} WHERE state=?'.format(sessions_table_name)
+    cursor.execute(q, (SESSION_FROZEN,))
+    return set(row["session"] for row in cursor)
+
+def set_session_state(session, state):
+    q = '''INSERT OR REPLACE INTO {} (session, state, updated_at)
+           VALUES (?, ?, ?)'''.format(sessions_table_name)
+    cursor.execute(q, (session, state, datetime.datetime.now().isoformat()))
+    conn.commit()
+
+def is_session_closed(session):
+    # session in format '2019-2020' ends in the end of its second year,
+    # some last actions (like chaptering) are still registered after that
+    end_year = int(session.split('-')[1])
+    closed_since = datetime.datetime(end_year + 1, 1, 1) + \
+                   datetime.timedelta(days=session_freeze_delay_days)
+    return datetime.datetime.now() >= closed_since
+
+def update_session_state(session, completed):
+    '''
+    Freezes session if it's closed and all its bills were parsed
+    '''
+    if completed and is_session_closed(session):
+        set_session_state(session, SESSION_FROZEN)
+        logger.info("Session frozen: " + session)
+    else:
+        set_session_state(session, SESSION_OPEN)
+
+def optimize_db():
+    optimize(conn)
+
+def start_crawl_run():
+    return change_journal.start_crawl_run(conn)
+
+def finish_crawl_run(run_id):
+    change_journal.finish_crawl_run(conn, run_id)
+
+def bump_data_generation():
+    # data in db and elasticsearch changed, caches of web app are outdated
+    cursor.execute("UPDATE app_state SET value=value+1 WHERE key='data_generation'")
+    conn.commit()
 
 
 '''
@@ -523,18 +671,20 @@ while year >= 2000:
     year -= 2
 '''
 '''
-clear_bills_changes()
-
+run_id = start_crawl_run()
 year = 2018
 while year >= 2000:
     prev_year = year - 1
     session = str(prev_year) + '-' + str(year)
-    parse_laws_into_db(session=session, num=-1)
+    parse_laws_into_db(session=session, num=-1, changes={"run_id": run_id, "added": [],
+                                                         "updated": [], "failed": 0})
     year -= 2
+finish_crawl_run(run_id)
 
 send_email_notifications(email_server, email_acc)
 
 
 parse_laws_into_db(session="2020-2018", num=-1)
+finish_crawl_run(get_run_id())
 send_email_notifications(email_server, sender_email=email_acc)
 '''
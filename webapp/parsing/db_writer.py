@@ -0,0 +1,104 @@
+import sqlite3
+import time
+import traceback
+import logging
+
+
+logger = logging.getLogger("errors")
+
+# ON CONFLICT ... DO UPDATE is supported since SQLite 3.24
+UPSERT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+class BillsWriter(object):
+    '''
+    Buffers parsed bills and writes them to db in batches of batch_size
+    bills. Every batch is one transaction with parameterized executemany
+    inserting new bills and updating existing ones by leginfo_id (needs
+    unique index on leginfo_id, created by db migrations)
+    on_flush - function called with list of (bill_dict, change) after
+    batch was committed (change is any value given to add())
+    on_write - function called with connection and list of (bill_dict,
+    change) after bills were written, in the same transaction
+    '''
+    def __init__(self, conn, table_name, batch_size, on_flush=None, on_write=None):
+        self.conn = conn
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.on_write = on_write
+        self._pending = []
+        self.written_cnt = 0
+        self.write_time = 0.0
+
+    def add(self, bill_dict, change=None):
+        self._pending.append((bill_dict, change))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        started = time.time()
+        try:
+            with self.conn:
+                self._write(pending)
+            written = pending
+        except:
+            # find bad bills, write others one by one
+            logger.error(traceback.format_exc())
+            traceback.print_exc()
+            written = []
+            for bill_dict, change in pending:
+                try:
+                    with self.conn:
+                        self._write([(bill_dict, change)])
+                    written.append((bill_dict, change))
+                except:
+                    logger.error(bill_dict.get("leginfo_id", "") + ": " +
+                                 traceback.format_exc())
+        self.write_time += time.time() - started
+        self.written_cnt += len(written)
+        if self.on_flush is not None and written:
+            self.on_flush(written)
+
+    def _write(self, bills):
+        # bills with the same set of columns are written by one executemany
+        bills_by_columns = dict()
+        for bill_dict, _ in bills:
+            columns = tuple(bill_dict.keys())
+            bills_by_columns.setdefault(columns, []).append(tuple(bill_dict.values()))
+        for columns, rows in bills_by_columns.items():
+            if UPSERT_SUPPORTED:
+                self.conn.executemany(self._upsert_query(columns), rows)
+            else:
+                i = columns.index('leginfo_id')
+                self.conn.executemany(self._update_query(columns),
+                                      [row[:i] + row[i+1:] + (row[i],) for row in rows])
+                self.conn.executemany(self._insert_query(columns, 'INSERT OR IGNORE'),
+                                      rows)
+        if self.on_write is not None:
+            self.on_write(self.conn, bills)
+
+    def _insert_query(self, columns, insert='INSERT'):
+        return '{} INTO {} ({}) VALUES ({})'.format(
+            insert, self.table_name, ', '.join(columns),
+            ', '.join('?' * len(columns)))
+
+    def _upsert_query(self, columns):
+        updates = ', '.join('{0}=excluded.{0}'.format(column) for column in columns
+                            if column != 'leginfo_id')
+        return self._insert_query(columns) + \
+               ' ON CONFLICT(leginfo_id) DO UPDATE SET ' + updates
+
+    def _update_query(self, columns):
+        # leginfo_id is the last param
+        updates = ', '.join('{}=?'.format(column) for column in columns
+                            if column != 'leginfo_id')
+        return 'UPDATE {} SET {} WHERE leginfo_id=?'.format(self.table_name, updates)
+
+    def get_stats(self):
+        speed = self.written_cnt / self.write_time if self.write_time else 0
+        return "Bills written to db: {} in {:.2f} s ({:.1f} bills/s)".format(
+            self.written_cnt, self.write_time, speed)
@@ -0,0 +1,235 @@
+'''
+Extraction of bill info from leginfo pages. No db or network access here,
+so functions can be used from fetching threads and benchmarks
+'''
+import re
+import html as html_entities
+import datetime
+import traceback
+import logging
+
+from lxml import etree, html
+
+
+logger = logging.getLogger("errors")
+
+bill_code_regex = re.compile('[A-Z]+-\d+')
+session_regex = re.compile('\(((20|19)\d{2}-(20|19)\d{2})\)')
+
+# ids of elements (span or div) on bill status page - columns in DB
+bill_attrs = {
+        'statusTitle': 'title',
+        'houseLoc': 'house_location',
+        'leadAuthors': 'authors',
+        }
+
+# all elements of bill status page needed for bill info, found in one walk
+# through the document
+status_elements_xpath = etree.XPath(
+    "//*[((self::span or self::div) and (@id='statusTitle' or @id='houseLoc'"
+    " or @id='leadAuthors' or @id='lastAction'))"
+    " or (self::div and (@id='bill_title' or @id='bill_status'))"
+    " or (self::label and @for='lastAction')]")
+
+status_parser = html.HTMLParser(encoding='utf-8')
+
+bill_text_xpath = etree.XPath("//div[@id='bill_all']")
+# text in <strike> is deleted from bill, it's not a part of text
+date_published_xpath = etree.XPath(
+    '//span[contains(text(), "Date Published")][not(ancestor::strike)]')
+date_publiched_regex = re.compile("(\d{2}/\d{2}/\d{4})")
+date_reformat_regex = re.compile("(\d\d)/(\d\d)/(\d{2,4})")
+
+# Bill texts in db were made by serializing bill html to bytes, converting
+# them with str() (so text got escapes like \\n, \\' of bytes repr) and
+# parsing the result with HTMLParser. The same text is made here in one walk
+# through the tree, so texts of not changed bills stay the same:
+# - newlines and tabs are dropped (\\n, \\t were removed from result),
+#   but not before spaces around them were collapsed
+# - other control chars, quote and backslash keep repr escapes
+# - chars which are not valid in HTML charrefs are changed like by unescape
+# - other whitespace is replaced with space (runs of spaces are collapsed
+#   in the whole text)
+_text_replacements = {
+    '\n': '\\n',
+    '\t': '\\t',
+    '\r': '\\r',
+    "'": "\\'",
+    '\\': '\\\\',
+}
+for _code in list(range(0x20)) + [0x7f]:
+    _text_replacements.setdefault(chr(_code), '\\x{:02x}'.format(_code))
+for _code in list(range(0x80, 0xa0)) + list(range(0xfdd0, 0xfdf0)) + \
+             [plane + nonchar for plane in range(0, 0x110000, 0x10000)
+              for nonchar in (0xfffe, 0xffff)]:
+    _text_replacements[chr(_code)] = html_entities.unescape('&#{};'.format(_code))
+# whitespace (str.isspace) which isn't escaped above
+for _char in '\xa0\u1680\u2028\u2029\u202f\u205f\u3000' + \
+             ''.join(chr(_code) for _code in range(0x2000, 0x200b)):
+    _text_replacements[_char] = ' '
+_text_replacements_regex = re.compile(
+    '[' + ''.join(re.escape(char) for char in _text_replacements) + ']')
+_spaces_regex = re.compile(r' {2,}')
+_text_cleanup_regex = re.compile(r'\n\n\n|\\t|\t|\\n')
+
+# elements serialized without end tag
+_void_tags = frozenset(['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
+                        'img', 'input', 'isindex', 'link', 'meta', 'param'])
+# tags starting new line in text
+_newline_start_tags = frozenset(['p', 'br', 'h1', 'h2', 'h3', 'div'])
+
+
+def log_exception(exc, bill_info):
+    logger.error(bill_info["leginfo_id"] + ": " + exc)
+
+def extract_bill_status_fields(page_text):
+    '''
+    Parses bill status page once and returns dict with texts of elements:
+    statusTitle, houseLoc, leadAuthors, lastAction (span or div with such id),
+    bill_title (div), lastActionLabel (label for lastAction) - None if there
+    is no element on page, and bill_status - whether div#bill_status is on page
+    (first element in document is used, like bs4 find)
+    '''
+    fields = dict.fromkeys(list(bill_attrs.keys()) +
+                           ['lastAction', 'bill_title', 'lastActionLabel'])
+    fields['bill_status'] = False
+    try:
+        tree = html.document_fromstring(page_text.encode('utf-8'),
+                                        parser=status_parser)
+    except etree.ParserError:
+        # empty page
+        return fields
+    for elem in status_elements_xpath(tree):
+        if elem.tag == 'label':
+            key = 'lastActionLabel'
+        else:
+            key = elem.get('id')
+            if key == 'bill_status':
+                fields['bill_status'] = True
+                continue
+        if fields[key] is None:
+            fields[key] = elem.text_content()
+    return fields
+
+def get_bill_attrs(bill_info, status_fields):
+    # title, house_location, authors
+    for elem_id, db_col_name in bill_attrs.items():
+        param = status_fields[elem_id]
+        if param is not None:
+            bill_info[db_col_name] = param.strip()
+        else:
+            bill_info[db_col_name] = ''
+
+def get_bill_subject_code_session(bill_info, status_fields):
+    try:
+        bill_title = status_fields['bill_title']
+        bill_code = bill_code_regex.search(bill_title).group(0)
+        session = session_regex.search(bill_title).group(1)
+        bill_info['code'] = bill_code
+        bill_info['session'] = session
+    except Exception:
+        log_exception(traceback.format_exc(), bill_info)
+        traceback.print_exc()
+        bill_info['code'] = ""
+        bill_info['session'] = ""
+        
+    try:
+        bill_subject = bill_title.replace(session, '').replace(bill_code, '').\
+                       replace('()', '').strip()
+        bill_info['subject'] = bill_subject
+    except:
+        log_exception(traceback.format_exc(), bill_info)
+        traceback.print_exc()
+        bill_info['subject'] = ''
+
+def get_bill_last_action(bill_info, status_fields):
+    # get last action date and name
+    try:
+        last_action_date = status_fields["lastAction"]
+        if last_action_date is not None:
+            last_action_date = last_action_date.strip()
+            last_action_date = datetime.datetime.strptime(last_action_date, "%m/%d/%y").strftime("%Y-%m-%d")
+            bill_info["last_action_date"] = last_action_date
+        else:
+            bill_info["last_action_date"] = None
+    except:
+        bill_info["last_action_date"] = None
+        log_exception(traceback.format_exc(), bill_info)
+        traceback.print_exc()
+        
+    try:
+        last_action_name = status_fields["lastActionLabel"]
+        if last_action_name is not None:
+            bill_info["last_action_name"] = last_action_name.replace(":", "")
+        else:
+            bill_info["last_action_name"] = ""
+    except:
+        bill_info["last_action_name"] = ""
+        log_exception(traceback.format_exc(), bill_info)
+        traceback.print_exc()
+
+def _replace_char(match):
+    return _text_replacements[match.group()]
+
+class _BillTextWriter(object):
+    def __init__(self):
+        self._buf = []
+        self.hide_output = False
+    def start_tag(self, tag):
+        if tag in _newline_start_tags and not self.hide_output:
+            self._buf.append('\n')
+        elif tag in ('script', 'style'):
+            self.hide_output = True
+    def end_tag(self, tag):
+        if tag == 'p' or 'h' in tag:
+            self._buf.append('\n')
+        elif tag in ('script', 'style'):
+            self.hide_output = False
+    def data(self, text):
+        if text and not self.hide_output:
+            self._buf.append(_text_replacements_regex.sub(_replace_char, text))
+    def write(self, elem):
+        tag = elem.tag
+        if not isinstance(tag, str):
+            # comment or processing instruction
+            self.data(elem.tail)
+            return
+        if tag == 'strike':
+            # deleted text, with text after it (like lxml remove())
+            return
+        self.start_tag(tag)
+        self.data(elem.text)
+        for child in elem:
+            self.write(child)
+        if tag not in _void_tags or elem.text or len(elem):
+            self.end_tag(tag)
+        self.data(elem.tail)
+    def get_text(self):
+        text = _spaces_regex.sub(' ', ''.join(self._buf))
+        return _text_cleanup_regex.sub('', text)
+
+def bill_text_to_str(bill_text):
+    '''
+    Returns normalized text of bill element (div#bill_all) without <strike>
+    '''
+    writer = _BillTextWriter()
+    writer.write(bill_text)
+    return writer.get_text()
+
+def extract_bill_text_and_date_published(page_text):
+    '''
+    Parses bill text page once and returns normalized bill text and
+    publishing date in format 2019-12-31 ('' if not on page)
+    Raises exception if there is no text on page
+    '''
+    tree = html.fromstring(bytes(page_text, encoding='utf-8'))
+    text = bill_text_to_str(bill_text_xpath(tree)[0])
+
+    date_published = date_published_xpath(tree)
+    if not date_published:
+        date_publiched = ''
+    else:
+        date_published = date_published[0]
+        date_publiched = date_publiched_regex.search(date_published.text).group(1)
+        date_publiched = date_reformat_regex.sub(r'\3-\1-\2', date_publiched)
+    return text, date_publiched
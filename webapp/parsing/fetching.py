@@ -0,0 +1,108 @@
+import re
+import hashlib
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from .parsing_options import (host_concurrency_min, host_concurrency_max,
+                              host_slow_response_time)
+
+# JSF pages contain ViewState value, which is different in every response,
+# it's masked before hashing so the same page gives the same hash
+view_state_regex = re.compile(rb'(javax\.faces\.ViewState[^>]*?value=")[^"]*"')
+
+
+class HostConcurrencyLimiter(object):
+    '''
+    Limits number of simultaneous requests to one host
+    The limit is adapted like TCP congestion window: it slowly grows after
+    fast successful responses and is halved after an error or a slow response
+    '''
+    def __init__(self, min_limit, max_limit, slow_response_time):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.slow_response_time = slow_response_time
+        self._limit = float(min_limit)
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, response_time, failed=False):
+        with self._cond:
+            self._active -= 1
+            if failed or response_time > self.slow_response_time:
+                self._limit = max(self.min_limit, self._limit / 2)
+            else:
+                # +1 after every <limit> successful responses
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+# (min, max) limits of hosts in this process, see set_host_concurrency_limits
+_host_limits = (host_concurrency_min, host_concurrency_max)
+
+def get_host_concurrency_share(processes):
+    '''
+    Returns (min, max) limits of one of processes fetching from the same
+    hosts, so all processes together don't exceed host_concurrency_max
+    (every process has at least one request)
+    '''
+    max_limit = max(1, host_concurrency_max // processes)
+    min_limit = max(1, min(host_concurrency_min // processes, max_limit))
+    return min_limit, max_limit
+
+def set_host_concurrency_limits(min_limit, max_limit):
+    # limiters are per process, so every process gets its share of limits
+    global _host_limits
+    with _limiters_lock:
+        _host_limits = (min_limit, max_limit)
+        _limiters.clear()
+
+def get_host_limiter(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostConcurrencyLimiter(_host_limits[0], _host_limits[1],
+                                                     host_slow_response_time)
+        return _limiters[host]
+
+def limited_get(r_session, url, **kwargs):
+    '''
+    r_session.get(url) which waits for a free slot of url's host
+    '''
+    limiter = get_host_limiter(url)
+    limiter.acquire()
+    started = time.time()
+    failed = True
+    try:
+        response = r_session.get(url, **kwargs)
+        failed = response.status_code == 429 or response.status_code >= 500
+        return response
+    finally:
+        limiter.release(time.time() - started, failed)
+
+def get_content_hash(content):
+    '''
+    Hash of page content (bytes) to find out if page changed
+    '''
+    return hashlib.sha1(view_state_regex.sub(rb'\1"', content)).hexdigest()
+
+def mount_pool_adapter(r_session, pool_size):
+    # default pool keeps only 10 connections to host, and threads would
+    # open and close extra connections instead of reusing them
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    r_session.mount('http://', adapter)
+    r_session.mount('https://', adapter)
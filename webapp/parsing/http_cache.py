@@ -0,0 +1,203 @@
+import time
+import sqlite3
+import threading
+import traceback
+import logging
+
+from requests.adapters import HTTPAdapter
+
+from .parsing_options import http_cache_file_name, http_cache_max_size
+from .fetching import get_content_hash
+
+
+logger = logging.getLogger("errors")
+
+
+class HTTPCache(object):
+    '''
+    On-disk cache of responses in SQLite file: validators (ETag,
+    Last-Modified) and hash of content of last response for every url.
+    Bodies are kept only for responses with validators (needed to answer
+    304 Not Modified), the least recently used entries are deleted when
+    size of bodies exceeds max_size bytes
+    Db connection is shared by threads, file can be used by several processes
+    '''
+    def __init__(self, db_file_name, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file_name, timeout=60,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS http_cache (
+                                 url TEXT PRIMARY KEY,
+                                 etag TEXT,
+                                 last_modified TEXT,
+                                 content_hash TEXT,
+                                 body BLOB,
+                                 encoding TEXT,
+                                 size INTEGER NOT NULL DEFAULT 0,
+                                 accessed_at REAL NOT NULL)''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS ix_http_cache_accessed_at
+                                 ON http_cache (accessed_at)''')
+        self._size = self._get_size()
+
+    def _get_size(self):
+        q = 'SELECT COALESCE(SUM(size), 0) FROM http_cache'
+        return self.conn.execute(q).fetchone()[0]
+
+    def _get_entry_size(self, url):
+        row = self.conn.execute('SELECT size FROM http_cache WHERE url=?',
+                                (url,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def get(self, url):
+        '''
+        Returns dict with etag, last_modified, content_hash, body, encoding
+        of url or None
+        '''
+        q = '''SELECT etag, last_modified, content_hash, body, encoding
+               FROM http_cache WHERE url=?'''
+        with self._lock:
+            row = self.conn.execute(q, (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('etag', 'last_modified', 'content_hash', 'body', 'encoding'),
+                        row))
+
+    def touch(self, url):
+        q = 'UPDATE http_cache SET accessed_at=? WHERE url=?'
+        with self._lock, self.conn:
+            self.conn.execute(q, (time.time(), url))
+
+    def put(self, url, etag, last_modified, content_hash, body, encoding):
+        if etag is None and last_modified is None:
+            # body can't be revalidated, only hash is needed
+            body = None
+        size = len(body) if body is not None else 0
+        q = '''INSERT OR REPLACE INTO http_cache (url, etag, last_modified,
+               content_hash, body, encoding, size, accessed_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+        with self._lock:
+            with self.conn:
+                # replaced entry isn't counted twice
+                old_size = self._get_entry_size(url)
+                self.conn.execute(q, (url, etag, last_modified, content_hash,
+                                      body, encoding, size, time.time()))
+            self._size += size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def invalidate(self, url):
+        # page was not parsed, it mustn't be reported as unchanged next time
+        with self._lock:
+            with self.conn:
+                old_size = self._get_entry_size(url)
+                self.conn.execute('DELETE FROM http_cache WHERE url=?', (url,))
+            self._size -= old_size
+
+    def _evict(self):
+        # cache file can be written by other processes, so size is recounted
+        self._size = self._get_size()
+        q = '''SELECT url, size FROM http_cache WHERE size > 0
+               ORDER BY accessed_at'''
+        urls = []
+        size_to_free = self._size - int(self.max_size * 0.9)
+        for url, size in self.conn.execute(q):
+            if size_to_free <= 0:
+                break
+            urls.append((url,))
+            size_to_free -= size
+        with self.conn:
+            self.conn.executemany('DELETE FROM http_cache WHERE url=?', urls)
+        self._size = self._get_size()
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter sending conditional GET requests with validators from cache
+    Every response gets attribute "unchanged": True if server answered
+    304 Not Modified (response is built from cached body) or content is
+    identical to the last response of this url
+    New content isn't cached by adapter: response gets attribute
+    "cache_entry", which is saved with save_cache_entries when page was
+    handled (e.g. bill is committed to db), so page of bill which wasn't
+    saved isn't skipped as unchanged next time
+    '''
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super(CachingHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingHTTPAdapter, self).send(request, **kwargs)
+        try:
+            cached = self.cache.get(request.url)
+        except:
+            logger.error(traceback.format_exc())
+            cached = None
+        if cached is not None:
+            if cached['etag']:
+                request.headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                request.headers['If-Modified-Since'] = cached['last_modified']
+
+        response = super(CachingHTTPAdapter, self).send(request, **kwargs)
+        response.unchanged = False
+        response.cache_entry = None
+        try:
+            if response.status_code == 304 and cached is not None \
+               and cached['body'] is not None:
+                self.cache.touch(request.url)
+                response.status_code = 200
+                response._content = cached['body']
+                response.encoding = cached['encoding']
+                response.unchanged = True
+            elif response.status_code == 200:
+                content_hash = get_content_hash(response.content)
+                response.unchanged = cached is not None and \
+                                     cached['content_hash'] == content_hash
+                response.cache_entry = (request.url, response.headers.get('ETag'),
+                                        response.headers.get('Last-Modified'),
+                                        content_hash, response.content,
+                                        response.encoding)
+        except:
+            # response is returned without caching
+            logger.error(traceback.format_exc())
+            traceback.print_exc()
+        return response
+
+
+_http_cache = None
+
+def get_http_cache():
+    # one cache connection in process, created when it's needed
+    global _http_cache
+    if _http_cache is None:
+        _http_cache = HTTPCache(http_cache_file_name, http_cache_max_size)
+    return _http_cache
+
+def mount_caching_adapter(r_session, urls, pool_size):
+    '''
+    Responses of urls starting with given prefixes are cached
+    '''
+    adapter = CachingHTTPAdapter(get_http_cache(), pool_maxsize=pool_size)
+    for url in urls:
+        r_session.mount(url, adapter)
+
+def is_unchanged(response):
+    return getattr(response, 'unchanged', False)
+
+def get_cache_entry(response):
+    # None if page isn't cached by adapter or it's unchanged
+    return getattr(response, 'cache_entry', None)
+
+def save_cache_entries(entries):
+    '''
+    Saves entries (see CachingHTTPAdapter) to cache, errors are logged
+    '''
+    for entry in entries:
+        try:
+            get_http_cache().put(*entry)
+        except:
+            logger.error(traceback.format_exc())
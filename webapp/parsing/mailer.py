@@ -0,0 +1,274 @@
+'''
+Delivery of emails: pool of authenticated SMTP connections, concurrent
+sending with limit of messages per second and persistent queue of failed
+messages, which are retried with exponential backoff
+'''
+import time
+import queue
+import sqlite3
+import smtplib
+import threading
+import traceback
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .parsing_options import (db_file_name, email_server, email_port, email_acc,
+                              email_pass, smtp_pool_size, email_send_workers,
+                              email_rate_limit, email_max_attempts,
+                              email_retry_backoff)
+
+
+logger = logging.getLogger("notifications")
+
+
+def connect_smtp_server(server, port, login, passw):
+    smtp = smtplib.SMTP(server, port)
+    smtp.starttls()
+    smtp.login(login, passw)
+    return smtp
+
+
+class SMTPConnectionPool(object):
+    '''
+    Keeps up to size open SMTP connections, they are created when needed
+    connect - function returning new connected (and logged in) smtplib.SMTP
+    '''
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                # server closes connections which were idle for long
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except OSError:
+                    # smtplib exceptions are OSError too
+                    pass
+                self._close(conn)
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._close(conn)
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def _close(self, conn):
+        try:
+            conn.quit()
+        except:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class RateLimiter(object):
+    '''
+    Allows not more than rate calls of wait() per second (0 - no limit)
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + 1.0 / self.rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class EmailRetryQueue(object):
+    '''
+    Failed messages in db table email_queue (created by db migrations).
+    Message is retried after backoff * 2^(attempts-1) seconds, and is marked
+    as failed after max_attempts attempts
+    '''
+    def __init__(self, db_file_name, max_attempts, backoff):
+        self.db_file_name = db_file_name
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file_name, timeout=60)
+
+    def add(self, from_, to, msg, error, attempts=1, message_id=None):
+        '''
+        Saves failed message (or updates it, if it's from queue)
+        '''
+        now = time.time()
+        state = "failed" if attempts >= self.max_attempts else "pending"
+        next_attempt_at = now + self.backoff * 2 ** (attempts - 1)
+        conn = self._connect()
+        try:
+            with conn:
+                if message_id is None:
+                    conn.execute('''INSERT INTO email_queue (from_addr, to_addr, msg,
+                                    attempts, state, next_attempt_at, last_error, created_at)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                 (from_, to, msg, attempts, state, next_attempt_at, error, now))
+                else:
+                    conn.execute('''UPDATE email_queue SET attempts=?, state=?,
+                                    next_attempt_at=?, last_error=? WHERE id=?''',
+                                 (attempts, state, next_attempt_at, error, message_id))
+        finally:
+            conn.close()
+        if state == "failed":
+            logger.error("Email to {} failed after {} attempts".format(to, attempts))
+
+    def remove(self, message_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM email_queue WHERE id=?', (message_id,))
+        finally:
+            conn.close()
+
+    def get_due(self):
+        '''
+        Returns list of (id, from, to, msg, attempts) of messages to retry now
+        '''
+        conn = self._connect()
+        try:
+            return conn.execute('''SELECT id, from_addr, to_addr, msg, attempts
+                                   FROM email_queue
+                                   WHERE state='pending' AND next_attempt_at <= ?
+                                   ORDER BY next_attempt_at''', (time.time(),)).fetchall()
+        finally:
+            conn.close()
+
+    def get_next_attempt_time(self):
+        # None if there are no pending messages
+        conn = self._connect()
+        try:
+            return conn.execute('''SELECT MIN(next_attempt_at) FROM email_queue
+                                   WHERE state='pending' ''').fetchone()[0]
+        finally:
+            conn.close()
+
+
+class Mailer(object):
+    '''
+    Sends messages concurrently by workers threads with connections from
+    pool, not more than rate messages per second
+    Messages which weren't sent are saved to retry_queue (if it's given)
+    '''
+    def __init__(self, pool, workers, rate, retry_queue=None):
+        self.pool = pool
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.retry_queue = retry_queue
+
+    def send(self, from_, to, msg):
+        '''
+        Sends one message (str), raises exception if it wasn't sent
+        '''
+        self.rate_limiter.wait()
+        conn = self.pool.acquire()
+        broken = False
+        try:
+            conn.sendmail(from_, to, msg.encode("utf-8"))
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # server answered, connection can be used further
+            raise
+        except:
+            broken = True
+            raise
+        finally:
+            self.pool.release(conn, broken)
+
+    def _send_all(self, messages):
+        # returns list of (message, error) of failed messages
+        failed = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(self.send, *message[:3]) for message in messages]
+            for message, future in zip(messages, futures):
+                try:
+                    future.result()
+                except:
+                    logger.error("Email to " + message[1] + ": " + traceback.format_exc())
+                    failed.append((message, traceback.format_exc()))
+        return failed
+
+    def send_all(self, messages):
+        '''
+        messages - list of (from, to, msg)
+        Returns number of sent messages
+        '''
+        failed = self._send_all(messages)
+        if self.retry_queue is not None:
+            for (from_, to, msg), error in failed:
+                self.retry_queue.add(from_, to, msg, error)
+        return len(messages) - len(failed)
+
+    def retry_queued(self, max_wait=0):
+        '''
+        Sends messages from retry queue whose time came. Waits for next
+        attempts while they are in max_wait seconds from now
+        Returns number of sent messages
+        '''
+        if self.retry_queue is None:
+            return 0
+        sent_cnt = 0
+        deadline = time.time() + max_wait
+        while True:
+            due = self.retry_queue.get_due()
+            if due:
+                messages = [(from_, to, msg, id_, attempts)
+                            for id_, from_, to, msg, attempts in due]
+                failed = self._send_all(messages)
+                failed_ids = set()
+                for (from_, to, msg, id_, attempts), error in failed:
+                    self.retry_queue.add(from_, to, msg, error, attempts + 1, id_)
+                    failed_ids.add(id_)
+                for message in messages:
+                    if message[3] not in failed_ids:
+                        self.retry_queue.remove(message[3])
+                sent_cnt += len(messages) - len(failed)
+                continue
+            next_attempt_at = self.retry_queue.get_next_attempt_time()
+            if next_attempt_at is None or next_attempt_at > deadline:
+                return sent_cnt
+            time.sleep(max(0, next_attempt_at - time.time()))
+
+    def close(self):
+        self.pool.close()
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+def get_mailer():
+    # one mailer (and pool of connections) in process
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            pool = SMTPConnectionPool(lambda: connect_smtp_server(email_server, email_port,
+                                                                  email_acc, email_pass),
+                                      smtp_pool_size)
+            _mailer = Mailer(pool, email_send_workers, email_rate_limit,
+                             EmailRetryQueue(db_file_name, email_max_attempts,
+                                             email_retry_backoff))
+        return _mailer
@@ -1,14 +1,20 @@
 from collections import namedtuple
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import datetime
+import sqlite3
 import traceback
 import logging
 
-from .parsing_options import site_addr
+from .parsing_options import site_addr, email_retry_max_wait, db_file_name
+from .mailer import connect_smtp_server, get_mailer
+from .change_journal import get_undelivered_changes, mark_changes_delivered
 from models import Bill
 from init_app import app
+import store
+from search import match_bills
+from search_params import get_time_limit_start, is_in_time_limit
+from percolator import ensure_keyword_percolators, percolate_bills
 
 
 status_client_url = 'http://leginfo.legislature.ca.gov/faces/billStatusClient.xhtml'
@@ -29,102 +35,128 @@ print("Logger inited")
 
 
 def get_auth_smtp_server(server, port, login, passw):
-    smtp = smtplib.SMTP(server, port)
-    smtp.starttls()
-    smtp.login(login, passw)
-    return smtp
-
-def save_ids_of_changed_bills(added, updated):
-    # added on 1st line, updated on 2nd
-    # comma separated leginfo ids
-    # needed for email notifications
-    logger.info("Saving ids of changed bills")
-    with open("changed_bills.txt", "r") as f:
-        lines = f.read().splitlines()
-        if len(lines) == 0:
-            lines = ["", ""]
-        elif len(lines) == 1:
-            lines = [lines[0], ""]
-        elif len(lines) > 2:
-            return
-        line_1 = lines[0] + "|" if lines[0] else ""
-        added_all = line_1 + "|".join(added) + "\n"
-        updated = [";".join([bill_info.id, bill_info.last_action_name]) for bill_info in updated]
-        line_2 = lines[1] + "|" if lines[1] else ""
-        updated_all = line_2 + "|".join(updated)
-    logger.info("Added bills ids: " + added_all)
-    logger.info("Updated bills ids: " + updated_all)
-    with open("changed_bills.txt", "w") as f:
-        f.write(added_all)
-        f.write(updated_all)
-
-def clear_bills_changes():
-    # clear changed_bills.txt file
-    logger.info("Clearing bills changes")
-    f = open("changed_bills.txt", "w")
-    f.close()
+    return connect_smtp_server(server, port, login, passw)
 
 def send_email_notifications(email_server, email_port, email_pass, sender_email):
+    '''
+    Notifies about changes of bills from journal which weren't delivered yet
+    (see change_journal.py)
+    Emails are sent by mailer (see mailer.py, SMTP server is set in
+    parsing_options.py), failed ones are retried in email_retry_max_wait
+    seconds, then they're left in queue for next run
+    '''
     logger.info("Entering function send_email_notifications")
     print("Entering function send_email_notifications")
-    from search import make_query
-    authed_email_server = get_auth_smtp_server(email_server, email_port, sender_email, email_pass)
-    with open("subscribed_emails.txt", "r") as f:
-        email_lines = [line for line in f.read().splitlines() if line]
-    with open("changed_bills.txt", "r") as f:
-        lines = f.read().splitlines()
-        if len(lines) == 0 or len(lines) > 2:
+    mailer = get_mailer()
+    # messages failed in previous runs
+    mailer.retry_queued()
+    subscriptions = store.get_subscriptions()
+    conn = sqlite3.connect(db_file_name, timeout=60)
+    try:
+        last_run_id, added, updated_list = get_undelivered_changes(conn)
+        if last_run_id is None:
             return
-        added = [bill for bill in lines[0].split("|") if bill]
-        updated = dict()
-        if len(lines) == 2:
-            for bill_info in lines[1].split("|"):
-                if not bill_info:
-                    continue
-                bill_info = bill_info.split(";")
-                print(bill_info)
-                bill_id = bill_info[0]
-                try:
-                    bill_last_action_name_prev = bill_info[1]
-                except Exception as e:
-                    print(e)
-                    
-                bill_info_tuple = updated_bill_info(id=bill_id,
-                                                    last_action_name=\
-                                                    bill_last_action_name_prev)
-                updated[bill_id] = bill_info_tuple
+        updated = {bill_id: updated_bill_info(id=bill_id, last_action_name=prev_name)
+                   for bill_id, prev_name in updated_list}
+        notify_subscriptions(subscriptions, added, updated, sender_email, mailer)
+        # failed emails are in retry queue of mailer
+        mark_changes_delivered(conn, last_run_id)
+    finally:
+        conn.close()
+
+def notify_subscriptions(subscriptions, added, updated, sender_email, mailer):
+    '''
+    Sends email to every subscription with changed bills matching its keywords
+    subscriptions - list of (email, list of keywords, time limit)
+    added - leginfo ids of added bills
+    updated - dict {leginfo id: updated_bill_info} of updated bills
+    '''
     logger.info("Updated bills: " + str(updated))
     logger.info("Added bills: " + str(added))
     
     print("Added bills: " + str(added))
     print("Updated bills: " + str(updated))
     
+    # only changed bills are searched, every (keyword, time limit) pair is
+    # searched once for all subscribers
+    changed_ids = set(added) | set(updated.keys())
+    kws_results = dict()
+    
     with app.app_context():
-        for email_line in email_lines:
-            receiver_email, kws, time_limit = email_line.split(":")
-            kws = [kw.strip() for kw in kws.split(",")]
+        # changed bills are got from db once for all subscribers, and lines
+        # of messages about them are rendered once
+        use_percolator = bool(app.config['NOTIFICATIONS_USE_PERCOLATOR'] and changed_ids
+                              and app.config['SEARCH_BACKEND'] == 'elasticsearch')
+        # texts are read by percolator for every batch of bills
+        changed_bills = Bill.find_by_leginfo_ids(changed_ids, with_text=False)
+        msgs_cache = dict()
+        messages = []
+        if use_percolator:
+            # pairs which weren't matched by percolator are searched
+            try:
+                kws_results = percolate_subscriptions(subscriptions, changed_bills)
+            except:
+                logger.error(traceback.format_exc())
+                traceback.print_exc()
+        for receiver_email, kws, time_limit in subscriptions:
             changes = dict()
             for kw in kws:
-                try:
-                    kw_result_ids, total = make_query("bill", [kw], page=1, 
-                                                      per_page=3000, time_limit=time_limit,
-                                                      returned_val="leginfo_id")
-                except:
-                    logger.error(traceback.format_exc())
-                    continue
+                if (kw, time_limit) not in kws_results:
+                    try:
+                        if changed_ids:
+                            kws_results[(kw, time_limit)] = match_bills("bill", [kw], changed_ids,
+                                                                        time_limit=time_limit)
+                        else:
+                            kws_results[(kw, time_limit)] = set()
+                    except:
+                        logger.error(traceback.format_exc())
+                        continue
+                kw_result_ids = kws_results[(kw, time_limit)]
                     
-                #print(kw_result_ids[:100])
-                #kw_result_ids, total = make_query("bill", [kw], page=1, 
-                #                                  per_page=70, time_limit="1M")
-                added_bills_for_kw = [kw for kw in added if kw in kw_result_ids]
+                added_bills_for_kw = [id_ for id_ in added if id_ in kw_result_ids]
                 updated_bills_of_kw = [updated[id_] for id_ in updated.keys() if id_ in kw_result_ids]
                 changes[kw] = [added_bills_for_kw, updated_bills_of_kw]
                 #print("kw_result_ids", kw_result_ids)
                 #print("updated_kw", updated_bills_of_kw)
             logger.info("Bills changes: " + str(changes))
             print("Bills changes: " + str(changes))
-            send_changes(authed_email_server, sender_email, receiver_email, changes)
-    authed_email_server.close()
+            msg = get_changes_email(sender_email, receiver_email, changes,
+                                    changed_bills, msgs_cache)
+            if msg is not None:
+                messages.append((sender_email, receiver_email, msg))
+
+    sent_cnt = mailer.send_all(messages)
+    sent_cnt += mailer.retry_queued(max_wait=email_retry_max_wait)
+    logger.info("Emails sent: {} of {}".format(sent_cnt, len(messages)))
+    print("Emails sent: {} of {}".format(sent_cnt, len(messages)))
+
+def percolate_subscriptions(subscriptions, bills):
+    '''
+    Matches changed bills with keywords of all subscriptions by percolator
+    index (missing keywords of subscriptions are added to it)
+    subscriptions - list of (email, list of keywords, time limit)
+    bills - dict {leginfo id: bill} of changed bills (loaded without text)
+    Returns dict {(keyword, time limit): set of leginfo ids of matching bills}
+    '''
+    index = app.config['PERCOLATOR_INDEX']
+    ensure_keyword_percolators(index, {kw for _, kws, _ in subscriptions for kw in kws})
+
+    matched = percolate_bills(index, list(bills.values()),
+                              batch_size=app.config['PERCOLATE_BATCH_SIZE'],
+                              get_texts=Bill.get_texts_by_leginfo_ids)
+    logger.info("Percolated bills: {}, matched keywords: {}".format(len(bills), len(matched)))
+    kws_results = dict()
+    for _, kws, time_limit in subscriptions:
+        try:
+            time_limit_start = get_time_limit_start(time_limit)
+        except ValueError:
+            logger.error(traceback.format_exc())
+            continue
+        for kw in kws:
+            kws_results[(kw, time_limit)] = {
+                id_ for id_ in matched.get(kw, ())
+                if is_in_time_limit(bills[id_].last_action_date, time_limit_start)}
+    return kws_results
 
 def is_info_to_notify(changes):
     # changes is dict like
@@ -133,41 +165,81 @@ def is_info_to_notify(changes):
     # check whether all values are empty (like in example above)
     return any([bool(v) for val in list(changes.values()) for v in val])
 
-def get_msg_text(changes, email):
+def get_added_bill_msg(bill, id_):
+    bill_link = status_client_url + '?bill_id=' + id_
+    return bill.code + " (" + bill.subject + "). Link: " + bill_link
+
+def get_updated_bill_msg(bill, bill_info):
+    bill_id = bill_info.id
+    prev_last_action_name = bill_info.last_action_name
+    last_action_name = bill.last_action_name
+    bill_link = status_client_url + '?' + bill_id
+    if last_action_name:
+        la_change = prev_last_action_name + " - " + last_action_name
+    else:
+        la_change = prev_last_action_name
+    return bill.code + " (" + bill.subject + "). Last action change: " + la_change \
+           + ". Link: " + bill_link
+
+def get_bill_msg(bills, msgs_cache, action, bill_info):
+    '''
+    Returns line of message about added (bill_info is leginfo id) or updated
+    (bill_info is updated_bill_info) bill, or None if bill isn't in db
+    Lines are cached in msgs_cache, so every bill is rendered once for all
+    subscribers
+    '''
+    key = (action, bill_info)
+    if key not in msgs_cache:
+        bill_id = bill_info if action == "added" else bill_info.id
+        bill = bills.get(bill_id)
+        if bill is None:
+            logger.error("Bill not found: " + bill_id)
+            msgs_cache[key] = None
+        elif action == "added":
+            msgs_cache[key] = get_added_bill_msg(bill, bill_id)
+        else:
+            msgs_cache[key] = get_updated_bill_msg(bill, bill_info)
+    return msgs_cache[key]
+
+def get_changed_bills_ids(changes):
+    ids = set()
+    for added, updated in changes.values():
+        ids.update(added)
+        ids.update(bill_info.id for bill_info in updated)
+    return ids
+
+def get_msg_text(changes, email, bills=None, msgs_cache=None):
+    '''
+    bills - dict {leginfo id: bill} with all changed bills, they are got
+    from db if None
+    msgs_cache - dict with cached lines about bills (see get_bill_msg),
+    shared by messages of all subscribers
+    '''
     logger.info("Getting message text")
     unsubscribe_link = site_addr + "unsubs/" + email
     kws_msgs = []
     is_info = is_info_to_notify(changes)
     if not is_info:
         return
+    if msgs_cache is None:
+        msgs_cache = dict()
     with app.app_context():
+        if bills is None:
+            bills = Bill.find_by_leginfo_ids(get_changed_bills_ids(changes), with_text=False)
         for kw, items in changes.items():
             added, updated = items
             if not added and not updated:
                 continue
             added_msgs = ["Added bills:"]
             for id_ in added:
-                bill = Bill.find_by_leginfo_id(id_)
-                bill_subject = bill.subject
-                bill_link = status_client_url + '?bill_id=' + id_
-                bill = Bill.find_by_leginfo_id(id_)
-                bill_code = bill.code
-                added_msgs.append(bill_code + " (" + bill_subject + "). Link: " + bill_link)
+                msg = get_bill_msg(bills, msgs_cache, "added", id_)
+                if msg is not None:
+                    added_msgs.append(msg)
             updated_msgs = ["Updated bills:"]
             for bill_info in updated:
-                bill_id = bill_info.id
-                prev_last_action_name = bill_info.last_action_name
-                bill = Bill.find_by_leginfo_id(bill_id)
-                bill_subject = bill.subject
-                last_action_name = bill.last_action_name
-                bill_code = bill.code
-                bill_link = status_client_url + '?' + bill_id
-                if last_action_name:
-                    la_change = prev_last_action_name + " - " + last_action_name
-                else:
-                    la_change = prev_last_action_name
-                updated_msgs.append(bill_code + " (" + bill_subject + "). Last action change: " + la_change
-                                   + ". Link: " + bill_link)
+                msg = get_bill_msg(bills, msgs_cache, "updated", bill_info)
+                if msg is not None:
+                    updated_msgs.append(msg)
             if len(added_msgs) > 1:
                 added_msg = "\n    ".join(added_msgs)
             else:
@@ -199,7 +271,8 @@ You can unsubscribe using following link: {unsubscribe_link}
         logger.info("Email text: \n" + text)
         return text
 
-def send_email(server, from_, to, subject, msg_text=None, html_msg_text=None, type_="plain"):
+def make_email(from_, to, subject, msg_text=None, html_msg_text=None, type_="plain"):
+    # returns message as str
     msg = MIMEMultipart()
     msg.add_header('From', from_)
     msg.add_header("To", to)
@@ -208,30 +281,31 @@ def send_email(server, from_, to, subject, msg_text=None, html_msg_text=None, ty
         msg.attach(MIMEText(msg_text, "plain"))
     if type_=="html" and html_msg_text:
         msg.attach(MIMEText(html_msg_text, "html"))    
+    return msg.as_string()
+
+def send_email(server, from_, to, subject, msg_text=None, html_msg_text=None, type_="plain"):
     server.sendmail(
       from_,
       to,
-      msg.as_string().encode("utf-8"))
+      make_email(from_, to, subject, msg_text, html_msg_text, type_).encode("utf-8"))
 
-def send_changes(server, from_, to, changes):
-    logger.info("Sending email notifications")
-    msg_text = get_msg_text(changes, to)
+def get_changes_email(from_, to, changes, bills=None, msgs_cache=None):
+    '''
+    Returns email (str) about changes of bills or None if nothing changed
+    '''
+    msg_text = get_msg_text(changes, to, bills, msgs_cache)
     if not msg_text:
         logger.info("No info to notify")
         print("No info to notify")
-        return
+        return None
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     subj = f'California Bills Updates for ' + now
-    try:
-        send_email(server, from_, to, subj, msg_text)
-    except Exception:
-        logger.error(traceback.format_exc())
-        print(traceback.format_exc())
-        return traceback.format_exc()
+    return make_email(from_, to, subj, msg_text)
     
 def send_email_subs_start_notification(receiver_email, kws, time_limit, email_server, 
                                        email_acc, email_port, email_pass):
-    authed_email_server = get_auth_smtp_server(email_server, email_port, email_acc, email_pass)
+    # connection to SMTP server is taken from pool of mailer (email_server,
+    # email_port and email_pass are set in parsing_options.py)
     subject = "You have subscribed to email alerts on California Bills Monitoring App"
     kws = "Specified keywords: " + ", ".join(kws)
     time_limit = "Time limit: " + str(time_limit)
@@ -256,5 +330,6 @@ def send_email_subs_start_notification(receiver_email, kws, time_limit, email_se
 </html>
 
 """.replace("http", "https")
-    send_email(authed_email_server, email_acc, receiver_email, subject, html_msg_text=html_msg_text, type_="html")
+    msg = make_email(email_acc, receiver_email, subject, html_msg_text=html_msg_text, type_="html")
+    get_mailer().send(email_acc, receiver_email, msg)
 
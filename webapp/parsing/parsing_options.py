@@ -12,4 +12,46 @@ email_server = 'smtp.gmail.com'
 email_port = 587
 
 # current address of site, in format like http://54.180.108.54/
-site_addr = "http://54.180.108.54/"
\ No newline at end of file
+site_addr = "http://54.180.108.54/"
+# concurrent fetching of bills' pages
+# number of threads downloading bills' status and text pages (1 - no threads)
+fetch_workers = 8
+# limits of simultaneous requests to one host. Actual limit is adapted
+# between these values depending on server response times and errors
+host_concurrency_min = 1
+host_concurrency_max = 8
+# response slower than this (seconds) is treated as server overload
+host_slow_response_time = 5
+
+# number of processes parsing sessions in parallel in update_db.py
+crawl_processes = 4
+
+# table with states of sessions (open/frozen). Frozen sessions are not
+# parsed by update_db.py
+sessions_table_name = 'sessions'
+# session is frozen after full parsing, if it ended more than this number of
+# days ago (last actions are registered for some time after session's end)
+session_freeze_delay_days = 60
+
+# number of parsed bills written to db in one transaction
+db_write_batch_size = 50
+
+# on-disk cache of bills' status and text pages: conditional requests are
+# sent with ETag/Last-Modified of last response, and pages identical to
+# last fetched ones are not parsed again
+http_cache_enabled = True
+http_cache_file_name = 'http_cache.db'
+# max size of cached pages' bodies in bytes, least recently used are deleted
+http_cache_max_size = 500 * 1024 * 1024
+
+# sending of emails: number of open SMTP connections, threads sending
+# messages and max messages per second (0 - no limit)
+smtp_pool_size = 3
+email_send_workers = 3
+email_rate_limit = 5
+# failed messages are saved to db and retried after email_retry_backoff
+# seconds, every next delay is twice longer
+email_max_attempts = 5
+email_retry_backoff = 60
+# update_db.py waits for retries of failed messages not longer than this
+email_retry_max_wait = 30 * 60
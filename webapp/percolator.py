@@ -0,0 +1,135 @@
+'''
+Matching of subscriptions with elasticsearch percolator: query of every
+subscribed keyword is stored in percolator index once, and changed bills
+are matched against all keywords at once (cost depends on number of changed
+bills, not on number of subscribers)
+Time limits of subscriptions are checked in python (search_params.py):
+queries with "now" are evaluated when they're stored in percolator index,
+not when bills are matched
+'''
+import hashlib
+
+from flask import current_app
+from elasticsearch.helpers import bulk
+
+from search import (get_match_query, get_field_payload, get_search_field_mapping,
+                    INDEX_VERSION)
+
+
+# fields of bills used by keywords' queries and time limits
+PERCOLATE_FIELDS = ['title', 'subject', 'text', 'last_action_date']
+
+def create_percolator_index(index):
+    settings = {
+      "mappings": {
+        "_meta": {"version": INDEX_VERSION},
+        "properties": {
+          "query": {"type": "percolator"},
+          "keyword": {"type": "keyword"},
+          # the same types as in index of bills
+          "title": get_search_field_mapping(),
+          "subject": get_search_field_mapping(),
+          "text": get_search_field_mapping(),
+          "last_action_date": {
+            "type": "date",
+            "ignore_malformed": True
+          },
+        }
+      }
+    }
+    current_app.elasticsearch.indices.create(index=index, ignore=400, body=settings)
+
+def is_percolator_index_current(index):
+    # queries use fields of current mapping of bills (.exact subfields),
+    # they can't be stored in index with older mapping
+    mapping = current_app.elasticsearch.indices.get_mapping(index=index)
+    meta = list(mapping.values())[0]['mappings'].get('_meta', {})
+    return meta.get('version') == INDEX_VERSION
+
+def remove_outdated_percolator_index(index):
+    # index is made again from subscriptions (ensure_keyword_percolators)
+    es = current_app.elasticsearch
+    if es.indices.exists(index) and not is_percolator_index_current(index):
+        es.indices.delete(index=index, ignore=[400, 404])
+
+def get_percolator_id(keyword):
+    return hashlib.sha1(keyword.encode('utf-8')).hexdigest()
+
+def add_keyword_percolators(index, keywords):
+    '''
+    Stores queries of keywords in percolator index (existing are replaced)
+    '''
+    if not current_app.elasticsearch or not keywords:
+        return
+    remove_outdated_percolator_index(index)
+    if not current_app.elasticsearch.indices.exists(index):
+        create_percolator_index(index)
+    actions = [{"_index": index, "_id": get_percolator_id(kw),
+                "_source": {"query": get_match_query([kw]), "keyword": kw}}
+               for kw in keywords]
+    bulk(current_app.elasticsearch, actions, refresh=True)
+
+def remove_keyword_percolators(index, keywords):
+    if not current_app.elasticsearch or not keywords:
+        return
+    actions = [{"_op_type": "delete", "_index": index, "_id": get_percolator_id(kw)}
+               for kw in keywords]
+    bulk(current_app.elasticsearch, actions, refresh=True, raise_on_error=False)
+
+def ensure_keyword_percolators(index, keywords):
+    '''
+    Adds queries of keywords which aren't in percolator index (e.g. index
+    was deleted or subscriptions were imported to db)
+    '''
+    if not current_app.elasticsearch or not keywords:
+        return
+    keywords = list(keywords)
+    missing = keywords
+    # queries of all keywords are stored again in outdated index
+    remove_outdated_percolator_index(index)
+    if current_app.elasticsearch.indices.exists(index):
+        docs = current_app.elasticsearch.mget(
+            index=index, _source=False,
+            body={"ids": [get_percolator_id(kw) for kw in keywords]})['docs']
+        missing = [kw for kw, doc in zip(keywords, docs) if not doc.get('found')]
+    add_keyword_percolators(index, missing)
+
+def get_percolate_doc(model, texts=None):
+    # texts - dict {leginfo_id: text} if model was loaded without text
+    doc = {field: get_field_payload(field, getattr(model, field))
+           for field in PERCOLATE_FIELDS if field != 'text' or texts is None}
+    if texts is not None:
+        doc['text'] = get_field_payload('text', texts.get(model.leginfo_id))
+    return doc
+
+def percolate_bills(index, models, batch_size=50, max_keywords=10000, get_texts=None):
+    '''
+    Finds keywords matching bills
+    models - bills to match
+    get_texts - if given, models are loaded without text and it returns dict
+    {leginfo_id: text} of given leginfo ids, it's called for every batch,
+    so only texts of one batch are in memory
+    Returns dict {keyword: set of leginfo ids of matching bills}
+    '''
+    matched = dict()
+    if not current_app.elasticsearch:
+        return matched
+    for i in range(0, len(models), batch_size):
+        models_part = models[i:i+batch_size]
+        texts = None
+        if get_texts is not None:
+            texts = get_texts([model.leginfo_id for model in models_part])
+        body = {"query": {"percolate": {
+                    "field": "query",
+                    "documents": [get_percolate_doc(model, texts) for model in models_part]
+                }},
+                "_source": ["keyword"],
+                "size": max_keywords}
+        search = current_app.elasticsearch.search(index=index, body=body)
+        for hit in search['hits']['hits']:
+            # numbers of matching documents in batch
+            slots = hit.get('fields', {}).get('_percolator_document_slot', [0])
+            kw_matched = matched.setdefault(hit['_source']['keyword'], set())
+            for slot in slots:
+                kw_matched.add(models_part[slot].leginfo_id)
+    return matched
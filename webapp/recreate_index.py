@@ -3,4 +3,7 @@ from search import remove_index, create_index
 from init_app import app
 with app.app_context():
     remove_index("bill")
-    create_index()
\ No newline at end of file
+    create_index()
+    # percolator index is created again with the same mapping of fields
+    # before next notifications
+    remove_index(app.config['PERCOLATOR_INDEX'])
\ No newline at end of file
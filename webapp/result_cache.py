@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    '''
+    In-process LRU cache of search results with time to live of entries
+    Results depend on data generation (number of parser's runs, see
+    migrations.py), cache is cleared when generation changes. Generation is
+    read by get_generation() not more often than every check_interval seconds
+    '''
+    def __init__(self, max_entries, ttl, get_generation, check_interval):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.get_generation = get_generation
+        self.check_interval = check_interval
+        self.generation = None
+        self.checked_at = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_generation(self):
+        now = time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        generation = self.get_generation()
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+
+    def lookup(self, key):
+        '''
+        Returns cached value or None and data generation, which is passed
+        to put if value is computed after miss
+        '''
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], self.generation
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None, self.generation
+
+    def get(self, key):
+        '''
+        Returns cached value or None
+        '''
+        return self.lookup(key)[0]
+
+    def put(self, key, value, generation=None):
+        '''
+        generation - returned by lookup before value was computed, value
+        isn't cached if generation changed since (value can be computed
+        from data of older generation)
+        '''
+        with self._lock:
+            self._check_generation()
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            requests_cnt = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / requests_cnt if requests_cnt else 0,
+                    "entries": len(self._entries),
+                    "generation": self.generation}
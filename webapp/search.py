@@ -1,74 +1,331 @@
+from contextlib import contextmanager
+
 from flask import current_app
+from elasticsearch.helpers import streaming_bulk
 import traceback
 
+import search_fts
+from search_params import encode_cursor, decode_cursor
+from keyword_matcher import get_words
 
-def remove_index(index_name='bill'):
-    current_app.elasticsearch.indices.delete(index=index_name, ignore=[400, 404])
 
-def create_index(index_name='bill'):
-    created = False
-    # index settings
-    settings = {
-      "mappings": {
-        "properties": {
-          "last_action_date": {
-            "type": "date",
-            "ignore_malformed": True
-          },
-          "text": {
-            "type": "text",
-            "normalizer": "useLowercase",
-          },
+# keyword field of leginfo_id, used for sorting
+LEGINFO_ID_FIELD = "leginfo_id"
+
+# version of mapping (get_index_body). Index of bills is named
+# "<name>_v<version>" and <name> is its alias, so index with new mapping is
+# loaded while the old one is searched and then alias is switched to it
+INDEX_VERSION = 2
+
+# fields searched by keywords. Main fields have english analyzer (stemmed
+# words), keywords are searched as whole words in .exact subfields
+SEARCH_FIELDS = ['title', 'subject', 'text']
+EXACT_SUBFIELD = "exact"
+
+
+def use_fts():
+    # search backend is chosen by app config SEARCH_BACKEND, FTS5 index is
+    # updated by triggers in db, so indexing functions do nothing with it
+    return current_app.config['SEARCH_BACKEND'] == 'fts'
+
+def get_search_field_mapping():
+    # results are sorted by date, not by score, so norms aren't needed
+    return {
+      "type": "text",
+      "analyzer": "english",
+      "norms": False,
+      "fields": {
+        EXACT_SUBFIELD: {
+          "type": "text",
+          "analyzer": "standard",
+          "norms": False
         }
+      }
+    }
+
+def get_index_body():
+    properties = {field: get_search_field_mapping() for field in SEARCH_FIELDS}
+    properties.update({
+      "code": {"type": "keyword"},
+      "session": {"type": "keyword"},
+      "leginfo_id": {"type": "keyword"},
+      "house_location": {"type": "keyword"},
+      "authors": {"type": "text", "norms": False},
+      "last_action_name": {"type": "text", "norms": False},
+      "last_action_date": {
+        "type": "date",
+        "ignore_malformed": True
+      },
+      "date_published": {
+        "type": "date",
+        "ignore_malformed": True
       },
-        "analysis": {
-          "normalizer": {
-            "useLowercase": {
-              "type": "custom",
-              "filter": [ "lowercase" ]
-            }
-          }
-         }
+    })
+    return {
+      "settings": {
+        "index": {
+          # segments are sorted like search results, so sorted queries
+          # stop collecting hits early
+          "sort.field": ["last_action_date", LEGINFO_ID_FIELD],
+          "sort.order": ["desc", "asc"]
+        }
+      },
+      "mappings": {
+        "_meta": {"version": INDEX_VERSION},
+        "properties": properties
+      }
     }
+
+def get_versioned_index(index_name):
+    # index with current mapping, index_name is its alias
+    return "{}_v{}".format(index_name, INDEX_VERSION)
+
+def get_aliased_indexes(index_name):
+    '''
+    Returns list of indexes which index_name refers to: indexes of alias
+    index_name, index itself if it isn't alias (made by older version of
+    app), empty list if there is no such index
+    '''
+    es = current_app.elasticsearch
+    if es.indices.exists_alias(name=index_name):
+        return list(es.indices.get_alias(name=index_name).keys())
+    if es.indices.exists(index=index_name):
+        return [index_name]
+    return []
+
+def is_index_current(index_name='bill'):
+    # whether index_name is alias of index with current mapping
+    return get_aliased_indexes(index_name) == [get_versioned_index(index_name)]
+
+def remove_index(index_name='bill'):
+    # indexes of alias are removed with it
+    indexes = get_aliased_indexes(index_name) or [index_name]
+    current_app.elasticsearch.indices.delete(index=",".join(indexes), ignore=[400, 404])
+
+def create_versioned_index(index_name='bill'):
+    '''
+    Creates empty index with current mapping for alias index_name (index
+    left by failed reindex is removed), alias isn't changed
+    Returns name of created index
+    '''
+    versioned = get_versioned_index(index_name)
+    current_app.elasticsearch.indices.delete(index=versioned, ignore=[400, 404])
+    current_app.elasticsearch.indices.create(index=versioned, body=get_index_body())
+    return versioned
+
+def switch_alias(index_name, versioned):
+    '''
+    Points alias index_name to versioned index in one atomic request, so
+    searches don't see missing index. Previous indexes are removed
+    '''
+    es = current_app.elasticsearch
+    previous = [index for index in get_aliased_indexes(index_name) if index != versioned]
+    actions = [{"add": {"index": versioned, "alias": index_name}}]
+    for index in previous:
+        if index == index_name:
+            # index of older version has the name of alias
+            actions.append({"remove_index": {"index": index}})
+        else:
+            actions.append({"remove": {"index": index, "alias": index_name}})
+    es.indices.update_aliases(body={"actions": actions})
+    for index in previous:
+        if index != index_name:
+            es.indices.delete(index=index, ignore=[400, 404])
+
+def create_index(index_name='bill'):
+    '''
+    Creates index with current mapping behind alias index_name if there is
+    no index with this name. Index made by older version of app isn't
+    changed, reindex.py replaces it (see Bill.reindex)
+    Returns True if index_name is alias of index with current mapping
+    '''
+    created = False
+    if use_fts():
+        return created
     try:
-        if not current_app.elasticsearch.indices.exists(index_name):
-            # Ignore 400 means to ignore "Index Already Exist" error.
-            current_app.elasticsearch.indices.create(index=index_name, ignore=400, body=settings)
+        if not get_aliased_indexes(index_name):
+            versioned = create_versioned_index(index_name)
+            current_app.elasticsearch.indices.put_alias(index=versioned, name=index_name)
             print('Created Index')
-        created = True
+        created = is_index_current(index_name)
     except Exception as ex:
         print(str(ex))
     finally:
         return created
 
+def check_index(index_name='bill'):
+    '''
+    Creates index if it doesn't exist. Queries use fields of current mapping
+    (.exact subfields, keyword leginfo_id), with index of older version
+    they find nothing, so app isn't started with it
+    Raises RuntimeError if index has older mapping
+    '''
+    try:
+        indexes = get_aliased_indexes(index_name)
+    except Exception as ex:
+        # elasticsearch isn't available, it's checked when it's started
+        print("Index isn't checked: ", ex)
+        return
+    if not indexes:
+        create_index(index_name)
+    elif indexes != [get_versioned_index(index_name)]:
+        raise RuntimeError("Index {} has mapping of older version of app ({}), "
+                           "run reindex.py to replace it with {}".format(
+                               index_name, ", ".join(indexes),
+                               get_versioned_index(index_name)))
+
+@contextmanager
+def bulk_load_mode(index, max_num_segments=1):
+    '''
+    Index isn't refreshed and has no replicas while documents are loaded,
+    then settings are restored and index is force merged
+    '''
+    es = current_app.elasticsearch
+    index_settings = es.indices.get_settings(index=index)[index]['settings']['index']
+    # None resets setting to default
+    restored = {"refresh_interval": index_settings.get("refresh_interval"),
+                "number_of_replicas": index_settings.get("number_of_replicas")}
+    es.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1",
+                                                         "number_of_replicas": 0}})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=index, body={"index": restored})
+        es.indices.refresh(index=index)
+        es.indices.forcemerge(index=index, max_num_segments=max_num_segments,
+                              request_timeout=3600)
+
+def get_field_payload(field, value):
+    if value == "" and field == "date_published":
+        return None
+    if field == "text":
+        return value.lower()
+    return value
+
+def get_index_payload(model):
+    payload = {}
+    for field in model.__searchable__:
+        payload[field] = get_field_payload(field, getattr(model, field))
+    return payload
+
 def add_to_index(index, model):
     try:
+        if use_fts():
+            return
         if not current_app.elasticsearch:
             print("not current_app.elasticsearch")
             return
-        payload = {}
-        for field in model.__searchable__:
-            payload[field] = getattr(model, field)
-            if payload[field] == "" and field == "date_published":
-                payload[field] = None
-            if field == "text":
-                payload[field] = payload[field].lower()
+        payload = get_index_payload(model)
         current_app.elasticsearch.index(index=index, id=model.id,
                                         body=payload)
     except:
         traceback.print_exc()
 
-def remove_from_index(index, model):
+def bulk_index(index, models):
+    '''
+    Indexes models with elasticsearch _bulk API. Requests are split by number
+    of documents and by size (app config ELASTICSEARCH_BULK_CHUNK_SIZE and
+    ELASTICSEARCH_BULK_MAX_BYTES), documents rejected because of full
+    elasticsearch queue are retried ELASTICSEARCH_BULK_MAX_RETRIES times
+    models - iterable of models, read lazily
+    Returns report - dict with numbers of indexed, failed (rejected by
+    elasticsearch) and skipped (payload wasn't made) documents
+    '''
+    report = {"indexed": 0, "failed": 0, "skipped": 0}
+    if use_fts():
+        return report
     if not current_app.elasticsearch:
+        print("not current_app.elasticsearch")
+        return report
+
+    def get_actions():
+        for model in models:
+            try:
+                payload = get_index_payload(model)
+            except:
+                traceback.print_exc()
+                report["skipped"] += 1
+                continue
+            yield {"_index": index, "_id": model.id, "_source": payload}
+
+    for ok, item in run_bulk(get_actions()):
+        if ok:
+            report["indexed"] += 1
+        else:
+            report["failed"] += 1
+            print("Indexing failed: ", item)
+    return report
+
+def bulk_update(index, updates, searchable):
+    '''
+    Updates only given fields of documents with _bulk API (partial updates,
+    other fields of documents are kept)
+    updates - iterable of (id, dict of changed fields), fields not in
+    searchable are ignored
+    Returns report - dict with numbers of updated and failed documents and
+    list of ids of documents which weren't found in index ("missing")
+    '''
+    report = {"updated": 0, "failed": 0, "missing": []}
+    if use_fts():
+        return report
+    if not current_app.elasticsearch:
+        print("not current_app.elasticsearch")
+        return report
+
+    def get_actions():
+        for id, fields in updates:
+            doc = {field: get_field_payload(field, value)
+                   for field, value in fields.items() if field in searchable}
+            if doc:
+                yield {"_op_type": "update", "_index": index, "_id": id, "doc": doc}
+
+    for ok, item in run_bulk(get_actions()):
+        if ok:
+            report["updated"] += 1
+        elif item.get("update", {}).get("status") == 404:
+            report["missing"].append(int(item["update"]["_id"]))
+        else:
+            report["failed"] += 1
+            print("Updating failed: ", item)
+    return report
+
+def run_bulk(actions):
+    # requests are split by number of documents and by size, documents
+    # rejected because of full elasticsearch queue are retried
+    config = current_app.config
+    return streaming_bulk(current_app.elasticsearch, actions,
+                          chunk_size=config["ELASTICSEARCH_BULK_CHUNK_SIZE"],
+                          max_chunk_bytes=config["ELASTICSEARCH_BULK_MAX_BYTES"],
+                          max_retries=config["ELASTICSEARCH_BULK_MAX_RETRIES"],
+                          raise_on_error=False, raise_on_exception=False)
+
+def remove_from_index(index, model):
+    if use_fts() or not current_app.elasticsearch:
         return
     current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+
+def bulk_remove(index, ids):
+    '''
+    Deletes documents by ids with _bulk API (missing documents are skipped)
+    Returns report - dict with numbers of removed and failed documents
+    '''
+    report = {"removed": 0, "failed": 0}
+    if use_fts() or not current_app.elasticsearch:
+        return report
+    actions = ({"_op_type": "delete", "_index": index, "_id": id_} for id_ in ids)
+    for ok, item in run_bulk(actions):
+        if ok or item.get("delete", {}).get("status") == 404:
+            report["removed"] += 1
+        else:
+            report["failed"] += 1
+            print("Removing failed: ", item)
+    return report
     
-def make_query(index, query_params, page, per_page, time_limit="1y", returned_val="id"):
-    # returned_val - str "id" (id from DB and elasticsearch) or "leginfo_id"
-    if not current_app.elasticsearch:
-        return [], 0
-    
-    search_field = ['title', 'subject', 'text']
+def get_match_query(query_params):
+    '''
+    Query of bills matching any of query_params (without time filter)
+    '''
+    search_field = [field + "." + EXACT_SUBFIELD for field in SEARCH_FIELDS]
     
     search_conditions = []
     
@@ -90,11 +347,14 @@ def make_query(index, query_params, page, per_page, time_limit="1y", returned_va
                 search_conditions.append(search_condition)
     '''
     
-    # multi-word fuzzy (words not necessary abjacent)
+    # multi-word fuzzy (words not necessary abjacent). Terms of fuzzy query
+    # aren't analyzed, keyword is split into lowercase words the same way as
+    # by keyword_matcher.py (e.g. "covid-19" is "covid" and "19")
     for param in query_params:
-        if len(param.split(" ")) > 1:
+        words = get_words(param)
+        if len(words) > 1:
             shoulds = []
-            for term in param.split(" "):
+            for term in words:
                 conditions = [{'fuzzy': {field: {"value": term, "fuzziness": "0"}}} for field in search_field]
                 shoulds.append(conditions)
             must = [{'bool': {"minimum_should_match": "1", 'should': should}} for should in shoulds]
@@ -102,37 +362,126 @@ def make_query(index, query_params, page, per_page, time_limit="1y", returned_va
             search_conditions.append(search_condition)
         else:
             for field in search_field:
-                search_condition = {'fuzzy': {field: {"value": param, "fuzziness": "0"}}}
-                search_conditions.append(search_condition)
+                for term in words:
+                    search_condition = {'fuzzy': {field: {"value": term, "fuzziness": "0"}}}
+                    search_conditions.append(search_condition)
                 
     print(search_conditions)
-    
+    return {'bool': {
+                "minimum_should_match": "1",
+                'should': [search_conditions]
+            }}
+
+def get_search_body(query_params, time_limit="1y", leginfo_ids=None):
+    '''
+    Query (without paging) of bills matching any of query_params
+    leginfo_ids - if given, only these bills are searched
+    '''
     time_lim_q = "now-" + str(time_limit)
-    search = current_app.elasticsearch.search(
-        index = index, 
-        body ={'query': {
-                'bool': {
-                    "minimum_should_match": "1",
-                    'should': [search_conditions],
-                    "filter" : [
-                      { "range" : { "last_action_date" : { "gte" : time_lim_q}}}
-                    ]
-                },
-              },
-              'from': (page - 1) * per_page, 
-              'size': per_page,
-              'sort': [{
-                 'last_action_date': {
-                    'order': 'desc'
-                     }
-                 }]
-               })
+    filters = [{ "range" : { "last_action_date" : { "gte" : time_lim_q}}}]
+    if leginfo_ids is not None:
+        filters.append({"terms": {LEGINFO_ID_FIELD: list(leginfo_ids)}})
+    query = get_match_query(query_params)
+    query['bool']['filter'] = filters
+    return {'query': query,
+            # leginfo_id is tiebreaker for bills with the same date, so
+            # order is stable between pages
+            'sort': [{
+               'last_action_date': {
+                  'order': 'desc'
+                   }
+               }, {
+               LEGINFO_ID_FIELD: {
+                  'order': 'asc'
+                   }
+               }]
+           }
+
+def get_source_param(returned_val, source_fields=None):
+    # only needed fields of documents are got from elasticsearch
+    if returned_val == "source":
+        return source_fields
+    elif returned_val == "leginfo_id":
+        return ["leginfo_id"]
+    return False
+
+def get_hits_vals(hits, returned_val):
     vals = []
     if returned_val == "id":
-        vals = [int(hit['_id']) for hit in search['hits']['hits']]
+        vals = [int(hit['_id']) for hit in hits]
     elif returned_val == "leginfo_id":
-        vals = [hit['_source']["leginfo_id"] for hit in search['hits']['hits']]
-    return vals, search['hits']['total']['value']
+        vals = [hit['_source']["leginfo_id"] for hit in hits]
+    elif returned_val == "source":
+        vals = [dict(hit['_source'], id=int(hit['_id'])) for hit in hits]
+    return vals
+
+def make_query(index, query_params, page, per_page, time_limit="1y", returned_val="id",
+               source_fields=None):
+    # returned_val - str "id" (id from DB and elasticsearch), "leginfo_id" or
+    # "source" (dicts with source_fields of documents and "id")
+    # pages are got with from/size, use make_cursor_query for deep pages
+    if use_fts():
+        return search_fts.make_query(index, query_params, page, per_page, time_limit,
+                                     returned_val, source_fields)
+    if not current_app.elasticsearch:
+        return [], 0
+
+    body = get_search_body(query_params, time_limit)
+    body['from'] = (page - 1) * per_page
+    body['size'] = per_page
+    body['_source'] = get_source_param(returned_val, source_fields)
+    search = current_app.elasticsearch.search(index=index, body=body)
+    return get_hits_vals(search['hits']['hits'], returned_val), \
+           search['hits']['total']['value']
+
+def make_cursor_query(index, query_params, per_page, time_limit="1y", cursor=None,
+                      returned_val="id", source_fields=None):
+    '''
+    Gets page of results after cursor with search_after, cost of deep pages
+    is the same as of the first one
+    cursor - str from previous call, None for the first page
+    Returns values (see make_query), total number of results and cursor of
+    next page (None if it's the last page)
+    '''
+    if use_fts():
+        return search_fts.make_cursor_query(index, query_params, per_page, time_limit,
+                                            cursor, returned_val, source_fields)
+    if not current_app.elasticsearch:
+        return [], 0, None
+
+    body = get_search_body(query_params, time_limit)
+    body['size'] = per_page
+    body['_source'] = get_source_param(returned_val, source_fields)
+    if cursor:
+        # date is sorted as epoch millis
+        body['search_after'] = decode_cursor(cursor, [int, str])
+    search = current_app.elasticsearch.search(index=index, body=body)
+    hits = search['hits']['hits']
+    next_cursor = None
+    if len(hits) == per_page:
+        next_cursor = encode_cursor(hits[-1]['sort'])
+    return get_hits_vals(hits, returned_val), search['hits']['total']['value'], next_cursor
+
+def match_bills(index, query_params, leginfo_ids, time_limit="1y", batch_size=5000):
+    '''
+    Finds which of given bills match query, only these bills are searched,
+    so time depends on number of bills, not on size of index
+    Returns set of leginfo ids of matching bills
+    '''
+    if use_fts():
+        return search_fts.match_bills(index, query_params, leginfo_ids, time_limit)
+    leginfo_ids = list(leginfo_ids)
+    matched = set()
+    if not current_app.elasticsearch:
+        return matched
+    for i in range(0, len(leginfo_ids), batch_size):
+        ids_part = leginfo_ids[i:i+batch_size]
+        body = get_search_body(query_params, time_limit, ids_part)
+        body['size'] = len(ids_part)
+        body['_source'] = get_source_param("leginfo_id")
+        search = current_app.elasticsearch.search(index=index, body=body)
+        matched.update(get_hits_vals(search['hits']['hits'], "leginfo_id"))
+    return matched
 
 """
 from init_app import app
@@ -0,0 +1,225 @@
+'''
+Search backend with SQLite FTS5 index in bills.db, used instead of
+elasticsearch when app config SEARCH_BACKEND is "fts" (see search.py).
+Index is external content table of bills: it keeps only terms, triggers
+update it when bills are written, so crawler and web app don't index bills
+themselves. Queries have the same meaning as elasticsearch ones: bill
+matches keyword if all words of keyword are in any of title, subject and
+text, results are filtered by last_action_date and sorted by date
+'''
+import datetime
+
+from sqlalchemy import text
+
+from init_app import db
+from parsing.parsing_options import table_name
+from keyword_matcher import get_words
+from search_params import get_time_limit_start, encode_cursor, decode_cursor
+
+
+FTS_TABLE_SUFFIX = "_fts"
+FTS_FIELDS = ['title', 'subject', 'text']
+# letters with diacritics aren't folded, the same as in elasticsearch and
+# keyword_matcher.py
+FTS_TOKENIZE = "unicode61 remove_diacritics 0"
+
+# tables of elasticsearch indexes (name of index is given to search functions)
+INDEX_TABLES = {'bill': table_name}
+
+
+def get_table(index):
+    return INDEX_TABLES.get(index, index)
+
+def get_fts_table(table):
+    return table + FTS_TABLE_SUFFIX
+
+def create_fts_index(conn, table):
+    '''
+    Creates FTS5 table and triggers for table (if they don't exist or table
+    has other tokenizer), new FTS5 table is filled with existing rows
+    conn - sqlite3 connection
+    Returns True if index was created
+    '''
+    fts_table = get_fts_table(table)
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name=?",
+                       (fts_table,)).fetchone()
+    if row is not None:
+        if FTS_TOKENIZE in row[0]:
+            return False
+        drop_fts_index(conn, table)
+    fields = ', '.join(FTS_FIELDS)
+    new_fields = ', '.join('new.' + field for field in FTS_FIELDS)
+    old_fields = ', '.join('old.' + field for field in FTS_FIELDS)
+    with conn:
+        conn.execute('''CREATE VIRTUAL TABLE {0} USING fts5({1},
+                        content='{2}', content_rowid='id', tokenize='{3}')'''.format(
+                            fts_table, fields, table, FTS_TOKENIZE))
+        conn.execute('''CREATE TRIGGER {0}_ai AFTER INSERT ON {1} BEGIN
+                          INSERT INTO {0} (rowid, {2}) VALUES (new.id, {3});
+                        END'''.format(fts_table, table, fields, new_fields))
+        conn.execute('''CREATE TRIGGER {0}_ad AFTER DELETE ON {1} BEGIN
+                          INSERT INTO {0} ({0}, rowid, {2}) VALUES ('delete', old.id, {3});
+                        END'''.format(fts_table, table, fields, old_fields))
+        # only updates of searched fields change index
+        conn.execute('''CREATE TRIGGER {0}_au AFTER UPDATE OF {2} ON {1} BEGIN
+                          INSERT INTO {0} ({0}, rowid, {2}) VALUES ('delete', old.id, {4});
+                          INSERT INTO {0} (rowid, {2}) VALUES (new.id, {3});
+                        END'''.format(fts_table, table, fields, new_fields, old_fields))
+        conn.execute("INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts_table))
+    return True
+
+def drop_fts_index(conn, table):
+    '''
+    Removes FTS5 table and triggers of table if they exist (when
+    elasticsearch is used, bills are written without updating FTS5 index)
+    Returns True if index was removed
+    '''
+    fts_table = get_fts_table(table)
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name=? OR tbl_name=?",
+                          (fts_table, fts_table)).fetchone()
+    if not exists:
+        return False
+    with conn:
+        for suffix in ('_ai', '_ad', '_au'):
+            conn.execute('DROP TRIGGER IF EXISTS ' + fts_table + suffix)
+        conn.execute('DROP TABLE IF EXISTS ' + fts_table)
+    return True
+
+def rebuild_fts_index(index):
+    # index is made again from table (e.g. after bills were changed without
+    # triggers)
+    fts_table = get_fts_table(get_table(index))
+    db.session.execute(text("INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts_table)))
+    db.session.commit()
+
+def quote_term(term):
+    # term is searched as string, not as FTS5 query syntax
+    return '"' + term.replace('"', '""') + '"'
+
+def get_match_expr(query_params):
+    '''
+    FTS5 query of bills matching any of query_params, all words of param
+    must be in bill (in any of indexed fields). Words are got like in
+    keyword_matcher.py
+    '''
+    conditions = []
+    for param in query_params:
+        terms = [quote_term(term) for term in get_words(param)]
+        if terms:
+            conditions.append('(' + ' AND '.join(terms) + ')')
+    return ' OR '.join(conditions)
+
+def get_min_date(time_limit):
+    '''
+    Returns str date of the oldest last_action_date in time limit (the same
+    bills as with "now-<time_limit>" in elasticsearch)
+    '''
+    start = get_time_limit_start(str(time_limit))
+    start_date = start.date()
+    if start.time() != datetime.time():
+        # dates are midnights, so date of start is before it
+        start_date += datetime.timedelta(days=1)
+    return start_date.isoformat()
+
+def get_search_query(index, query_params, time_limit, columns, leginfo_ids=None):
+    '''
+    Returns (sql without ORDER BY and LIMIT, params)
+    columns - columns of bills table to select
+    '''
+    table = get_table(index)
+    fts_table = get_fts_table(table)
+    params = {"match": get_match_expr(query_params),
+              "min_date": get_min_date(time_limit)}
+    q = '''SELECT {} FROM {} f JOIN {} b ON b.id = f.rowid
+           WHERE {} MATCH :match AND b.last_action_date >= :min_date
+           AND b.last_action_date GLOB '[0-9][0-9][0-9][0-9]-*'
+        '''.format(', '.join('b.' + column for column in columns), fts_table,
+                   table, fts_table)
+    if leginfo_ids is not None:
+        names = []
+        for i, leginfo_id in enumerate(leginfo_ids):
+            names.append(":id" + str(i))
+            params["id" + str(i)] = leginfo_id
+        q += ' AND b.leginfo_id IN ({})'.format(', '.join(names))
+    return q, params
+
+def get_columns(returned_val, source_fields=None):
+    # the last two columns are sort values
+    if returned_val == "source":
+        fields = [field for field in source_fields
+                  if field not in ('id', 'last_action_date', 'leginfo_id')]
+        return ['id'] + fields + ['last_action_date', 'leginfo_id']
+    return ['id', 'last_action_date', 'leginfo_id']
+
+def get_rows_vals(rows, columns, returned_val, source_fields=None):
+    if returned_val == "id":
+        return [row[0] for row in rows]
+    if returned_val == "leginfo_id":
+        return [row[-1] for row in rows]
+    returned_fields = ['id'] + list(source_fields)
+    return [{field: value for field, value in zip(columns, row)
+             if field in returned_fields} for row in rows]
+
+def count_results(index, query_params, time_limit):
+    q, params = get_search_query(index, query_params, time_limit, ['id'])
+    return db.session.execute(text('SELECT COUNT(*) FROM (' + q + ')'), params).scalar()
+
+def make_query(index, query_params, page, per_page, time_limit="1y", returned_val="id",
+               source_fields=None):
+    # see search.make_query
+    if not get_match_expr(query_params):
+        return [], 0
+    columns = get_columns(returned_val, source_fields)
+    q, params = get_search_query(index, query_params, time_limit, columns)
+    q += ' ORDER BY b.last_action_date DESC, b.leginfo_id ASC LIMIT :limit OFFSET :offset'
+    params.update(limit=per_page, offset=(page - 1) * per_page)
+    rows = db.session.execute(text(q), params).fetchall()
+    return get_rows_vals(rows, columns, returned_val, source_fields), \
+           count_results(index, query_params, time_limit)
+
+def make_cursor_query(index, query_params, per_page, time_limit="1y", cursor=None,
+                      returned_val="id", source_fields=None):
+    '''
+    See search.make_cursor_query, cursor is (last_action_date, leginfo_id)
+    of the last bill of previous page
+    '''
+    if not get_match_expr(query_params):
+        return [], 0, None
+    columns = get_columns(returned_val, source_fields)
+    q, params = get_search_query(index, query_params, time_limit, columns)
+    if cursor:
+        params["cursor_date"], params["cursor_id"] = decode_cursor(cursor, [str, str])
+        q += ''' AND (b.last_action_date < :cursor_date OR
+                      (b.last_action_date = :cursor_date AND b.leginfo_id > :cursor_id))'''
+    q += ' ORDER BY b.last_action_date DESC, b.leginfo_id ASC LIMIT :limit'
+    params["limit"] = per_page
+    rows = db.session.execute(text(q), params).fetchall()
+    next_cursor = None
+    if len(rows) == per_page:
+        next_cursor = encode_cursor([rows[-1][-2], rows[-1][-1]])
+    return get_rows_vals(rows, columns, returned_val, source_fields), \
+           count_results(index, query_params, time_limit), next_cursor
+
+def match_bills(index, query_params, leginfo_ids, time_limit="1y", batch_size=500):
+    # see search.match_bills, number of ids in one query is limited by sqlite
+    leginfo_ids = list(leginfo_ids)
+    matched = set()
+    if not get_match_expr(query_params):
+        return matched
+    for i in range(0, len(leginfo_ids), batch_size):
+        q, params = get_search_query(index, query_params, time_limit, ['leginfo_id'],
+                                     leginfo_ids[i:i+batch_size])
+        matched.update(row[0] for row in db.session.execute(text(q), params))
+    return matched
+
+def get_index_size(index):
+    '''
+    Returns size in bytes of FTS5 table and its shadow tables
+    (None if sqlite is built without dbstat)
+    '''
+    fts_table = get_fts_table(get_table(index))
+    try:
+        return db.session.execute(text("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE :name"),
+                                  {"name": fts_table + "%"}).scalar()
+    except Exception:
+        return None
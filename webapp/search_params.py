@@ -0,0 +1,74 @@
+'''
+Parameters of search queries shared by search backends (search.py,
+search_fts.py) and notifications: time limits like "1y" and cursors of
+pages of results
+'''
+import re
+import json
+import base64
+import datetime
+
+
+time_limit_regex = re.compile(r'^(\d+)([yMwd])$')
+
+
+def get_time_limit_start(time_limit, now=None):
+    '''
+    Returns datetime of start of time limit like "1y", "6M" (the same as
+    "now-<time_limit>" in elasticsearch)
+    Raises ValueError if time limit is in unknown format
+    '''
+    if now is None:
+        now = datetime.datetime.utcnow()
+    parsed = time_limit_regex.match(time_limit.strip())
+    if not parsed:
+        raise ValueError("Unknown time limit: " + time_limit)
+    num, unit = int(parsed.group(1)), parsed.group(2)
+    if unit == 'w':
+        return now - datetime.timedelta(weeks=num)
+    if unit == 'd':
+        return now - datetime.timedelta(days=num)
+    months = num * 12 if unit == 'y' else num
+    year = now.year + (now.month - 1 - months) // 12
+    month = (now.month - 1 - months) % 12 + 1
+    # the last day of month if there is no such day (e.g. 29 Feb)
+    day = now.day
+    while True:
+        try:
+            return now.replace(year=year, month=month, day=day)
+        except ValueError:
+            day -= 1
+
+def is_in_time_limit(last_action_date, time_limit_start):
+    # last_action_date - str like 2020-03-31 or None
+    if not last_action_date:
+        return False
+    try:
+        date = datetime.datetime.strptime(last_action_date, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return date >= time_limit_start
+
+def encode_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')).decode('ascii')
+
+def is_sort_value(value, value_type):
+    # bool is int in python, but it's not valid date or id
+    return isinstance(value, value_type) and not isinstance(value, bool)
+
+def decode_cursor(cursor, value_types):
+    '''
+    Returns list of sort values of last bill of previous page
+    value_types - type (or tuple of types) of value of every sort key, e.g.
+    [str, int] for (last_action_date, id)
+    Raises ValueError if cursor is invalid
+    '''
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor: " + cursor)
+    if not isinstance(sort_values, list) or len(sort_values) != len(value_types) or \
+       not all(is_sort_value(value, value_type)
+               for value, value_type in zip(sort_values, value_types)):
+        raise ValueError("Invalid cursor: " + cursor)
+    return sort_values
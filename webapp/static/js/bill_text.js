@@ -0,0 +1,29 @@
+// Text of bill is loaded when its modal is opened for the first time
+$(document).on('show.bs.modal', '.modal', function () {
+	var textElem = this.querySelector('.bill-text');
+	if (!textElem || textElem.dataset.loaded) {
+		return;
+	}
+	textElem.dataset.loaded = 'true';
+	fetch(textElem.dataset.textUrl)
+		.then(function (response) {
+			if (!response.ok) {
+				throw new Error(response.status);
+			}
+			return response.json();
+		})
+		.then(function (bill) {
+			// line breaks are shown like on bill's page, text isn't parsed as html
+			textElem.textContent = '';
+			bill.text.split('\n').forEach(function (line, i) {
+				if (i > 0) {
+					textElem.appendChild(document.createElement('br'));
+				}
+				textElem.appendChild(document.createTextNode(line));
+			});
+		})
+		.catch(function () {
+			delete textElem.dataset.loaded;
+			textElem.textContent = 'Failed to load text';
+		});
+});
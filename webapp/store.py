@@ -0,0 +1,192 @@
+'''
+Keywords of monitoring page and email subscriptions in db tables
+(created by db migrations). Every change is one transaction, so concurrent
+requests don't overwrite changes of each other
+'''
+import os
+import sqlite3
+import datetime
+
+from init_app import db_file_name
+
+# files of keywords and subscriptions of older versions of app, imported by
+# db migration
+KEYWORDS_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'keywords.txt')
+SUBSCRIPTIONS_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'subscribed_emails.txt')
+
+
+def connect():
+    conn = sqlite3.connect(db_file_name, timeout=60)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+def get_keywords():
+    conn = connect()
+    try:
+        return [row[0] for row in conn.execute('SELECT keyword FROM keywords ORDER BY id')]
+    finally:
+        conn.close()
+
+def add_keyword(keyword):
+    '''
+    Returns True if keyword is new (bills must be scanned for it, see
+    keyword_matcher.py)
+    '''
+    conn = connect()
+    try:
+        with conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO keywords (keyword) VALUES (?)',
+                                  (keyword,))
+            return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+def delete_keyword(keyword):
+    conn = connect()
+    try:
+        with conn:
+            conn.execute('DELETE FROM keywords WHERE keyword=?', (keyword,))
+            conn.execute('DELETE FROM bill_keyword_matches WHERE keyword=?', (keyword,))
+    finally:
+        conn.close()
+
+def get_unmatched_keywords():
+    # keywords which bills weren't scanned for yet
+    conn = connect()
+    try:
+        return [row[0] for row in conn.execute('SELECT keyword FROM keywords WHERE matched=0')]
+    finally:
+        conn.close()
+
+def get_subscriptions():
+    '''
+    Returns list of (email, list of keywords, time limit)
+    '''
+    conn = connect()
+    try:
+        subscriptions = dict()
+        q = '''SELECT s.email, s.time_limit, k.keyword FROM subscriptions s
+               LEFT JOIN subscription_keywords k ON k.subscription_id = s.id
+               ORDER BY s.id, k.position'''
+        for email, time_limit, keyword in conn.execute(q):
+            kws = subscriptions.setdefault((email, time_limit), [])
+            if keyword is not None:
+                kws.append(keyword)
+        return [(email, kws, time_limit) for (email, time_limit), kws in subscriptions.items()]
+    finally:
+        conn.close()
+
+def get_subscribed_keywords(email=None, conn=None):
+    # keywords of all subscriptions or of one email
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    try:
+        if email is None:
+            rows = conn.execute('SELECT DISTINCT keyword FROM subscription_keywords')
+        else:
+            rows = conn.execute('''SELECT k.keyword FROM subscription_keywords k
+                                   JOIN subscriptions s ON s.id = k.subscription_id
+                                   WHERE s.email=?''', (email,))
+        return {row[0] for row in rows}
+    finally:
+        if own_conn:
+            conn.close()
+
+def get_unused_keywords(keywords, conn):
+    # keywords which aren't in any subscription
+    return {kw for kw in keywords
+            if conn.execute('SELECT 1 FROM subscription_keywords WHERE keyword=? LIMIT 1',
+                            (kw,)).fetchone() is None}
+
+def _delete_subscription(conn, email):
+    # keywords are deleted explicitly, connection of db migration has no
+    # foreign keys enabled
+    conn.execute('''DELETE FROM subscription_keywords WHERE subscription_id IN
+                    (SELECT id FROM subscriptions WHERE email=?)''', (email,))
+    conn.execute('DELETE FROM subscriptions WHERE email=?', (email,))
+
+def _add_subscription(conn, email, keywords, time_limit):
+    # replaces subscription of email in transaction of caller
+    _delete_subscription(conn, email)
+    cursor = conn.execute('''INSERT INTO subscriptions (email, time_limit, created_at)
+                             VALUES (?, ?, ?)''',
+                          (email, time_limit, datetime.datetime.now().isoformat()))
+    conn.executemany('''INSERT OR IGNORE INTO subscription_keywords
+                        (subscription_id, keyword, position) VALUES (?, ?, ?)''',
+                     [(cursor.lastrowid, kw, i) for i, kw in enumerate(keywords)])
+
+def subscribe(email, keywords, time_limit):
+    '''
+    Creates or replaces subscription of email
+    Returns set of keywords which aren't subscribed anymore (keywords of
+    replaced subscription)
+    '''
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old_kws = get_subscribed_keywords(email, conn)
+            _add_subscription(conn, email, keywords, time_limit)
+            unused_kws = get_unused_keywords(old_kws, conn)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return unused_kws
+    finally:
+        conn.close()
+
+def unsubscribe(email):
+    '''
+    Returns set of keywords which aren't subscribed anymore
+    '''
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old_kws = get_subscribed_keywords(email, conn)
+            _delete_subscription(conn, email)
+            unused_kws = get_unused_keywords(old_kws, conn)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return unused_kws
+    finally:
+        conn.close()
+
+def import_keywords_file(conn, file_name):
+    '''
+    Adds keywords from file (one per line) in transaction of caller,
+    keywords are lowercased like the ones added by monitoring page
+    Returns number of keywords in file
+    '''
+    with open(file_name, 'r') as f:
+        kws = [kw.strip().lower() for kw in f.read().splitlines() if kw.strip()]
+    conn.executemany('INSERT OR IGNORE INTO keywords (keyword) VALUES (?)',
+                     [(kw,) for kw in kws])
+    return len(kws)
+
+def import_subscriptions_file(conn, file_name):
+    '''
+    Adds subscriptions from file (lines like email:keyword1,keyword2:time_limit)
+    in transaction of caller, existing subscriptions of the same emails are
+    replaced
+    Returns number of imported subscriptions
+    '''
+    imported_cnt = 0
+    with open(file_name, 'r') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    for line in lines:
+        try:
+            email, kws, time_limit = line.split(":")
+        except ValueError:
+            print("Skipped line: " + line)
+            continue
+        kws = [kw.strip() for kw in kws.split(",") if kw.strip()]
+        _add_subscription(conn, email.strip(), kws, time_limit.strip())
+        imported_cnt += 1
+    return imported_cnt
@@ -0,0 +1,35 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+# modules of app are imported from webapp directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import store
+from migrations import migrate
+
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    '''
+    Path of bills.db with the latest schema (keywords.txt and
+    subscribed_emails.txt of webapp aren't imported)
+    '''
+    monkeypatch.setattr(store, "KEYWORDS_FILE_NAME", str(tmp_path / "keywords.txt"))
+    monkeypatch.setattr(store, "SUBSCRIPTIONS_FILE_NAME",
+                        str(tmp_path / "subscribed_emails.txt"))
+    path = str(tmp_path / "bills.db")
+    conn = sqlite3.connect(path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    return path
+
+@pytest.fixture
+def conn(db_file):
+    conn = sqlite3.connect(db_file)
+    yield conn
+    conn.close()
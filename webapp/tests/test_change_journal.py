@@ -0,0 +1,50 @@
+from parsing import change_journal
+from parsing.change_journal import (CHANGE_ADDED, CHANGE_UPDATED, start_crawl_run,
+                                    finish_crawl_run, add_bill_changes,
+                                    get_undelivered_changes, mark_changes_delivered)
+
+
+def add_run(conn, changes, finished=True):
+    run_id = start_crawl_run(conn)
+    with conn:
+        add_bill_changes(conn, run_id, changes)
+    if finished:
+        finish_crawl_run(conn, run_id)
+    return run_id
+
+def test_no_runs_to_deliver(conn):
+    assert get_undelivered_changes(conn) == (None, [], [])
+
+def test_changes_of_runs_are_merged(conn):
+    add_run(conn, [("B1", CHANGE_ADDED, None),
+                   ("B2", CHANGE_UPDATED, "Introduced")])
+    last_run_id = add_run(conn, [("B1", CHANGE_UPDATED, "Introduced"),
+                                 ("B2", CHANGE_UPDATED, "In committee"),
+                                 ("B3", CHANGE_UPDATED, "Chaptered")])
+    run_id, added, updated = get_undelivered_changes(conn)
+    assert run_id == last_run_id
+    # added and then updated bill is added, updated bill has last action
+    # from before its first update
+    assert added == ["B1"]
+    assert updated == [("B2", "Introduced"), ("B3", "Chaptered")]
+
+def test_delivered_runs_are_skipped(conn):
+    first_run_id = add_run(conn, [("B1", CHANGE_ADDED, None)])
+    mark_changes_delivered(conn, first_run_id)
+    last_run_id = add_run(conn, [("B2", CHANGE_ADDED, None)])
+    assert get_undelivered_changes(conn) == (last_run_id, ["B2"], [])
+    mark_changes_delivered(conn, last_run_id)
+    assert change_journal.get_delivered_run_id(conn) == last_run_id
+    assert get_undelivered_changes(conn) == (None, [], [])
+
+def test_changes_of_crashed_run_are_sent_after_next_run(conn):
+    add_run(conn, [("B1", CHANGE_ADDED, None)], finished=False)
+    # unfinished run isn't delivered while it may be running
+    assert get_undelivered_changes(conn) == (None, [], [])
+    last_run_id = add_run(conn, [("B2", CHANGE_UPDATED, "Introduced")])
+    assert get_undelivered_changes(conn) == (last_run_id, ["B1"], [("B2", "Introduced")])
+
+def test_unfinished_run_after_finished_one_is_kept(conn):
+    finished_run_id = add_run(conn, [("B1", CHANGE_ADDED, None)])
+    add_run(conn, [("B2", CHANGE_ADDED, None)], finished=False)
+    assert get_undelivered_changes(conn) == (finished_run_id, ["B1"], [])
@@ -0,0 +1,62 @@
+import pytest
+
+from parsing import db_writer
+from parsing.db_writer import BillsWriter
+
+
+def get_bills(conn):
+    q = 'SELECT leginfo_id, title, text FROM bills ORDER BY leginfo_id'
+    return conn.execute(q).fetchall()
+
+@pytest.fixture(params=[True, False], ids=["upsert", "update_insert"])
+def upsert_supported(request, monkeypatch):
+    # old sqlite without ON CONFLICT DO UPDATE is emulated
+    monkeypatch.setattr(db_writer, "UPSERT_SUPPORTED", request.param)
+    return request.param
+
+def test_bills_are_inserted_and_updated_by_leginfo_id(conn, upsert_supported):
+    writer = BillsWriter(conn, 'bills', 10)
+    writer.add({"leginfo_id": "B1", "title": "First", "text": "text 1"})
+    writer.add({"leginfo_id": "B2", "title": "Second", "text": "text 2"})
+    writer.flush()
+    # only changed fields of existing bill are written
+    writer.add({"leginfo_id": "B1", "title": "First changed"})
+    writer.add({"leginfo_id": "B3", "title": "Third", "text": "text 3"})
+    writer.flush()
+    assert get_bills(conn) == [("B1", "First changed", "text 1"),
+                               ("B2", "Second", "text 2"),
+                               ("B3", "Third", "text 3")]
+    assert writer.written_cnt == 4
+
+def test_batch_is_written_when_full(conn, upsert_supported):
+    flushed = []
+    writer = BillsWriter(conn, 'bills', 2, on_flush=flushed.append)
+    writer.add({"leginfo_id": "B1", "title": "First"}, "change 1")
+    assert flushed == [] and get_bills(conn) == []
+    writer.add({"leginfo_id": "B2", "title": "Second"}, "change 2")
+    assert [change for batch in flushed for _, change in batch] == ["change 1", "change 2"]
+    assert len(get_bills(conn)) == 2
+
+def test_bad_bill_doesnt_stop_others(conn, upsert_supported):
+    flushed = []
+    written_in_transaction = []
+    writer = BillsWriter(conn, 'bills', 10, on_flush=flushed.extend,
+                         on_write=lambda conn, bills: written_in_transaction.extend(bills))
+    writer.add({"leginfo_id": "B1", "title": "First"})
+    writer.add({"leginfo_id": "B2", "no_such_column": "value"})
+    writer.add({"leginfo_id": "B3", "title": "Third"})
+    writer.flush()
+    assert get_bills(conn) == [("B1", "First", None), ("B3", "Third", None)]
+    assert [bill["leginfo_id"] for bill, _ in flushed] == ["B1", "B3"]
+    assert writer.written_cnt == 2
+
+def test_on_write_error_rolls_back_batch(conn, upsert_supported):
+    def on_write(conn, bills):
+        if any(bill["leginfo_id"] == "B2" for bill, _ in bills):
+            raise ValueError("journal failed")
+    writer = BillsWriter(conn, 'bills', 10, on_write=on_write)
+    writer.add({"leginfo_id": "B1", "title": "First"})
+    writer.add({"leginfo_id": "B2", "title": "Second"})
+    writer.flush()
+    # bill is written only with its changes in journal
+    assert get_bills(conn) == [("B1", "First", None)]
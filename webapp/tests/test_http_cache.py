@@ -0,0 +1,15 @@
+from parsing.http_cache import HTTPCache
+
+
+def test_replaced_entry_isnt_counted_twice(tmp_path):
+    cache = HTTPCache(str(tmp_path / "http_cache.db"), max_size=100)
+    for i in range(3):
+        cache.put("http://example.org/a", "etag{}".format(i), None, "hash", b"x" * 30, "utf-8")
+    assert cache._size == 30
+    assert cache.get("http://example.org/a")["etag"] == "etag2"
+    cache.put("http://example.org/b", None, "yesterday", "hash", b"y" * 50, "utf-8")
+    assert cache._size == 80
+    # nothing is evicted, both entries fit
+    assert cache.get("http://example.org/a") is not None
+    cache.invalidate("http://example.org/b")
+    assert cache._size == 30 == cache._get_size()
@@ -0,0 +1,115 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from jobs import JobQueue, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+
+@pytest.fixture
+def queue(db_file):
+    # jobs are run by test, not by worker threads
+    return JobQueue(db_file, workers=2, max_attempts=3, backoff=10, poll_interval=0.1)
+
+def test_job_is_run_with_args(queue):
+    calls = []
+    queue.register("add")(lambda a, b: calls.append(a + b))
+    job_id = queue.enqueue("add", a=1, b=2)
+    assert queue.get_job(job_id)["state"] == JOB_QUEUED
+    assert queue.run_pending() == 1
+    assert calls == [3]
+    job = queue.get_job(job_id)
+    assert job["state"] == JOB_DONE and job["attempts"] == 1
+    assert queue.run_pending() == 0
+
+def test_unknown_job_isnt_enqueued(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue("no_such_job")
+
+def test_failed_job_is_retried_with_backoff(queue):
+    attempts = []
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("temporary error")
+    queue.register("flaky")(flaky)
+    with mock.patch("jobs.time.time", return_value=1000.0) as time_mock:
+        job_id = queue.enqueue("flaky")
+        queue.run_pending()
+        job = queue.get_job(job_id)
+        assert job["state"] == JOB_QUEUED and "temporary error" in job["last_error"]
+        # job isn't run before its backoff
+        assert job["run_at"] == 1010.0
+        assert queue.run_pending() == 0
+        time_mock.return_value = 1010.0
+        queue.run_pending()
+        # second retry is after twice longer delay
+        assert queue.get_job(job_id)["run_at"] == 1030.0
+        time_mock.return_value = 1030.0
+        queue.run_pending()
+    job = queue.get_job(job_id)
+    assert job["state"] == JOB_DONE and job["attempts"] == 3
+
+def test_job_fails_after_max_attempts(queue):
+    def broken():
+        raise RuntimeError("permanent error")
+    queue.register("broken")(broken)
+    with mock.patch("jobs.time.time", return_value=1000.0) as time_mock:
+        job_id = queue.enqueue("broken")
+        for _ in range(3):
+            time_mock.return_value += 100
+            queue.run_pending()
+    job = queue.get_job(job_id)
+    assert job["state"] == JOB_FAILED and job["attempts"] == 3
+
+def test_job_is_claimed_by_one_worker(queue):
+    ran = []
+    lock = threading.Lock()
+    def record(i):
+        with lock:
+            ran.append(i)
+    queue.register("record")(record)
+    for i in range(100):
+        queue.enqueue("record", i=i)
+    threads = [threading.Thread(target=queue.run_pending) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(ran) == list(range(100))
+
+def test_pending_job_isnt_duplicated(queue):
+    queue.register("scan")(lambda keyword: None)
+    job_id = queue.enqueue_once("scan", keyword="tax")
+    assert queue.enqueue_once("scan", keyword="tax") == job_id
+    assert queue.enqueue_once("scan", keyword="water") != job_id
+    queue.run_pending()
+    # done job doesn't prevent new one
+    assert queue.enqueue_once("scan", keyword="tax") != job_id
+
+def test_running_job_is_taken_when_lease_expires(queue, conn):
+    queue.register("noop")(lambda: None)
+    with mock.patch("jobs.time.time", return_value=1000.0):
+        job_id = queue.enqueue("noop")
+        expired_id = queue.enqueue("noop")
+    # both are run by other process, lease of the second one expired
+    with conn:
+        conn.execute('''UPDATE jobs SET state=?, attempts=1, lease_until=?
+                        WHERE id=?''', (JOB_RUNNING, 2000.0, job_id))
+        conn.execute('''UPDATE jobs SET state=?, attempts=1, lease_until=?
+                        WHERE id=?''', (JOB_RUNNING, 1100.0, expired_id))
+    with mock.patch("jobs.time.time", return_value=1200.0):
+        assert queue.run_pending() == 1
+    assert queue.get_job(job_id)["state"] == JOB_RUNNING
+    job = queue.get_job(expired_id)
+    assert job["state"] == JOB_DONE and job["attempts"] == 2
+
+def test_job_taken_by_other_worker_isnt_finished(queue, conn):
+    queue.register("noop")(lambda: None)
+    job_id = queue.enqueue("noop")
+    job = queue._claim()
+    # lease expired and job was claimed again by other worker
+    with conn:
+        conn.execute('UPDATE jobs SET attempts=attempts+1 WHERE id=?', (job_id,))
+    queue.run_job(*job)
+    assert queue.get_job(job_id)["state"] == JOB_RUNNING
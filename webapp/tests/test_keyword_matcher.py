@@ -0,0 +1,97 @@
+import datetime
+from unittest import mock
+
+import pytest
+from sqlalchemy import create_engine
+
+from init_app import app, db
+from keyword_matcher import (KeywordMatcher, match_bills_by_leginfo_ids, scan_keyword,
+                             get_keywords, get_current_matcher)
+from search import match_bills
+from search_fts import create_fts_index
+
+
+DATE = datetime.date.today().isoformat()
+
+# (leginfo_id, title, subject, text)
+BILLS = [
+    ("B1", "Education: public schools", None, "ÉCOLE publique funding"),
+    ("B2", "COVID-19 relief", "Health", "Relief for small business"),
+    ("B3", "Public health", "Water quality", "Drinking water standards"),
+    ("B4", "Taxation of housing", "Housing", "Property taxation rules"),
+    ("B5", "ÜBER regulation", "Transportation", "Ride services"),
+    ("B6", "Health-care workers", None, "Care of patients in public hospitals"),
+    ("B7", "Schools", "Education", "19 covid cases in schools"),
+    ("B8", "Ecole", None, "Taxes"),
+]
+
+KEYWORDS = ["education", "école", "covid-19", "public health", "tax", "über",
+            "health care", "water", "schools"]
+
+
+@pytest.fixture
+def bills_db(db_file, conn):
+    conn.executemany('''INSERT INTO bills (leginfo_id, title, subject, text,
+                        last_action_date) VALUES (?, ?, ?, ?, ?)''',
+                     [bill + (DATE,) for bill in BILLS])
+    conn.executemany('INSERT INTO keywords (keyword) VALUES (?)',
+                     [(kw,) for kw in KEYWORDS])
+    conn.commit()
+    create_fts_index(conn, 'bills')
+    return db_file
+
+@pytest.fixture
+def fts_search(bills_db):
+    # search functions of app use FTS5 index of test db
+    with app.app_context():
+        engine = create_engine('sqlite:///' + bills_db)
+        with mock.patch.dict(app.config, {'SEARCH_BACKEND': 'fts'}), \
+             mock.patch.dict(db.engines, {None: engine}):
+            yield
+            db.session.remove()
+        engine.dispose()
+
+def get_saved_matches(conn):
+    matched = dict()
+    q = '''SELECT m.keyword, b.leginfo_id FROM bill_keyword_matches m
+           JOIN bills b ON b.id = m.bill_id'''
+    for keyword, leginfo_id in conn.execute(q):
+        matched.setdefault(keyword, set()).add(leginfo_id)
+    return matched
+
+def test_words_are_found_as_whole_words():
+    matcher = KeywordMatcher(["tax", "public health", "covid-19"])
+    assert matcher.find_words("Taxation, TAX; covid-19") == {"tax", "covid", "19"}
+    assert matcher.match("Public services", "health") == {"public health"}
+    assert matcher.match("Taxes") == set()
+
+def test_ingest_matches_are_the_same_as_search(conn, fts_search):
+    leginfo_ids = [bill[0] for bill in BILLS]
+    matcher = KeywordMatcher(get_keywords(conn))
+    with conn:
+        match_bills_by_leginfo_ids(conn, matcher, 'bills', leginfo_ids)
+    saved = get_saved_matches(conn)
+    for keyword in KEYWORDS:
+        searched = match_bills('bill', [keyword], leginfo_ids, time_limit="1y")
+        assert saved.get(keyword, set()) == searched, keyword
+    assert saved["école"] == {"B1"}
+    assert saved["covid-19"] == {"B2", "B7"}
+
+def test_scanned_matches_are_the_same_as_ingest(conn, bills_db):
+    leginfo_ids = [bill[0] for bill in BILLS]
+    with conn:
+        match_bills_by_leginfo_ids(conn, KeywordMatcher(KEYWORDS), 'bills', leginfo_ids)
+    ingested = get_saved_matches(conn)
+    for keyword in KEYWORDS:
+        scan_keyword(conn, keyword, 'bills')
+    assert get_saved_matches(conn) == ingested
+    assert conn.execute('SELECT COUNT(*) FROM keywords WHERE matched=0').fetchone()[0] == 0
+
+def test_matcher_is_reloaded_when_keywords_change(conn):
+    with conn:
+        conn.execute("INSERT INTO keywords (keyword) VALUES ('tax')")
+    matcher = get_current_matcher(conn)
+    assert get_current_matcher(conn, matcher) is matcher
+    with conn:
+        conn.execute("INSERT INTO keywords (keyword) VALUES ('water')")
+    assert sorted(get_current_matcher(conn, matcher).keywords) == ["tax", "water"]
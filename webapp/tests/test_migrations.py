@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+import store
+import migrations
+from migrations import migrate, get_db_version, get_latest_version
+
+
+# bills table created by the first version of app, before migrations
+BASELINE_SCHEMA = '''CREATE TABLE bills (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     code VARCHAR(25),
+                     subject TEXT,
+                     title TEXT,
+                     house_location VARCHAR(10),
+                     authors TEXT,
+                     session VARCHAR(25),
+                     last_action_date VARCHAR(25),
+                     last_action_name VARCHAR(25),
+                     date_published VARCHAR(25),
+                     leginfo_id INT(25),
+                     text TEXT)'''
+
+
+@pytest.fixture
+def baseline_conn(tmp_path, monkeypatch):
+    keywords_file = tmp_path / "keywords.txt"
+    keywords_file.write_text("tax\nHousing\n\ntax\nTAX\n")
+    subscriptions_file = tmp_path / "subscribed_emails.txt"
+    subscriptions_file.write_text("a@example.org:tax, water:1y\n"
+                                  "broken line\n"
+                                  "b@example.org:housing:6M\n")
+    monkeypatch.setattr(store, "KEYWORDS_FILE_NAME", str(keywords_file))
+    monkeypatch.setattr(store, "SUBSCRIPTIONS_FILE_NAME", str(subscriptions_file))
+    conn = sqlite3.connect(str(tmp_path / "bills.db"))
+    conn.execute(BASELINE_SCHEMA)
+    conn.executemany('INSERT INTO bills (leginfo_id, title) VALUES (?, ?)',
+                     [("B1", "old copy"), ("B2", "second"), ("B1", "new copy")])
+    conn.commit()
+    yield conn
+    conn.close()
+
+def get_columns(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+
+def test_baseline_db_is_upgraded(baseline_conn):
+    conn = baseline_conn
+    applied = migrate(conn)
+    assert applied == list(range(1, get_latest_version() + 1))
+    assert get_db_version(conn) == get_latest_version()
+    # duplicated bills are removed before unique index is created
+    assert conn.execute('SELECT leginfo_id, title FROM bills ORDER BY leginfo_id').fetchall() == \
+           [("B1", "new copy"), ("B2", "second")]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO bills (leginfo_id) VALUES ('B2')")
+    assert "text_hash" in get_columns(conn, "bills")
+    assert "matched" in get_columns(conn, "keywords")
+    for table in ['sessions', 'app_state', 'email_queue', 'subscriptions', 'crawl_runs',
+                  'bill_changes', 'jobs', 'bill_keyword_matches']:
+        assert get_columns(conn, table), table
+    assert dict(conn.execute('SELECT key, value FROM app_state')) == \
+           {"data_generation": 0, "delivered_run_id": 0}
+
+def test_files_of_older_version_are_imported(baseline_conn):
+    conn = baseline_conn
+    migrate(conn)
+    assert conn.execute('SELECT keyword, matched FROM keywords ORDER BY id').fetchall() == \
+           [("tax", 0), ("housing", 0)]
+    q = '''SELECT s.email, s.time_limit, k.keyword FROM subscriptions s
+           JOIN subscription_keywords k ON k.subscription_id = s.id
+           ORDER BY s.id, k.position'''
+    assert conn.execute(q).fetchall() == [("a@example.org", "1y", "tax"),
+                                          ("a@example.org", "1y", "water"),
+                                          ("b@example.org", "6M", "housing")]
+
+def test_migrations_are_applied_once(baseline_conn):
+    conn = baseline_conn
+    migrate(conn)
+    assert migrate(conn) == []
+    assert conn.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0] == 2
+
+def test_failed_migration_is_rolled_back(baseline_conn, monkeypatch):
+    def fail(conn):
+        conn.execute('CREATE TABLE half_done (id INTEGER)')
+        raise sqlite3.OperationalError("migration failed")
+    failing = list(migrations.MIGRATIONS)
+    failing[4] = (failing[4][0], failing[4][1], fail)
+    monkeypatch.setattr(migrations, "MIGRATIONS", failing)
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(baseline_conn)
+    assert get_db_version(baseline_conn) == 4
+    assert not baseline_conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='half_done'").fetchone()
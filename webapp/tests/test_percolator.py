@@ -0,0 +1,25 @@
+from collections import namedtuple
+from unittest import mock
+
+from init_app import app
+from percolator import percolate_bills
+
+
+bill = namedtuple('bill', ['leginfo_id', 'title', 'subject', 'last_action_date'])
+
+
+def test_texts_are_read_for_every_batch():
+    bills = [bill("B{}".format(i), "title", "subject", "2020-01-01") for i in range(5)]
+    requested = []
+    def get_texts(leginfo_ids):
+        requested.append(leginfo_ids)
+        return {id_: "text of " + id_ for id_ in leginfo_ids}
+    es = mock.Mock()
+    es.search.return_value = {"hits": {"hits": [
+        {"_source": {"keyword": "tax"}, "fields": {"_percolator_document_slot": [0]}}]}}
+    with app.app_context(), mock.patch.object(app, "elasticsearch", es, create=True):
+        matched = percolate_bills("subscriptions", bills, batch_size=2, get_texts=get_texts)
+    assert requested == [["B0", "B1"], ["B2", "B3"], ["B4"]]
+    docs = es.search.call_args_list[0][1]["body"]["query"]["percolate"]["documents"]
+    assert [doc["text"] for doc in docs] == ["text of b0", "text of b1"]
+    assert matched == {"tax": {"B0", "B2", "B4"}}
@@ -0,0 +1,76 @@
+from unittest import mock
+
+from result_cache import ResultCache
+
+
+class Generation(object):
+    # data generation in db, counts reads
+    def __init__(self):
+        self.value = 0
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.value
+
+
+def test_cached_value_is_returned():
+    # value is cached after miss, like in Bill.get_cached_monitoring_results
+    cache = ResultCache(10, 3600, Generation(), 0)
+    assert cache.get("key") is None
+    cache.put("key", [1, 2])
+    assert cache.get("key") == [1, 2]
+    assert cache.get_stats()["hits"] == 1 and cache.get_stats()["misses"] == 1
+
+def test_new_generation_clears_cache():
+    generation = Generation()
+    cache = ResultCache(10, 3600, generation, 0)
+    cache.get("key")
+    cache.put("key", "results of generation 0")
+    generation.value = 1
+    assert cache.get("key") is None
+    cache.put("key", "results of generation 1")
+    assert cache.get("key") == "results of generation 1"
+    assert cache.get_stats()["generation"] == 1
+
+def test_generation_is_read_once_per_interval():
+    generation = Generation()
+    with mock.patch("result_cache.time.time", return_value=1000.0) as time_mock:
+        cache = ResultCache(10, 3600, generation, 10)
+        cache.get("key")
+        cache.put("key", "value")
+        generation.value = 1
+        # change isn't seen until interval passes
+        assert cache.get("key") == "value"
+        assert generation.reads == 1
+        time_mock.return_value = 1011.0
+        assert cache.get("key") is None
+        assert generation.reads == 2
+
+def test_expired_and_least_recently_used_entries_are_removed():
+    with mock.patch("result_cache.time.time", return_value=1000.0) as time_mock:
+        cache = ResultCache(2, 60, Generation(), 3600)
+        cache.get("a")
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        time_mock.return_value = 1061.0
+        assert cache.get("a") is None
+        assert cache.get_stats()["entries"] == 1
+
+def test_value_computed_before_new_generation_isnt_cached():
+    generation = Generation()
+    cache = ResultCache(10, 3600, generation, 0)
+    cached, lookup_generation = cache.lookup("key")
+    assert cached is None
+    # parser run finished while value was computed
+    generation.value = 1
+    cache.get("other key")
+    cache.put("key", "results of generation 0", lookup_generation)
+    assert cache.get("key") is None
+    cached, lookup_generation = cache.lookup("key")
+    cache.put("key", "results of generation 1", lookup_generation)
+    assert cache.get("key") == "results of generation 1"
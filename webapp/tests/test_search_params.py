@@ -0,0 +1,17 @@
+import pytest
+
+from search_params import encode_cursor, decode_cursor
+
+
+def test_cursor_is_decoded():
+    cursor = encode_cursor(["2020-03-31", "201920200AB1"])
+    assert decode_cursor(cursor, [str, str]) == ["2020-03-31", "201920200AB1"]
+    assert decode_cursor(encode_cursor([None, 5]), [(str, type(None)), int]) == [None, 5]
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!", encode_cursor({"a": 1}), encode_cursor(["x"]),
+    encode_cursor([1, 2, 3]), encode_cursor([1, "B1"]), encode_cursor(["2020-03-31", True]),
+])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, [str, str])
@@ -1,4 +1,7 @@
+import argparse
 import datetime
+import functools
+import multiprocessing
 import os
 
 
@@ -7,29 +10,100 @@ dname = os.path.dirname(abspath)
 os.chdir(dname)
 
 import parsing.notifications
-from parsing.create_db import parse_laws_into_db
-from parsing.notifications import send_email_notifications, clear_bills_changes
+from parsing.create_db import (crawl_session, get_frozen_sessions,
+                               update_session_state, optimize_db,
+                               bump_data_generation, start_crawl_run,
+                               finish_crawl_run)
+from parsing.notifications import send_email_notifications
+from parsing.fetching import get_host_concurrency_share
 from parsing.parsing_options import (email_server, email_acc, email_port, 
-                                     email_pass)
+                                     email_pass, crawl_processes)
 
 
-clear_bills_changes()
+def get_sessions():
+    # sessions from current to 1999-2000, like "2019-2020"
+    year = datetime.datetime.now().year
+    if year % 2 == 0:
+        prev_year = year-1
+    else:
+        year+=1
+        prev_year = year-1
+    sessions = []
+    while year >= 2000:
+        sessions.append(str(prev_year) + '-' + str(year))
+        year -= 2
+        prev_year -= 2
+    return sessions
 
+def get_sessions_to_crawl(backfill=None):
+    '''
+    Returns sessions which aren't frozen
+    backfill - list of frozen sessions to parse anyway (all frozen sessions
+    if empty list)
+    '''
+    frozen = get_frozen_sessions()
+    if backfill is not None:
+        if backfill:
+            frozen -= set(backfill)
+        else:
+            frozen = set()
+    skipped = [session for session in get_sessions() if session in frozen]
+    if skipped:
+        print("Skipping frozen sessions: ", ", ".join(skipped))
+    return [session for session in get_sessions() if session not in frozen]
 
-year = datetime.datetime.now().year
-if year % 2 == 0:
-    prev_year = year-1
-else:
-    year+=1
-    prev_year = year-1
-   
-print("Parsing started: ", datetime.datetime.now())
+def crawl_sessions(sessions, processes, run_id):
+    '''
+    Parses sessions into db, in parallel if processes > 1
+    run_id - crawl run, changes of bills are saved to journal under it
+    Returns merged dict with "added" and "updated" lists of changed bills
+    '''
+    # limits of requests to leginfo are shared by processes parsing at once
+    host_concurrency = get_host_concurrency_share(max(1, min(processes, len(sessions))))
+    crawl = functools.partial(crawl_session, run_id=run_id,
+                              host_concurrency=host_concurrency)
+    changes = {"added": [], "updated": []}
+    pool = None
+    if processes > 1:
+        # spawn - workers mustn't inherit db connection and threads of this
+        # process. One session per worker process, so state isn't shared
+        # between sessions
+        ctx = multiprocessing.get_context("spawn")
+        pool = ctx.Pool(processes, maxtasksperchild=1)
+        sessions_changes = pool.imap(crawl, sessions)
+    else:
+        sessions_changes = map(crawl, sessions)
+    for session_changes in sessions_changes:
+        changes["added"].extend(session_changes["added"])
+        changes["updated"].extend(session_changes["updated"])
+        update_session_state(session_changes["session"],
+                             session_changes["completed"])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return changes
 
-while year >= 2000:
-    session = str(prev_year) + '-' + str(year)
-    parse_laws_into_db(session=session, num=-1)
-    year -= 2
-    prev_year -= 2
 
-send_email_notifications(email_server, email_port=email_port, email_pass=email_pass,
-                         sender_email=email_acc)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parse bills into db and "
+                                     "send email notifications")
+    parser.add_argument("--processes", type=int, default=crawl_processes,
+                        help="number of sessions parsed in parallel")
+    parser.add_argument("--backfill", nargs="*", metavar="SESSION",
+                        help="parse frozen sessions too (all of them if no "
+                        "sessions like 2015-2016 are given)")
+    args = parser.parse_args()
+
+    print("Parsing started: ", datetime.datetime.now())
+
+    run_id = start_crawl_run()
+    sessions = get_sessions_to_crawl(args.backfill)
+    changes = crawl_sessions(sessions, args.processes, run_id)
+    print("Added bills: {}, updated bills: {}".format(len(changes["added"]),
+                                                     len(changes["updated"])))
+    finish_crawl_run(run_id)
+    optimize_db()
+    bump_data_generation()
+
+    send_email_notifications(email_server, email_port=email_port, email_pass=email_pass,
+                             sender_email=email_acc)